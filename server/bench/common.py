@@ -0,0 +1,81 @@
+# Общие функции нагрузочных скриптов bench/
+from urllib import request as urlrequest
+import json
+import statistics
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summary(samples):
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 50),
+        "p95_ms": percentile(samples, 95),
+        "p99_ms": percentile(samples, 99),
+        "mean_ms": statistics.fmean(samples) if samples else None,
+    }
+
+
+def post_json(url, payload):
+    body = json.dumps(payload).encode()
+    req = urlrequest.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+    with urlrequest.urlopen(req) as response:
+        return json.loads(response.read())
+
+
+def post_body(url, body: bytes, content_type: str):
+    req = urlrequest.Request(url, data=body, headers={"Content-Type": content_type}, method="POST")
+    with urlrequest.urlopen(req) as response:
+        return json.loads(response.read())
+
+
+def get_json(url):
+    with urlrequest.urlopen(url) as response:
+        body = response.read()
+        return json.loads(body), len(body)
+
+
+def get_text(url):
+    with urlrequest.urlopen(url) as response:
+        return response.read().decode()
+
+
+def parse_metrics(text):
+    # Разбирает текстовый формат Prometheus в {"имя{метки}": значение}
+    values = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        try:
+            values[name] = float(value)
+        except ValueError:
+            continue
+    return values
+
+
+def decode(message):
+    # Сообщение /ws в любой кодировке (json, columnar, msgpack) -> словарь со списками записей
+    if isinstance(message, bytes):
+        import msgpack
+        payload = msgpack.unpackb(message)
+    else:
+        payload = json.loads(message)
+    if isinstance(payload, dict) and payload.get("layout") == "columnar":
+        for key in ("teachers", "students"):
+            columns = payload.get(key) or {}
+            payload[key] = [dict(zip(columns, row)) for row in zip(*columns.values())]
+    return payload
+
+
+async def wait_for(ws, predicate):
+    while True:
+        message = decode(await ws.recv())
+        if predicate(message):
+            return message
@@ -0,0 +1,144 @@
+# Сравнение чтения снимка состава: ORM-объекты с ленивой загрузкой связей + json
+# против проекций столбцов (roster.roster_snapshot) + orjson. Для каждого размера печатает
+# число SQL-запросов, время чтения из БД и время кодирования.
+#
+# Запуск из каталога server против отдельной (пустой) базы — снимок читает таблицы целиком:
+#   POSTGRES_HOST=localhost python bench/roster_read.py --sizes 1000 10000 100000
+# Добавленные записи удаляются по окончании.
+from datetime import date, timedelta
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, insert, delete
+
+from src.database import SessionLocal, engine
+from src.models import Teachers, Students, Group
+from src import roster
+
+STUDENTS_PER_GROUP = 10
+GROUPS_PER_TEACHER = 20
+
+
+def legacy_teacher_to_dict(teacher):
+    return {
+        "id": teacher.id,
+        "uuid": str(teacher.uuid),
+        "name": teacher.name,
+        "department": teacher.department,
+        "photo": teacher.photo,
+        "date_of_birth": teacher.date_of_birth.isoformat() if teacher.date_of_birth else None,
+        "created_at": teacher.created_at.isoformat() if teacher.created_at else None,
+        "groups": [group.name for group in teacher.groups],
+    }
+
+
+def legacy_student_to_dict(student):
+    return {
+        "id": student.id,
+        "uuid": str(student.uuid),
+        "name": student.name,
+        "department": student.department,
+        "group_id": student.group_id,
+        "group_name": student.group.name if student.group else None,
+        "photo": student.photo,
+        "date_of_birth": student.date_of_birth.isoformat() if student.date_of_birth else None,
+        "created_at": student.created_at.isoformat() if student.created_at else None,
+    }
+
+
+def legacy_snapshot(db):
+    # Прежний путь: ORM-объекты, связи подгружаются лениво по одной
+    teachers = db.query(Teachers).order_by(Teachers.id).all()
+    students = db.query(Students).order_by(Students.id).all()
+    return {
+        "teachers": [legacy_teacher_to_dict(teacher) for teacher in teachers],
+        "students": [legacy_student_to_dict(student) for student in students],
+    }
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def measure(counter, read, encode):
+    with SessionLocal() as db:
+        counter.count = 0
+        started = time.perf_counter()
+        payload = read(db)
+        read_ms = (time.perf_counter() - started) * 1000
+        queries = counter.count
+    started = time.perf_counter()
+    encoded = encode(payload)
+    encode_ms = (time.perf_counter() - started) * 1000
+    return {"queries": queries, "read_ms": round(read_ms, 1), "encode_ms": round(encode_ms, 1), "bytes": len(encoded)}
+
+
+def grow(db, department, teacher_ids, group_ids, students, target):
+    # Досеивает студентов до target; новые группы и преподаватели создаются по мере заполнения
+    rows = []
+    while students + len(rows) < target:
+        index = students + len(rows)
+        if index % STUDENTS_PER_GROUP == 0:
+            if len(group_ids) % GROUPS_PER_TEACHER == 0:
+                teacher_ids.append(db.execute(insert(Teachers).returning(Teachers.id), {
+                    "uuid": uuid.uuid4(), "name": f"Bench Teacher {len(teacher_ids)}",
+                    "department": department, "date_of_birth": date(1970, 1, 1),
+                }).scalar())
+            group_ids.append(db.execute(insert(Group).returning(Group.id), {
+                "name": f"{department} {len(group_ids)}", "teacher_id": teacher_ids[-1],
+                "student_count": STUDENTS_PER_GROUP,
+            }).scalar())
+        rows.append({
+            "uuid": uuid.uuid4(), "name": f"Bench Student {index}", "department": department,
+            "group_id": group_ids[-1], "date_of_birth": date(2000, 1, 1) + timedelta(days=index % 1000),
+        })
+        if len(rows) == 5000:
+            db.execute(insert(Students), rows)
+            students += len(rows)
+            rows = []
+    if rows:
+        db.execute(insert(Students), rows)
+    db.commit()
+    return target
+
+
+def main(args):
+    department = f"Bench {uuid.uuid4().hex[:8]}"
+    counter = QueryCounter()
+    teacher_ids, group_ids, students = [], [], 0
+    results = []
+    try:
+        for size in sorted(args.sizes):
+            with SessionLocal() as db:
+                students = grow(db, department, teacher_ids, group_ids, students, size)
+            results.append({
+                "students": size,
+                "teachers": len(teacher_ids),
+                "legacy": measure(counter, legacy_snapshot, json.dumps),
+                "projection": measure(counter, roster.roster_snapshot, roster.encode),
+            })
+            print(json.dumps(results[-1]), file=sys.stderr)
+    finally:
+        with SessionLocal() as db:
+            db.execute(delete(Teachers).where(Teachers.department == department))
+            db.execute(delete(Students).where(Students.department == department))
+            db.commit()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Число запросов и время построения снимка состава")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="число студентов")
+    main(parser.parse_args())
@@ -0,0 +1,324 @@
+# Набор нагрузочных сценариев для сервера. Засевает состав (кафедры × преподаватели × студенты),
+# прогоняет сценарии и печатает результат одним JSON-документом, который удобно сохранять
+# и сравнивать между релизами.
+#
+# Сервер и локальный PostgreSQL должны быть запущены; лучше использовать отдельную базу —
+# засеянные данные (кафедры "Bench <run_id> ...") не удаляются:
+#   python -m src.migrate && uvicorn src.main:app
+#   python bench/suite.py --departments 3 --teachers 5 --students 2000 --clients 50 --output bench-results.json
+#
+# Сценарии (--scenarios):
+#   enroll_http       — одновременные POST /students/
+#   enroll_ws         — зачисление через /ws множеством клиентов
+#   list_students     — обход GET /students/ по курсору до последней страницы
+#   fire_redistribute — увольнение преподавателя с переводом студентов при подключённых клиентах
+#   reconnect_storm   — одновременное переподключение множества клиентов
+#
+# --encoding json|columnar|msgpack и --no-deflate позволяют сравнить размер сообщений и время разбора
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta, datetime, timezone
+from urllib.parse import urlencode
+import argparse
+import asyncio
+import json
+import subprocess
+import time
+import uuid
+
+import websockets
+
+from common import summary, post_json, post_body, get_json, get_text, parse_metrics, wait_for, decode
+
+SCENARIOS = ["enroll_http", "enroll_ws", "list_students", "fire_redistribute", "reconnect_storm"]
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.run_id = uuid.uuid4().hex[:8]
+        self.http = args.http.rstrip("/")
+        self.ws_url = args.url
+        self.executor = ThreadPoolExecutor(max_workers=max(args.concurrency, 4))
+        self.departments = {}
+
+    async def call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def connect(self, protocol="delta"):
+        # permessage-deflate websockets согласует сам; --no-deflate отключает сжатие для сравнения
+        return websockets.connect(
+            f"{self.ws_url}?protocol={protocol}&encoding={self.args.encoding}",
+            max_size=None, open_timeout=60, compression=None if self.args.no_deflate else "deflate",
+        )
+
+    async def server_metrics(self):
+        return parse_metrics(await self.call(get_text, f"{self.http}/metrics"))
+
+    @staticmethod
+    def metrics_delta(before, after):
+        # Сколько запросов к БД и байт снимков/дельт пришлось на сценарий (по метрикам сервера)
+        def diff(name):
+            return after.get(name, 0) - before.get(name, 0)
+
+        messages = diff("roster_ws_message_db_queries_count")
+        result = {
+            "ws_messages": messages,
+            "db_queries": diff("roster_ws_message_db_queries_sum"),
+            "db_queries_per_message": diff("roster_ws_message_db_queries_sum") / messages if messages else None,
+            "payload_bytes": {},
+            "db_pool_wait_seconds": diff("roster_db_pool_wait_seconds_total"),
+        }
+        for kind in ("delta", "snapshot", "legacy_snapshot"):
+            for encoding in ("json", "columnar", "msgpack"):
+                labels = f'{{kind="{kind}",encoding="{encoding}"}}'
+                count = diff(f"roster_payload_bytes_count{labels}")
+                if count:
+                    result["payload_bytes"][f"{kind}/{encoding}"] = {
+                        "count": count,
+                        "mean": diff(f"roster_payload_bytes_sum{labels}") / count,
+                    }
+        return result
+
+    async def seed(self):
+        args = self.args
+        started = time.perf_counter()
+        async with self.connect() as ws:
+            await ws.recv()
+            for d in range(args.departments):
+                department = f"Bench {self.run_id} D{d}"
+                self.departments[department] = []
+                for t in range(args.teachers):
+                    name = f"Bench {self.run_id} Teacher {d}-{t}"
+                    await ws.send(json.dumps({"action": "create", "type": "teacher", "name": name, "department": department}))
+                    message = await wait_for(ws, lambda m: any(x["name"] == name for x in m.get("teachers", [])))
+                    self.departments[department].append(next(x["id"] for x in message["teachers"] if x["name"] == name))
+
+        # Студенты загружаются потоковым импортом: это быстро и не зависит от сценариев
+        imported = 0
+        for department in self.departments:
+            body = "\n".join(
+                json.dumps({
+                    "name": f"Bench Student {i}",
+                    "department": department,
+                    "date_of_birth": (date(2000, 1, 1) + timedelta(days=i % 2000)).isoformat(),
+                })
+                for i in range(args.students)
+            ).encode()
+            result = await self.call(post_body, f"{self.http}/students/import?format=jsonl", body, "application/x-ndjson")
+            imported += result["imported"]
+        return {
+            "departments": args.departments,
+            "teachers_per_department": args.teachers,
+            "students_per_department": args.students,
+            "imported": imported,
+            "elapsed_s": round(time.perf_counter() - started, 3),
+        }
+
+    async def enroll_http(self):
+        args = self.args
+        department, teachers = next(iter(self.departments.items()))
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies, errors = [], 0
+
+        async def enroll(i):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    await self.call(post_json, f"{self.http}/students/", {
+                        "name": f"Bench Burst {i}", "department": department, "teacher_id": teachers[i % len(teachers)],
+                    })
+                    latencies.append((time.perf_counter() - started) * 1000)
+                except Exception:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(enroll(i) for i in range(args.enrollments)))
+        elapsed = time.perf_counter() - started
+        return {
+            "requests": args.enrollments,
+            "concurrency": args.concurrency,
+            "errors": errors,
+            "throughput_rps": len(latencies) / elapsed if elapsed else None,
+            "latency": summary(latencies),
+        }
+
+    async def enroll_ws(self):
+        args = self.args
+        department = next(iter(self.departments))
+        per_client = max(1, args.enrollments // args.clients)
+        latencies, errors = [], 0
+
+        async def client(c):
+            nonlocal errors
+            async with self.connect() as ws:
+                await ws.recv()
+                for i in range(per_client):
+                    name = f"Bench WS {self.run_id} {c}-{i}"
+                    started = time.perf_counter()
+                    await ws.send(json.dumps({"action": "create", "type": "student", "name": name, "department": department}))
+                    message = await wait_for(ws, lambda m: "error" in m or any(s["name"] == name for s in m.get("students", [])))
+                    if "error" in message:
+                        errors += 1
+                    else:
+                        latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(c) for c in range(args.clients)))
+        elapsed = time.perf_counter() - started
+        return {
+            "clients": args.clients,
+            "actions": per_client * args.clients,
+            "errors": errors,
+            "throughput_aps": len(latencies) / elapsed if elapsed else None,
+            "latency": summary(latencies),
+        }
+
+    async def list_students(self):
+        args = self.args
+        department = next(iter(self.departments))
+        params = {"department": department, "fields": "id,name,group_name", "limit": args.page_size, "sort": "name"}
+        latencies, sizes, cursor = [], [], None
+        while True:
+            query = dict(params, cursor=cursor) if cursor else params
+            started = time.perf_counter()
+            page, size = await self.call(get_json, f"{self.http}/students/?{urlencode(query)}")
+            latencies.append((time.perf_counter() - started) * 1000)
+            sizes.append(size)
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        return {
+            "pages": len(latencies),
+            "page_size": args.page_size,
+            "first_page_ms": latencies[0],
+            "last_page_ms": latencies[-1],
+            "latency": summary(latencies),
+            "mean_page_bytes": sum(sizes) / len(sizes),
+        }
+
+    async def fire_redistribute(self):
+        args = self.args
+        department, teachers = next(iter(self.departments.items()))
+        fired = teachers.pop(0)
+        deleted = lambda m: "error" in m or fired in m.get("deleted", {}).get("teachers", [])
+
+        # Подключённые клиенты ждут дельту с удалённым преподавателем: так видна задержка рассылки
+        listeners = []
+        for _ in range(args.clients):
+            ws = await self.connect()
+            await ws.recv()
+            listeners.append(ws)
+
+        async def listen(ws, sent_at):
+            while True:
+                raw = await ws.recv()
+                if deleted(decode(raw)):
+                    return (time.perf_counter() - sent_at[0]) * 1000, len(raw)
+
+        try:
+            async with self.connect() as ws:
+                await ws.recv()
+                sent_at = [0.0]
+                waiting = [asyncio.create_task(listen(listener, sent_at)) for listener in listeners]
+                sent_at[0] = time.perf_counter()
+                await ws.send(json.dumps({"action": "fire", "type": "teacher", "id": fired}))
+                message = await wait_for(ws, deleted)
+                ack_ms = (time.perf_counter() - sent_at[0]) * 1000
+                fanout = await asyncio.gather(*waiting)
+        finally:
+            for listener in listeners:
+                await listener.close()
+
+        return {
+            "clients": args.clients,
+            "error": message.get("error"),
+            "moved_students": len(message.get("students", [])),
+            "ack_ms": ack_ms,
+            "fanout_latency": summary([ms for ms, _ in fanout]),
+            "delta_bytes": fanout[0][1] if fanout else None,
+        }
+
+    async def reconnect_storm(self):
+        args = self.args
+
+        async def reconnect():
+            # Время до разобранного первого сообщения: сюда входит и декодирование на клиенте
+            started = time.perf_counter()
+            async with self.connect(args.storm_protocol) as ws:
+                first = await ws.recv()
+                decode(first)
+                return (time.perf_counter() - started) * 1000, len(first)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(reconnect() for _ in range(args.storm)), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        ok = [r for r in results if not isinstance(r, BaseException)]
+        return {
+            "connections": args.storm,
+            "protocol": args.storm_protocol,
+            "errors": len(results) - len(ok),
+            "elapsed_s": elapsed,
+            "first_message": summary([ms for ms, _ in ok]),
+            "first_message_bytes": ok[0][1] if ok else None,
+        }
+
+    async def run(self):
+        report = {
+            "meta": {
+                "label": self.args.label,
+                "run_id": self.run_id,
+                "started_at": datetime.now(timezone.utc).isoformat(),
+                "git_commit": git_commit(),
+                "params": vars(self.args),
+            },
+            "seed": await self.seed(),
+            "scenarios": {},
+        }
+        for name in self.args.scenarios:
+            before = await self.server_metrics()
+            started = time.perf_counter()
+            result = await getattr(self, name)()
+            result["elapsed_s"] = round(time.perf_counter() - started, 3)
+            result["server"] = self.metrics_delta(before, await self.server_metrics())
+            report["scenarios"][name] = result
+        return report
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочные сценарии сервера; результат — JSON")
+    parser.add_argument("--url", default="ws://localhost:8000/ws")
+    parser.add_argument("--http", default="http://localhost:8000")
+    parser.add_argument("--departments", type=int, default=3)
+    parser.add_argument("--teachers", type=int, default=5, help="преподавателей на кафедре")
+    parser.add_argument("--students", type=int, default=1000, help="студентов на кафедре")
+    parser.add_argument("--clients", type=int, default=50, help="одновременных клиентов /ws")
+    parser.add_argument("--concurrency", type=int, default=20, help="одновременных HTTP-запросов")
+    parser.add_argument("--enrollments", type=int, default=500, help="зачислений в сценариях enroll_*")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--storm", type=int, default=200, help="подключений в reconnect_storm")
+    parser.add_argument("--storm-protocol", choices=["delta", "snapshot"], default="delta")
+    parser.add_argument("--encoding", choices=["json", "columnar", "msgpack"], default="json", help="кодировка сообщений /ws")
+    parser.add_argument("--no-deflate", action="store_true", help="не согласовывать permessage-deflate")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--label", default=None, help="метка прогона (например, версия)")
+    parser.add_argument("--output", default=None, help="файл для JSON-результата")
+    args = parser.parse_args()
+
+    report = asyncio.run(Bench(args).run())
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Нагрузочный тест: задержка ping/pong для множества подключений /ws,
+# пока параллельно выполняется тяжёлое перераспределение студентов (увольнение преподавателя).
+#
+# Запуск против работающего сервера:
+#   python bench/ws_latency.py --url ws://localhost:8000/ws --http http://localhost:8000 --sockets 50 --students 500
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import websockets
+
+from common import summary, post_json, wait_for
+
+
+async def create_teacher(ws, name, department):
+    await ws.send(json.dumps({"action": "create", "type": "teacher", "name": name, "department": department}))
+    message = await wait_for(ws, lambda m: any(t["name"] == name for t in m.get("teachers", [])))
+    return next(t["id"] for t in message["teachers"] if t["name"] == name)
+
+
+async def seed(args, department):
+    async with websockets.connect(f"{args.url}?protocol=delta", max_size=None) as ws:
+        await ws.recv()
+        fired = await create_teacher(ws, f"Bench Fired {department}", department)
+        for i in range(args.teachers - 1):
+            await create_teacher(ws, f"Bench Teacher {i} {department}", department)
+
+    loop = asyncio.get_running_loop()
+    for i in range(args.students):
+        await loop.run_in_executor(None, post_json, f"{args.http}/students/", {
+            "name": f"Bench Student {i}",
+            "department": department,
+            "teacher_id": fired,
+        })
+    return fired
+
+
+async def pinger(url, phase, samples, stop):
+    async with websockets.connect(f"{url}?protocol=delta", max_size=None) as ws:
+        await ws.recv()
+        seq = 0
+        while not stop.is_set():
+            seq += 1
+            started = time.perf_counter()
+            await ws.send(json.dumps({"action": "ping", "id": seq}))
+            await wait_for(ws, lambda m, seq=seq: m.get("type") == "pong" and m.get("id") == seq)
+            samples[phase["name"]].append((time.perf_counter() - started) * 1000)
+            await asyncio.sleep(0.01)
+
+
+async def main(args):
+    department = f"Bench {uuid.uuid4().hex[:8]}"
+    fired = await seed(args, department)
+
+    phase = {"name": "baseline"}
+    samples = {"baseline": [], "redistribution": [], "after": []}
+    stop = asyncio.Event()
+    pingers = [asyncio.create_task(pinger(args.url, phase, samples, stop)) for _ in range(args.sockets)]
+
+    await asyncio.sleep(args.duration)
+
+    # Увольняем преподавателя: сервер перераспределяет всех его студентов
+    phase["name"] = "redistribution"
+    async with websockets.connect(f"{args.url}?protocol=delta", max_size=None) as ws:
+        await ws.recv()
+        started = time.perf_counter()
+        await ws.send(json.dumps({"action": "fire", "type": "teacher", "id": fired}))
+        await wait_for(ws, lambda m: fired in m.get("deleted", {}).get("teachers", []) or "error" in m)
+        redistribution_ms = (time.perf_counter() - started) * 1000
+
+    phase["name"] = "after"
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*pingers)
+
+    print(json.dumps({
+        "sockets": args.sockets,
+        "students": args.students,
+        "redistribution_ms": redistribution_ms,
+        "latency": {name: summary(values) for name, values in samples.items()},
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Задержка /ws под нагрузкой во время перераспределения студентов")
+    parser.add_argument("--url", default="ws://localhost:8000/ws")
+    parser.add_argument("--http", default="http://localhost:8000")
+    parser.add_argument("--sockets", type=int, default=50, help="число одновременных подключений")
+    parser.add_argument("--teachers", type=int, default=3, help="преподавателей на кафедре, включая увольняемого")
+    parser.add_argument("--students", type=int, default=500, help="студентов у увольняемого преподавателя")
+    parser.add_argument("--duration", type=float, default=3.0, help="длительность фаз до и после увольнения, с")
+    asyncio.run(main(parser.parse_args()))
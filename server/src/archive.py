@@ -0,0 +1,482 @@
+from sqlalchemy import select, insert, update, delete, func, event, literal, tuple_, union_all, text
+from sqlalchemy.orm import Session, with_loader_criteria
+from datetime import datetime, timedelta
+import os
+
+from .models import Teachers, Students, Group, Request, Stage, Job, StudentArchive, GroupArchive, RequestArchive
+from .database import run_db
+from .changes import mark_changed
+from .capacity import mark_groups
+from .listing import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, encode_cursor, decode_cursor
+from . import jobs, placement, workflow
+
+# Сколько дней отчисленные студенты, закрытые группы и завершённые заявки остаются в основных таблицах,
+# прежде чем задание compact_archive переносит их в архив
+ARCHIVE_RETENTION_DAYS = int(os.environ.get("ARCHIVE_RETENTION_DAYS", "90"))
+# Как часто ставится задание compact_archive (0 — только по запросу POST /archive/compact)
+ARCHIVE_COMPACT_SECONDS = int(os.environ.get("ARCHIVE_COMPACT_SECONDS", "86400"))
+# Сколько записей переносится одной транзакцией
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", "500"))
+
+# Ключ advisory-блокировки: секции архива создаёт одна транзакция за раз
+PARTITION_LOCK_ID = 7242002
+
+# Модели с мягким удалением: строка с deleted_at остаётся в таблице (история, ссылки заявок),
+# но не видна запросам ORM
+SOFT_DELETE_MODELS = (Students, Group)
+ACTIVE_CRITERIA = tuple(
+    with_loader_criteria(model, lambda cls: cls.deleted_at.is_(None), include_aliases=True)
+    for model in SOFT_DELETE_MODELS
+)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _hide_deleted(state):
+    # Выборки, UPDATE и DELETE через ORM (в том числе подзапросы, соединения и ленивая загрузка связей)
+    # видят только действующих студентов и группы. Запросы истории и архивации отключают условие
+    # через execution_options(include_deleted=True) и отбирают удалённые строки явно.
+    # Слушатель висит на классе Session, чтобы действовать и в сессиях миграции, а не только SessionLocal.
+    # Дочитывание атрибутов уже загруженного объекта не фильтруется
+    if state.is_column_load or state.execution_options.get("include_deleted", False):
+        return
+    if state.is_select or state.is_update or state.is_delete:
+        state.statement = state.statement.options(*ACTIVE_CRITERIA)
+
+
+# Мягкое удаление
+
+def expel_student(db: Session, student_id: int):
+    # Отчисление: студент помечается удалённым (строка и заявки остаются для истории), его открытые
+    # заявки отменяются, место в группе освобождается; опустевшая группа закрывается
+    row = db.execute(
+        update(Students)
+        .where(Students.id == student_id)
+        .values(deleted_at=func.now(), version=Students.version + 1)
+        .returning(Students.group_id, Students.department)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if row is None:
+        raise ValueError("Student not found")
+    mark_changed(db, deleted_students=[student_id], departments={row.department}, groups={row.group_id} - {None})
+
+    open_requests = db.scalars(
+        select(Request.id).where(Request.student_id == student_id, Request.status.not_in(workflow.CLOSED_STATUSES))
+    ).all()
+    if open_requests:
+        workflow.transition(db, open_requests, status="cancelled")
+
+    closed = False
+    if row.group_id is not None and placement.release_seat(db, row.group_id) == 0:
+        closed = close_group(db, row.group_id)
+    return {"student_id": student_id, "group_id": row.group_id, "group_closed": closed}
+
+
+def close_group(db: Session, group_id: int):
+    # Закрывает пустую группу; её название снова свободно для новых групп
+    row = db.execute(
+        update(Group)
+        .where(Group.id == group_id, Group.student_count == 0)
+        .values(deleted_at=func.now())
+        .returning(Group.teacher_id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if row is None:
+        return False
+    mark_groups(db, {group_id: None})
+    mark_changed(db, teachers=[row.teacher_id])
+    return True
+
+
+# Перенос в архив. Каждая функция переносит указанные строки целиком в транзакции вызывающего:
+# копия в архивную таблицу и удаление из основной
+
+def ensure_partitions(db: Session, model, moments):
+    # Годовые секции архивной таблицы для указанных моментов времени (только PostgreSQL)
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    table = model.__tablename__
+    years = sorted({moment.year for moment in moments})
+    missing = [
+        year for year in years
+        if db.execute(text("SELECT to_regclass(:name)"), {"name": f"{table}_{year}"}).scalar() is None
+    ]
+    if not missing:
+        return
+    db.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": PARTITION_LOCK_ID})
+    for year in missing:
+        db.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {table}_{year} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+        ))
+
+
+def archive_requests(db: Session, request_ids):
+    # Заявки вместе с этапами; счётчики request_counts уменьшаются на перенесённые заявки
+    if not request_ids:
+        return 0
+    rows = db.execute(
+        select(
+            Request.id, Request.teacher_id, Request.student_id, Request.status, Request.stage,
+            Request.created_at, Request.updated_at,
+        ).where(Request.id.in_(request_ids))
+    ).all()
+    stages = {}
+    for stage in db.execute(
+        select(Stage.id, Stage.request_id, Stage.stage_name, Stage.status, Stage.started_at, Stage.completed_at)
+        .where(Stage.request_id.in_(request_ids))
+        .order_by(Stage.id)
+    ):
+        stages.setdefault(stage.request_id, []).append(workflow.stage_info(stage))
+
+    now = datetime.now()
+    records = [
+        {
+            "id": row.id, "closed_at": row.updated_at or row.created_at or now, "teacher_id": row.teacher_id,
+            "student_id": row.student_id, "status": row.status, "stage": row.stage, "created_at": row.created_at,
+            "stages": stages.get(row.id, []),
+        }
+        for row in rows
+    ]
+    ensure_partitions(db, RequestArchive, [record["closed_at"] for record in records])
+    db.execute(insert(RequestArchive), records)
+
+    deltas = {}
+    for row in rows:
+        workflow.add_count(deltas, workflow.count_key(row.teacher_id, row.status, row.stage), -1)
+    workflow.apply_counts(db, deltas)
+    db.execute(delete(Stage).where(Stage.request_id.in_(request_ids)).execution_options(synchronize_session=False))
+    db.execute(delete(Request).where(Request.id.in_(request_ids)).execution_options(synchronize_session=False))
+    return len(records)
+
+
+def archive_students(db: Session, student_ids):
+    # Отчисленные студенты; их заявки переносятся первыми (иначе каскад внешнего ключа удалит их)
+    if not student_ids:
+        return 0
+    archive_requests(db, db.scalars(select(Request.id).where(Request.student_id.in_(student_ids))).all())
+    rows = db.execute(
+        select(
+            Students.id, Students.uuid, Students.name, Students.department, Students.group_id,
+            Group.name.label("group_name"), Group.teacher_id, Students.photo, Students.date_of_birth,
+            Students.created_at, Students.version, Students.deleted_at,
+        )
+        .outerjoin(Group, Students.group_id == Group.id)
+        .where(Students.id.in_(student_ids))
+        .execution_options(include_deleted=True)
+    ).all()
+    now = datetime.now()
+    records = [dict(row._mapping, deleted_at=row.deleted_at or now) for row in rows]
+    ensure_partitions(db, StudentArchive, [record["deleted_at"] for record in records])
+    db.execute(insert(StudentArchive), records)
+    db.execute(
+        delete(Students).where(Students.id.in_(student_ids))
+        .execution_options(include_deleted=True, synchronize_session=False)
+    )
+    return len(records)
+
+
+def archive_groups(db: Session, group_ids):
+    # Закрытые группы, на которые уже не ссылаются студенты
+    if not group_ids:
+        return 0
+    rows = db.execute(
+        select(Group.id, Group.name, Group.teacher_id, Teachers.department, Group.deleted_at)
+        .outerjoin(Teachers, Group.teacher_id == Teachers.id)
+        .where(Group.id.in_(group_ids))
+        .execution_options(include_deleted=True)
+    ).all()
+    now = datetime.now()
+    records = [dict(row._mapping, deleted_at=row.deleted_at or now) for row in rows]
+    ensure_partitions(db, GroupArchive, [record["deleted_at"] for record in records])
+    db.execute(insert(GroupArchive), records)
+    db.execute(
+        delete(Group).where(Group.id.in_(group_ids))
+        .execution_options(include_deleted=True, synchronize_session=False)
+    )
+    return len(records)
+
+
+def archive_teacher(db: Session, teacher_id: int):
+    # Перед увольнением: отчисленные студенты из групп преподавателя и его закрытые группы уходят в архив,
+    # иначе их удалит каскад внешних ключей вместе с группами и самим преподавателем
+    teacher_groups = select(Group.id).where(Group.teacher_id == teacher_id)
+    student_ids = db.scalars(
+        select(Students.id)
+        .where(Students.group_id.in_(teacher_groups), Students.deleted_at.is_not(None))
+        .execution_options(include_deleted=True)
+    ).all()
+    group_ids = db.scalars(
+        select(Group.id)
+        .where(Group.teacher_id == teacher_id, Group.deleted_at.is_not(None))
+        .execution_options(include_deleted=True)
+    ).all()
+    return {"students": archive_students(db, student_ids), "groups": archive_groups(db, group_ids)}
+
+
+# Задание compact_archive: переносит в архив строки старше срока хранения пачками по ARCHIVE_BATCH_SIZE.
+# Сначала заявки (завершённые), затем отчисленные студенты, затем закрытые группы без студентов
+
+def closed_requests(before):
+    return (
+        select(Request.id)
+        .where(Request.status.in_(workflow.CLOSED_STATUSES), Request.updated_at < before)
+    )
+
+
+def deleted_students(before):
+    return select(Students.id).where(Students.deleted_at < before).execution_options(include_deleted=True)
+
+
+def deleted_groups(before):
+    has_students = select(Students.id).where(Students.group_id == Group.id).exists()
+    return (
+        select(Group.id)
+        .where(Group.deleted_at < before, ~has_students)
+        .execution_options(include_deleted=True)
+    )
+
+
+def compact_requests(db: Session, before, limit=ARCHIVE_BATCH_SIZE):
+    query = closed_requests(before).order_by(Request.updated_at, Request.id)
+    return archive_requests(db, db.scalars(query.limit(limit).with_for_update(skip_locked=True)).all())
+
+
+def compact_students(db: Session, before, limit=ARCHIVE_BATCH_SIZE):
+    query = deleted_students(before).order_by(Students.deleted_at, Students.id)
+    return archive_students(db, db.scalars(query.limit(limit).with_for_update(skip_locked=True)).all())
+
+
+def compact_groups(db: Session, before, limit=ARCHIVE_BATCH_SIZE):
+    query = deleted_groups(before).order_by(Group.deleted_at, Group.id)
+    return archive_groups(db, db.scalars(query.limit(limit).with_for_update(skip_locked=True)).all())
+
+
+COMPACTION_STEPS = (("requests", compact_requests), ("students", compact_students), ("groups", compact_groups))
+
+
+def compaction_backlog(db: Session, before):
+    # Сколько строк осталось перенести (для прогресса задания)
+    return sum(
+        db.execute(select(func.count()).select_from(query.subquery())).scalar()
+        for query in (closed_requests(before), deleted_students(before), deleted_groups(before))
+    )
+
+
+def compact_step(db: Session, job: jobs.JobContext, name, step, before):
+    # Одна пачка шага name; число перенесённых строк попадает в checkpoint в той же транзакции
+    moved = step(db, before)
+    if moved:
+        totals = dict((job.checkpoint or {}).get("moved", {}))
+        totals[name] = totals.get(name, 0) + moved
+        job.checkpoint = {"moved": totals}
+        job.progress(job.done + moved)
+    return moved
+
+
+@jobs.job_handler("compact_archive")
+async def compact_archive_job(job: jobs.JobContext):
+    # Повтор после сбоя продолжает с оставшихся строк: перенесённых в основных таблицах уже нет
+    before = datetime.fromisoformat(job.params["before"])
+    remaining = await run_db(compaction_backlog, job.db, before)
+    job.progress(job.done, job.done + remaining)
+    for name, step in COMPACTION_STEPS:
+        while await job.commit(compact_step, job, name, step, before):
+            pass
+    moved = (job.checkpoint or {}).get("moved", {})
+    return {"before": job.params["before"], **{name: moved.get(name, 0) for name, _ in COMPACTION_STEPS}}
+
+
+def enqueue_compaction(db: Session, scheduled: bool = False):
+    # Ставит compact_archive со сроком хранения на текущий момент. Плановый запуск пропускается, если задание
+    # уже ставилось за последние ARCHIVE_COMPACT_SECONDS (расписание есть у каждого воркера uvicorn)
+    if scheduled:
+        since = datetime.now() - timedelta(seconds=ARCHIVE_COMPACT_SECONDS)
+        if db.query(Job.id).filter(Job.kind == "compact_archive", Job.created_at > since).first() is not None:
+            return None
+    before = datetime.now() - timedelta(days=ARCHIVE_RETENTION_DAYS)
+    return jobs.enqueue(db, "compact_archive", {"before": before.isoformat()}, key="compact_archive")
+
+
+# История: удалённые записи из основных таблиц (ещё не перенесённые) и из архива одним списком,
+# от недавно удалённых к давним. Пагинация по курсору (время удаления, id), как у списка студентов
+
+def parse_moment(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def _window(query, moment, record_id, since, until, position, limit):
+    # Часть объединения: период, позиция курсора и первые limit строк по индексу (момент, id)
+    if since is not None:
+        query = query.where(moment >= since)
+    if until is not None:
+        query = query.where(moment < until)
+    if position is not None:
+        query = query.where(tuple_(moment, record_id) < tuple_(*position))
+    return select(query.order_by(moment.desc(), record_id.desc()).limit(limit).subquery())
+
+
+def _history(db: Session, parts, key, cursor, limit, info):
+    # parts — [(запрос, столбец времени, столбец id)]; столбец времени в запросах назван key
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    position = None
+    if cursor:
+        value, last_id = decode_cursor(cursor, key)
+        position = (parse_moment(value), last_id)
+    merged = union_all(*[
+        _window(query, moment, record_id, since, until, position, limit + 1)
+        for query, moment, record_id, since, until in parts
+    ]).subquery()
+    rows = db.execute(
+        select(merged).order_by(merged.c[key].desc(), merged.c.id.desc()).limit(limit + 1)
+        .execution_options(include_deleted=True)
+    ).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(key, rows[-1]._mapping[key], rows[-1].id)
+    return {"items": [info(row) for row in rows], "next_cursor": next_cursor}
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def student_history_info(row):
+    return {
+        "id": row.id,
+        "name": row.name,
+        "department": row.department,
+        "group_id": row.group_id,
+        "group_name": row.group_name,
+        "teacher_id": row.teacher_id,
+        "date_of_birth": _iso(row.date_of_birth),
+        "created_at": _iso(row.created_at),
+        "deleted_at": _iso(row.deleted_at),
+        "archived": bool(row.archived),
+    }
+
+
+def group_history_info(row):
+    return {
+        "id": row.id,
+        "name": row.name,
+        "teacher_id": row.teacher_id,
+        "department": row.department,
+        "deleted_at": _iso(row.deleted_at),
+        "archived": bool(row.archived),
+    }
+
+
+def request_history_info(row):
+    return {
+        "id": row.id,
+        "teacher_id": row.teacher_id,
+        "student_id": row.student_id,
+        "status": row.status,
+        "stage": row.stage,
+        "created_at": _iso(row.created_at),
+        "closed_at": _iso(row.closed_at),
+        "stages": row.stages,
+    }
+
+
+def expelled_students(
+    db: Session,
+    department: str = None,
+    teacher_id: int = None,
+    since: datetime = None,
+    until: datetime = None,
+    cursor: str = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+):
+    # Отчисленные студенты за период [since, until), с группой и преподавателем на момент отчисления
+    live = (
+        select(
+            Students.id, Students.name, Students.department, Students.group_id, Group.name.label("group_name"),
+            Group.teacher_id, Students.date_of_birth, Students.created_at, Students.deleted_at,
+            literal(False).label("archived"),
+        )
+        .outerjoin(Group, Students.group_id == Group.id)
+        .where(Students.deleted_at.is_not(None))
+    )
+    archived = select(
+        StudentArchive.id, StudentArchive.name, StudentArchive.department, StudentArchive.group_id,
+        StudentArchive.group_name, StudentArchive.teacher_id, StudentArchive.date_of_birth,
+        StudentArchive.created_at, StudentArchive.deleted_at, literal(True).label("archived"),
+    )
+    if department:
+        live = live.where(Students.department == department)
+        archived = archived.where(StudentArchive.department == department)
+    if teacher_id:
+        live = live.where(Group.teacher_id == teacher_id)
+        archived = archived.where(StudentArchive.teacher_id == teacher_id)
+    return _history(db, [
+        (live, Students.deleted_at, Students.id, since, until),
+        (archived, StudentArchive.deleted_at, StudentArchive.id, since, until),
+    ], "deleted_at", cursor, limit, student_history_info)
+
+
+def closed_groups(
+    db: Session,
+    department: str = None,
+    teacher_id: int = None,
+    since: datetime = None,
+    until: datetime = None,
+    cursor: str = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+):
+    # Закрытые (опустевшие) группы за период [since, until)
+    live = (
+        select(
+            Group.id, Group.name, Group.teacher_id, Teachers.department, Group.deleted_at,
+            literal(False).label("archived"),
+        )
+        .outerjoin(Teachers, Group.teacher_id == Teachers.id)
+        .where(Group.deleted_at.is_not(None))
+    )
+    archived = select(
+        GroupArchive.id, GroupArchive.name, GroupArchive.teacher_id, GroupArchive.department,
+        GroupArchive.deleted_at, literal(True).label("archived"),
+    )
+    if department:
+        live = live.where(Teachers.department == department)
+        archived = archived.where(GroupArchive.department == department)
+    if teacher_id:
+        live = live.where(Group.teacher_id == teacher_id)
+        archived = archived.where(GroupArchive.teacher_id == teacher_id)
+    return _history(db, [
+        (live, Group.deleted_at, Group.id, since, until),
+        (archived, GroupArchive.deleted_at, GroupArchive.id, since, until),
+    ], "deleted_at", cursor, limit, group_history_info)
+
+
+def archived_requests(
+    db: Session,
+    status: str = None,
+    teacher_id: int = None,
+    student_id: int = None,
+    since: datetime = None,
+    until: datetime = None,
+    cursor: str = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+):
+    # Заявки из архива с этапами, закрытые за период [since, until). Недавно закрытые заявки
+    # ещё в основной таблице: GET /requests/?status=done
+    if status is not None and status not in workflow.REQUEST_STATUSES:
+        raise ValueError(f"Unknown status: {status}")
+    query = select(
+        RequestArchive.id, RequestArchive.teacher_id, RequestArchive.student_id, RequestArchive.status,
+        RequestArchive.stage, RequestArchive.created_at, RequestArchive.closed_at, RequestArchive.stages,
+    )
+    if status:
+        query = query.where(RequestArchive.status == status)
+    if teacher_id:
+        query = query.where(RequestArchive.teacher_id == teacher_id)
+    if student_id:
+        query = query.where(RequestArchive.student_id == student_id)
+    return _history(db, [
+        (query, RequestArchive.closed_at, RequestArchive.id, since, until),
+    ], "closed_at", cursor, limit, request_history_info)
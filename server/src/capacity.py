@@ -0,0 +1,305 @@
+from sqlalchemy import select, event, inspect
+from sqlalchemy.orm import Session
+import bisect
+import os
+import threading
+
+from .database import SessionLocal
+from .models import Teachers, Group
+from .changes import pending_changes, transaction_changes, commit_hooks
+from .log import get_logger
+
+# Максимальное число студентов в группе
+GROUP_CAPACITY = 10
+
+# Как часто кэш вместимости сверяется с БД (секунды; 0 — не сверяется)
+CAPACITY_RECONCILE_SECONDS = float(os.environ.get("CAPACITY_RECONCILE_SECONDS", "60"))
+
+logger = get_logger("capacity")
+
+# Нет записи о группе в изменениях транзакции
+_MISSING = object()
+
+
+class DepartmentCapacity:
+    # Вместимость одной кафедры: группы со свободными местами по возрастанию id
+    # и преподаватели по числу групп. Поиск — первый элемент отсортированного списка,
+    # изменение — bisect, поэтому место и преподаватель для новой группы выбираются без запросов к БД
+    def __init__(self, name, teacher_ids=(), groups=()):
+        self.name = name
+        self.groups = {}
+        self.free = []
+        self.teacher_groups = {teacher_id: 0 for teacher_id in teacher_ids}
+        for group_id, teacher_id, student_count in groups:
+            self.groups[group_id] = (teacher_id, student_count)
+            self.teacher_groups[teacher_id] = self.teacher_groups.get(teacher_id, 0) + 1
+            if student_count < GROUP_CAPACITY:
+                self.free.append(group_id)
+        self.free.sort()
+        self.load = sorted((count, teacher_id) for teacher_id, count in self.teacher_groups.items())
+
+    def state(self):
+        return self.groups, self.teacher_groups
+
+    def _set_teacher_groups(self, teacher_id, count):
+        old = self.teacher_groups.get(teacher_id)
+        if old is not None:
+            del self.load[bisect.bisect_left(self.load, (old, teacher_id))]
+        self.teacher_groups[teacher_id] = count
+        bisect.insort(self.load, (count, teacher_id))
+
+    def set_group(self, group_id, teacher_id, student_count):
+        if group_id not in self.groups:
+            self._set_teacher_groups(teacher_id, self.teacher_groups.get(teacher_id, 0) + 1)
+        self.groups[group_id] = (teacher_id, student_count)
+        position = bisect.bisect_left(self.free, group_id)
+        listed = position < len(self.free) and self.free[position] == group_id
+        if student_count < GROUP_CAPACITY and not listed:
+            self.free.insert(position, group_id)
+        elif student_count >= GROUP_CAPACITY and listed:
+            del self.free[position]
+
+    def remove_group(self, group_id):
+        old = self.groups.pop(group_id, None)
+        if old is None:
+            return
+        position = bisect.bisect_left(self.free, group_id)
+        if position < len(self.free) and self.free[position] == group_id:
+            del self.free[position]
+        self._set_teacher_groups(old[0], self.teacher_groups[old[0]] - 1)
+
+    def first_free(self, overlay):
+        # Первая группа со свободным местом с учётом ещё не зафиксированных изменений транзакции overlay,
+        # в том числе групп кафедры, открытых в этой транзакции
+        opened = min((
+            group_id for group_id, state in overlay.items()
+            if state is not None and group_id not in self.groups
+            and state["teacher_id"] in self.teacher_groups and state["student_count"] < GROUP_CAPACITY
+        ), default=None)
+        for group_id in self.free:
+            if opened is not None and opened < group_id:
+                break
+            state = overlay.get(group_id, _MISSING)
+            if state is _MISSING or (state is not None and state["student_count"] < GROUP_CAPACITY):
+                return group_id
+        return opened
+
+    def least_loaded(self, overlay):
+        # Преподаватель с наименьшим числом групп (при равенстве — с меньшим id);
+        # группы, созданные и удалённые в текущей транзакции, учитываются поверх кэша
+        adjust = {}
+        for group_id, state in overlay.items():
+            if state is None and group_id in self.groups:
+                teacher_id = self.groups[group_id][0]
+                adjust[teacher_id] = adjust.get(teacher_id, 0) - 1
+            elif state is not None and group_id not in self.groups and state.get("teacher_id") in self.teacher_groups:
+                adjust[state["teacher_id"]] = adjust.get(state["teacher_id"], 0) + 1
+        candidates = [(self.teacher_groups[teacher_id] + delta, teacher_id) for teacher_id, delta in adjust.items()]
+        first = next(((count, teacher_id) for count, teacher_id in self.load if teacher_id not in adjust), None)
+        if first is not None:
+            candidates.append(first)
+        return min(candidates)[1] if candidates else None
+
+
+class CapacityCache:
+    # Кэш вместимости кафедр для размещения студентов. Источник истины — БД: кэш меняется только
+    # после фиксации транзакций этого процесса (commit_hooks), кафедры с изменившимся составом
+    # преподавателей перечитываются, а весь кэш периодически сверяется с БД (reconcile).
+    # Подсказка кэша всегда проверяется условием в UPDATE, поэтому устаревший кэш не приводит
+    # к переполнению группы — только к лишнему запросу
+    def __init__(self):
+        self.departments = {}
+        self.teacher_department = {}
+        self.hits = 0
+        self.misses = 0
+        self.rejections = 0
+        self.drift = 0
+        self._touched = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _load(self, db: Session, department=None):
+        # Вместимость одной кафедры или (department=None) всех кафедр: два запроса
+        teachers_query = select(Teachers.id, Teachers.department).where(Teachers.department.is_not(None))
+        groups_query = (
+            select(Group.id, Group.teacher_id, Group.student_count, Teachers.department)
+            .join(Teachers, Group.teacher_id == Teachers.id)
+            .where(Teachers.department.is_not(None))
+        )
+        if department is not None:
+            teachers_query = teachers_query.where(Teachers.department == department)
+            groups_query = groups_query.where(Teachers.department == department)
+        teachers, groups = {}, {}
+        for teacher_id, name in db.execute(teachers_query):
+            teachers.setdefault(name, []).append(teacher_id)
+        for group_id, teacher_id, student_count, name in db.execute(groups_query):
+            groups.setdefault(name, []).append((group_id, teacher_id, student_count))
+        names = set(teachers) if department is None else {department}
+        return {name: DepartmentCapacity(name, teachers.get(name, ()), groups.get(name, ())) for name in names}
+
+    def _store(self, capacity):
+        old = self.departments.get(capacity.name)
+        if old is not None:
+            for teacher_id in old.teacher_groups:
+                self.teacher_department.pop(teacher_id, None)
+        self.departments[capacity.name] = capacity
+        for teacher_id in capacity.teacher_groups:
+            self.teacher_department[teacher_id] = capacity.name
+
+    def get(self, db: Session, department: str):
+        # Вместимость кафедры; при промахе читается из БД в транзакции вызывающего
+        with self._lock:
+            capacity = self.departments.get(department)
+            if capacity is not None:
+                self.hits += 1
+                return capacity
+            self.misses += 1
+        generation = self._generation
+        capacity = self._load(db, department)[department]
+        changes = transaction_changes(db)
+        if changes.capacity or changes.stale_departments:
+            # Транзакция уже меняла группы или преподавателей: прочитанное может не быть зафиксировано
+            return capacity
+        with self._lock:
+            # Пока читали, зафиксировались другие изменения: прочитанное могло устареть
+            if department not in self.departments and generation == self._generation:
+                self._store(capacity)
+                self._mark_touched(department)
+            return self.departments.get(department, capacity)
+
+    def group_count(self, group_id):
+        # Число студентов группы из кэша или None, если группа в кэше неизвестна
+        with self._lock:
+            for capacity in self.departments.values():
+                if group_id in capacity.groups:
+                    self.hits += 1
+                    return capacity.groups[group_id][1]
+            self.misses += 1
+            return None
+
+    def invalidate(self, departments=None):
+        # Кафедры перечитаются из БД при следующем обращении; None — все кафедры
+        with self._lock:
+            self._generation += 1
+            names = list(self.departments) if departments is None else departments
+            for name in names:
+                capacity = self.departments.pop(name, None)
+                if capacity is not None:
+                    for teacher_id in capacity.teacher_groups:
+                        self.teacher_department.pop(teacher_id, None)
+                if self._touched is not None:
+                    self._touched.add(name)
+
+    def apply(self, changes):
+        # Обработчик фиксации транзакции: новое состояние групп и устаревшие кафедры
+        if not changes.capacity and not changes.stale_departments:
+            return
+        with self._lock:
+            self._generation += 1
+            for group_id, state in changes.capacity.items():
+                current = next((c for c in self.departments.values() if group_id in c.groups), None)
+                if current is not None and (state is None or current.groups[group_id][0] != state["teacher_id"]):
+                    # Группа удалена или перешла к другому преподавателю
+                    current.remove_group(group_id)
+                    self._mark_touched(current.name)
+                if state is None:
+                    continue
+                name = self.teacher_department.get(state["teacher_id"])
+                if name is None:
+                    continue  # кафедра не загружена: прочитается из БД при обращении
+                self.departments[name].set_group(group_id, state["teacher_id"], state["student_count"])
+                self._mark_touched(name)
+        if changes.stale_departments:
+            self.invalidate(changes.stale_departments - {None})
+
+    def _mark_touched(self, name):
+        if self._touched is not None:
+            self._touched.add(name)
+
+    def warm(self):
+        # Загрузка всех кафедр при запуске
+        with SessionLocal() as db:
+            departments = self._load(db)
+        with self._lock:
+            for capacity in departments.values():
+                self._store(capacity)
+        logger.info("Кэш вместимости загружен: кафедр %s", len(departments))
+
+    def reconcile(self):
+        # Сверка с БД: расхождения (изменения других воркеров, массовые правки в обход placement)
+        # считаются в drift и исправляются. Кафедры, изменённые во время чтения, пропускаются до следующей сверки
+        with self._lock:
+            self._touched = set()
+        try:
+            with SessionLocal() as db:
+                fresh = self._load(db)
+        finally:
+            with self._lock:
+                touched, self._touched = self._touched, None
+        drift = 0
+        with self._lock:
+            for name, capacity in list(self.departments.items()):
+                if name in touched:
+                    continue
+                current = fresh.get(name) or DepartmentCapacity(name)
+                if capacity.state() != current.state():
+                    groups, teachers = capacity.state()
+                    fresh_groups, fresh_teachers = current.state()
+                    drift += sum(1 for key in groups.keys() | fresh_groups.keys() if groups.get(key) != fresh_groups.get(key))
+                    drift += len(teachers.keys() ^ fresh_teachers.keys())
+                    self._store(current)
+            self.drift += drift
+        if drift:
+            logger.warning("Кэш вместимости расходился с БД: %s записей исправлено", drift)
+        return drift
+
+    def reject(self):
+        # Подсказка кэша не подтвердилась в БД; размещение продолжено запросом к БД
+        with self._lock:
+            self.rejections += 1
+
+
+capacity_cache = CapacityCache()
+commit_hooks.append(capacity_cache.apply)
+
+
+def overlay(db: Session):
+    # Состояние групп, изменённое текущей транзакцией (ещё не попало в кэш)
+    return transaction_changes(db).capacity
+
+
+def mark_groups(db: Session, groups=None, stale_departments=()):
+    # Для массовых UPDATE/INSERT групп: {id группы: {"teacher_id", "student_count"} или None — удалена}.
+    # Кэш обновится после фиксации транзакции
+    changes = pending_changes(db)
+    changes.capacity.update(groups or {})
+    changes.stale_departments.update(stale_departments)
+
+
+@event.listens_for(SessionLocal, "before_flush")
+def _track_capacity(session, flush_context, instances):
+    # Изменения групп и преподавателей через ORM (create_group, удаление пустых групп, найм и увольнение)
+    changes = pending_changes(session)
+    for obj in session.deleted:
+        if isinstance(obj, Group):
+            changes.capacity[obj.id] = None
+        elif isinstance(obj, Teachers):
+            changes.stale_departments.add(obj.department)
+    for obj in session.dirty:
+        if isinstance(obj, Teachers) and session.is_modified(obj):
+            history = inspect(obj).attrs.department.history
+            if history.deleted:
+                changes.stale_departments.update(history.deleted)
+                changes.stale_departments.add(obj.department)
+        elif isinstance(obj, Group) and session.is_modified(obj):
+            changes.capacity[obj.id] = {"teacher_id": obj.teacher_id, "student_count": obj.student_count}
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _track_new_capacity(session, flush_context):
+    changes = pending_changes(session)
+    for obj in session.new:
+        if isinstance(obj, Group):
+            changes.capacity[obj.id] = {"teacher_id": obj.teacher_id, "student_count": obj.student_count or 0}
+        elif isinstance(obj, Teachers):
+            changes.stale_departments.add(obj.department)
@@ -0,0 +1,342 @@
+from sqlalchemy import event, inspect
+from collections import deque
+import threading
+import uuid
+import os
+
+from .database import SessionLocal
+from .models import Teachers, Students, Group
+
+# Сколько последних ревизий держим в памяти. Клиенту, отставшему сильнее, отправляется полный снимок
+CHANGELOG_SIZE = int(os.environ.get("ROSTER_CHANGELOG_SIZE", "1000"))
+
+
+class RosterChanges:
+    # Идентификаторы преподавателей и студентов, затронутых изменением, и кафедры, которых оно касается
+    # (в том числе прежние кафедры и группы перемещённых и удалённых записей). Новые кафедры известны
+    # по загруженным строкам; departments_unknown — кафедры удалённых записей неизвестны
+    def __init__(self):
+        self.teachers = set()
+        self.students = set()
+        self.deleted_teachers = set()
+        self.deleted_students = set()
+        self.departments = set()
+        self.groups = set()
+        self.departments_unknown = False
+        # Для кэша вместимости (capacity.py): новое состояние групп {id: {...} или None} и кафедры,
+        # которые нужно перечитать из БД. В рассылку клиентам не попадают
+        self.capacity = {}
+        self.stale_departments = set()
+
+    def __bool__(self):
+        return bool(self.teachers or self.students or self.deleted_teachers or self.deleted_students)
+
+    def update(self, other):
+        self.teachers |= other.teachers
+        self.students |= other.students
+        self.deleted_teachers |= other.deleted_teachers
+        self.deleted_students |= other.deleted_students
+        self.departments |= other.departments
+        self.groups |= other.groups
+        self.departments_unknown |= other.departments_unknown
+        self.capacity.update(other.capacity)
+        self.stale_departments |= other.stale_departments
+
+    def as_dict(self):
+        return {
+            "teachers": sorted(self.teachers - {None}),
+            "students": sorted(self.students - {None}),
+            "deleted_teachers": sorted(self.deleted_teachers - {None}),
+            "deleted_students": sorted(self.deleted_students - {None}),
+            "departments": None if self.departments_unknown else sorted(self.departments - {None}),
+            "groups": sorted(self.groups - {None}),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        changes = cls()
+        changes.teachers.update(data.get("teachers", ()))
+        changes.students.update(data.get("students", ()))
+        changes.deleted_teachers.update(data.get("deleted_teachers", ()))
+        changes.deleted_students.update(data.get("deleted_students", ()))
+        changes.groups.update(data.get("groups", ()))
+        departments = data.get("departments")
+        if departments is None:
+            changes.departments_unknown = True
+        else:
+            changes.departments.update(departments)
+        return changes
+
+    def upserted_teachers(self):
+        return self.teachers - self.deleted_teachers - {None}
+
+    def upserted_students(self):
+        return self.students - self.deleted_students - {None}
+
+
+# Вызываются после фиксации транзакции с её изменениями (в том числе без изменений состава)
+commit_hooks = []
+
+
+def _pending(session):
+    return session.info.setdefault("roster_pending", RosterChanges())
+
+
+def pending_changes(db):
+    # Изменения текущего уровня транзакции (SAVEPOINT или внешней), в которые пишут отслеживание и mark_changed
+    return _pending(db)
+
+
+def transaction_changes(db):
+    # Все ещё не зафиксированные изменения транзакции, включая открытые SAVEPOINT
+    merged = RosterChanges()
+    for changes in db.info.get("roster_savepoints", ()):
+        if changes is not None:
+            merged.update(changes)
+    current = db.info.get("roster_pending")
+    if current is not None:
+        merged.update(current)
+    return merged
+
+
+def mark_changed(db, teachers=(), students=(), deleted_teachers=(), deleted_students=(), departments=None, groups=()):
+    # Для массовых UPDATE/DELETE, которые не проходят через unit of work сессии.
+    # departments — прежние кафедры записей, если массовое изменение их меняет или удаляет записи,
+    # groups — прежние группы перемещённых студентов
+    changes = _pending(db)
+    changes.groups.update(groups)
+    changes.teachers.update(teachers)
+    changes.students.update(students)
+    changes.deleted_teachers.update(deleted_teachers)
+    changes.deleted_students.update(deleted_students)
+    if departments is not None:
+        changes.departments.update(departments)
+    elif deleted_teachers or deleted_students:
+        changes.departments_unknown = True
+
+
+def pop_committed(db):
+    # Забираем изменения, зафиксированные с момента прошлого вызова
+    return db.info.pop("roster_committed", RosterChanges())
+
+
+@event.listens_for(SessionLocal, "before_flush")
+def _track_existing(session, flush_context, instances):
+    changes = _pending(session)
+    for obj in session.deleted:
+        if isinstance(obj, Teachers):
+            changes.deleted_teachers.add(obj.id)
+            changes.departments.add(obj.department)
+        elif isinstance(obj, Students):
+            changes.deleted_students.add(obj.id)
+            changes.departments.add(obj.department)
+            changes.groups.add(obj.group_id)
+        elif isinstance(obj, Group):
+            changes.teachers.add(obj.teacher_id)
+    for obj in session.dirty:
+        if not session.is_modified(obj):
+            continue
+        if isinstance(obj, (Teachers, Students)):
+            # Запись могла перейти на другую кафедру: изменение касается и прежней
+            changes.departments.update(inspect(obj).attrs.department.history.deleted or ())
+        if isinstance(obj, Teachers):
+            changes.teachers.add(obj.id)
+        elif isinstance(obj, Students):
+            changes.students.add(obj.id)
+            changes.groups.update(inspect(obj).attrs.group_id.history.deleted or ())
+        elif isinstance(obj, Group):
+            # Группа могла перейти к другому преподавателю: обновляем обоих
+            history = inspect(obj).attrs.teacher_id.history
+            changes.teachers.update(history.deleted or ())
+            changes.teachers.add(obj.teacher_id)
+            # Название группы отображается у её студентов
+            changes.students.update(s.id for s in obj.students)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _track_new(session, flush_context):
+    # Первичные ключи новых объектов известны только после flush
+    changes = _pending(session)
+    for obj in session.new:
+        if isinstance(obj, Teachers):
+            changes.teachers.add(obj.id)
+            changes.departments.add(obj.department)
+        elif isinstance(obj, Students):
+            changes.students.add(obj.id)
+            changes.departments.add(obj.department)
+        elif isinstance(obj, Group):
+            changes.teachers.add(obj.teacher_id)
+
+
+@event.listens_for(SessionLocal, "after_transaction_create")
+def _begin_savepoint(session, transaction):
+    # Изменения внутри SAVEPOINT копятся отдельно: при его откате они отбрасываются, не задевая остальные
+    if transaction.nested:
+        session.info.setdefault("roster_savepoints", []).append(session.info.pop("roster_pending", None))
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _move_to_committed(session):
+    if session.in_nested_transaction():
+        # RELEASE SAVEPOINT: изменения станут видны другим только с фиксацией всей транзакции
+        session.info["roster_savepoint_released"] = True
+        return
+    pending = session.info.pop("roster_pending", None)
+    if pending is None:
+        return
+    for hook in commit_hooks:
+        hook(pending)
+    if pending:
+        session.info.setdefault("roster_committed", RosterChanges()).update(pending)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_pending(session):
+    session.info.pop("roster_pending", None)
+
+
+@event.listens_for(SessionLocal, "after_transaction_end")
+def _end_savepoint(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("roster_savepoints", None)
+        return
+    if not transaction.nested:
+        return
+    savepoints = session.info.get("roster_savepoints")
+    parent = savepoints.pop() if savepoints else None
+    current = session.info.pop("roster_pending", None)
+    if session.info.pop("roster_savepoint_released", False) and current is not None:
+        # SAVEPOINT отпущен: его изменения переходят во внешнюю транзакцию
+        parent = parent or RosterChanges()
+        parent.update(current)
+    if parent is not None:
+        session.info["roster_pending"] = parent
+
+
+class Scope:
+    # Часть состава, на которую подписан клиент: кафедры и/или группы.
+    # groups — {id группы: (название, кафедра преподавателя)}; изменения маршрутизируются по кафедрам,
+    # поэтому группы подписки учитываются через кафедры их преподавателей
+    def __init__(self, departments=(), groups=None):
+        self.departments = frozenset(departments)
+        self.groups = dict(groups or {})
+        self.group_names = frozenset(name for name, _ in self.groups.values())
+        self.routes = self.departments | frozenset(department for _, department in self.groups.values())
+        self.key = (tuple(sorted(self.departments)), tuple(sorted(self.groups)))
+
+    def touches(self, departments):
+        # departments=None — кафедры изменения неизвестны, оно может касаться любой подписки
+        return departments is None or not self.routes.isdisjoint(departments)
+
+    def has_teacher(self, row):
+        return row["department"] in self.departments or not self.group_names.isdisjoint(row["groups"])
+
+    def has_student(self, row):
+        return row["department"] in self.departments or row["group_id"] in self.groups
+
+
+class ChangeLog:
+    # Журнал последних изменений состава. Каждое изменение получает номер ревизии;
+    # epoch отличает журнал этого процесса от журнала после перезапуска
+    def __init__(self, size=CHANGELOG_SIZE):
+        self.epoch = uuid.uuid4().hex
+        self.revision = 0
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def append(self, teachers, students, deleted_teachers, deleted_students, departments=None):
+        # departments — кафедры, которых касается изменение (None — неизвестно)
+        with self._lock:
+            self.revision += 1
+            self._entries.append((self.revision, {
+                "teachers": teachers,
+                "students": students,
+                "deleted_teachers": list(deleted_teachers),
+                "deleted_students": list(deleted_students),
+                "departments": None if departments is None else frozenset(departments),
+            }))
+            return self.revision
+
+    def departments(self, revision):
+        # Кафедры изменения с ревизией revision (None — неизвестны или изменение уже вытеснено из журнала)
+        with self._lock:
+            for entry_revision, entry in reversed(self._entries):
+                if entry_revision == revision:
+                    return entry["departments"]
+                if entry_revision < revision:
+                    break
+            return None
+
+    def invalidate(self):
+        # Изменение произошло, но его содержимое неизвестно: все отставшие клиенты получат полный снимок
+        with self._lock:
+            self.revision += 1
+            self._entries.clear()
+            return self.revision
+
+    def since(self, revision, scope=None):
+        # Объединённая дельта после ревизии revision или None, если нужен полный снимок.
+        # С подпиской scope в дельту попадают только изменения её кафедр: записи подписки обновляются,
+        # а ушедшие из неё (переведённые в другую группу или на другую кафедру) приходят как удалённые
+        with self._lock:
+            if revision > self.revision:
+                return None
+            if self._entries and revision < self._entries[0][0] - 1:
+                return None
+            if not self._entries and revision != self.revision:
+                return None
+
+            teachers, students = {}, {}
+            deleted_teachers, deleted_students = set(), set()
+            # Идём с конца: обычно клиенту не хватает лишь последних ревизий
+            missed = []
+            from_revision = revision
+            for entry_revision, entry in reversed(self._entries):
+                if entry_revision <= revision:
+                    break
+                if scope is None or scope.touches(entry["departments"]):
+                    missed.append(entry)
+
+            if scope is not None:
+                # Ревизии, не затронувшие подписку, клиенту не нужны: дельта годится и тому,
+                # кто остановился на последнем изменении подписки до revision
+                from_revision = self._entries[0][0] - 1 if self._entries else revision
+                for entry_revision, entry in reversed(self._entries):
+                    if entry_revision <= revision and scope.touches(entry["departments"]):
+                        from_revision = entry_revision
+                        break
+
+            for entry in reversed(missed):
+                for item in entry["teachers"]:
+                    if scope is None or scope.has_teacher(item):
+                        teachers[item["id"]] = item
+                        deleted_teachers.discard(item["id"])
+                    else:
+                        teachers.pop(item["id"], None)
+                        deleted_teachers.add(item["id"])
+                for item in entry["students"]:
+                    if scope is None or scope.has_student(item):
+                        students[item["id"]] = item
+                        deleted_students.discard(item["id"])
+                    else:
+                        students.pop(item["id"], None)
+                        deleted_students.add(item["id"])
+                for item_id in entry["deleted_teachers"]:
+                    teachers.pop(item_id, None)
+                    deleted_teachers.add(item_id)
+                for item_id in entry["deleted_students"]:
+                    students.pop(item_id, None)
+                    deleted_students.add(item_id)
+
+            return {
+                "type": "delta",
+                "epoch": self.epoch,
+                "from_revision": from_revision,
+                "revision": self.revision,
+                "teachers": sorted(teachers.values(), key=lambda item: item["id"]),
+                "students": sorted(students.values(), key=lambda item: item["id"]),
+                "deleted": {
+                    "teachers": sorted(deleted_teachers),
+                    "students": sorted(deleted_students),
+                },
+            }
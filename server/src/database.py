@@ -1,7 +1,14 @@
 # src/database.py
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import threading
+import asyncio
+import time
 import os
 
 # Получаем параметры подключения из переменных окружения или используем значения по умолчанию
@@ -11,16 +18,127 @@ DATABASE_HOST = os.environ.get("POSTGRES_HOST", "db")  # имя сервиса 
 DATABASE_PORT = os.environ.get("POSTGRES_PORT", "5432")
 DATABASE_NAME = os.environ.get("POSTGRES_DB", "postgres")
 
-DATABASE_URL = f"postgresql://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
+# DATABASE_URL целиком заменяет параметры POSTGRES_*
+DATABASE_URL = os.environ.get("DATABASE_URL") or f"postgresql://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
+
+# Прямое подключение к Postgres в обход PgBouncer: LISTEN/NOTIFY и миграции требуют сессионного режима
+DATABASE_DIRECT_URL = os.environ.get("DATABASE_DIRECT_URL") or DATABASE_URL
+
+# Настройки пула соединений. Всего соединений у воркера не больше DB_POOL_SIZE + DB_MAX_OVERFLOW;
+# сумма по всем воркерам должна укладываться в max_connections Postgres (или в пул PgBouncer)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "1") == "1"
+# Ограничение времени одного запроса, мс (0 — без ограничения)
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "0"))
+# Режим работы через PgBouncer (pool_mode=transaction): без сессионных настроек,
+# statement_timeout задаётся внутри каждой транзакции через SET LOCAL
+DB_PGBOUNCER = os.environ.get("DB_PGBOUNCER", "0") == "1"
+
+
+class MeteredQueuePool(QueuePool):
+    # QueuePool, который считает ожидание соединения: сколько потоков ждут сейчас (свободных соединений
+    # нет и открыть новое нельзя), сколько было выдач соединений и сколько времени на них ушло
+    # (включая открытие новых соединений), сколько ожиданий закончилось таймаутом
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.waiting = 0
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _exhausted(self):
+        # Те же условия, при которых QueuePool._do_get блокируется на очереди
+        return self._pool.empty() and -1 < self._max_overflow <= self._overflow
+
+    def _do_get(self):
+        started = time.perf_counter()
+        blocked = self._exhausted()
+        if blocked:
+            with self._stats_lock:
+                self.waiting += 1
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            if blocked:
+                with self._stats_lock:
+                    self.waiting -= 1
+        waited = time.perf_counter() - started
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return connection
+
+
+def create_db_engine(url: str = DATABASE_URL):
+    connect_args = {}
+    if DB_STATEMENT_TIMEOUT_MS and not DB_PGBOUNCER:
+        connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    db_engine = create_engine(
+        url,
+        poolclass=MeteredQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args=connect_args,
+    )
+    if DB_STATEMENT_TIMEOUT_MS and DB_PGBOUNCER:
+        @event.listens_for(db_engine, "begin")
+        def set_statement_timeout(conn):
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+    return db_engine
+
+
+def pool_stats(db_engine=None):
+    # Состояние пула для подбора числа воркеров и размера пула
+    pool = (db_engine or engine).pool
+    stats = {
+        "size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+        "idle": pool.checkedin() if hasattr(pool, "checkedin") else None,
+        "overflow": pool.overflow() if hasattr(pool, "overflow") else None,
+    }
+    if isinstance(pool, MeteredQueuePool):
+        stats.update({
+            "waiting": pool.waiting,
+            "checkouts": pool.checkouts,
+            "wait_seconds_total": round(pool.wait_seconds, 6),
+            "wait_seconds_max": round(pool.max_wait_seconds, 6),
+            "timeouts": pool.timeouts,
+        })
+    return stats
+
 
 # Создание движка базы данных:
-engine = create_engine(DATABASE_URL)
+engine = create_db_engine()
 
 # Создание фабрики сессий:
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Пул потоков для синхронной работы с БД из асинхронных обработчиков (WebSocket).
+# Ограничен, чтобы тяжёлые операции не открывали больше соединений, чем есть в пуле движка
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", "8"))
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+async def run_db(fn, *args, **kwargs):
+    # Выполняет fn в пуле потоков БД; цикл событий в это время обслуживает остальные подключения
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, functools.partial(context.run, fn, *args, **kwargs))
+
 # Создание базового класса для моделей:
 Base = declarative_base()
 
-# Создаем все таблицы, если их еще нет
-Base.metadata.create_all(bind=engine)
+# Схема создаётся и обновляется отдельным шагом: python -m src.migrate (см. migrate.py)
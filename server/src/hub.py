@@ -0,0 +1,351 @@
+from sqlalchemy import text, make_url
+import asyncio
+import json
+import os
+import select
+import threading
+import uuid
+
+from .database import SessionLocal, engine, DATABASE_DIRECT_URL, run_db
+from .changes import RosterChanges
+from .capacity import capacity_cache
+from .jobs import FINISHED, load_job
+from .roster import roster_log, snapshot_cache, record_changes, encode, payload_size
+from .log import get_logger
+from . import metrics
+
+# Сколько сообщений может ждать отправки одному клиенту, прежде чем очередь схлопнется в один снимок
+SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", "64"))
+
+# memory — один процесс; postgres — несколько воркеров uvicorn через LISTEN/NOTIFY
+HUB_BACKEND = os.environ.get("ROSTER_HUB_BACKEND", "memory")
+
+logger = get_logger("hub")
+
+# Маркер в очереди отправки: клиент пропустил сообщения и должен догнать состояние целиком
+RESYNC = object()
+
+
+class Subscriber:
+    # Подключённый клиент /ws со своей ограниченной очередью отправки
+    def __init__(self, websocket, protocol="snapshot", since=-1, encoding="json", scope=None):
+        self.websocket = websocket
+        self.protocol = protocol
+        self.encoding = encoding
+        # Подписка на кафедры и группы (changes.Scope); None — весь состав
+        self.scope = scope
+        self.since = since
+        self.revision = -1
+        self.ready = False
+        self.dropped = 0
+        self.queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.task = None
+        # Задания, о ходе которых клиент получает события
+        self.jobs = set()
+
+    def offer(self, from_revision, revision, message):
+        # Никогда не ждём: медленный клиент не должен тормозить остальных
+        if self.queue.full():
+            self.dropped += self.queue.qsize()
+            metrics.WS_SEND_DROPPED.inc(self.queue.qsize())
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait((None, None, RESYNC))
+        self.queue.put_nowait((from_revision, revision, message))
+
+    def send(self, payload):
+        # Ответ только этому клиенту (например, ошибка), в порядке общей очереди
+        self.offer(None, None, encode(payload, self.encoding))
+
+    @property
+    def scope_key(self):
+        return self.scope.key if self.scope is not None else None
+
+    def initial_payload(self, db):
+        if self.protocol != "delta":
+            return snapshot_cache.get(db, "snapshot", encoding=self.encoding, scope=self.scope)
+        payload = roster_log.since(self.since, self.scope) if self.since >= 0 else None
+        if payload is None:
+            return snapshot_cache.get(db, encoding=self.encoding, scope=self.scope)
+        return payload["revision"], encode(payload, self.encoding)
+
+    def resync_payload(self):
+        # Сводное сообщение вместо выброшенных: дельта из журнала или полный снимок
+        with SessionLocal() as db:
+            if self.protocol != "delta":
+                return snapshot_cache.get(db, "snapshot", encoding=self.encoding, scope=self.scope)
+            payload = roster_log.since(self.revision, self.scope)
+            if payload is None:
+                return snapshot_cache.get(db, encoding=self.encoding, scope=self.scope)
+            return payload["revision"], encode(payload, self.encoding)
+
+    async def run(self):
+        while True:
+            from_revision, revision, message = await self.queue.get()
+            if revision is not None:
+                if revision <= self.revision:
+                    # Изменение уже вошло в ранее отправленный снимок или сводную дельту
+                    continue
+                if from_revision > self.revision:
+                    # Дельты пришли не по порядку: догоняем по журналу
+                    message = RESYNC
+            if message is RESYNC:
+                revision, message = await run_db(self.resync_payload)
+            if revision is not None:
+                self.revision = revision
+            try:
+                if isinstance(message, bytes):
+                    await self.websocket.send_bytes(message)
+                else:
+                    await self.websocket.send_text(message)
+            except Exception:
+                # Клиент отключился; обработчик /ws сам снимет подписку
+                return
+
+
+class Hub:
+    # Реестр подключений: изменение сериализуется один раз на кодировку и подписку и рассылается
+    # подписчикам. Подписчики с ограниченной подпиской учтены в индексе по кафедрам: изменение
+    # сопоставляется только с подписчиками своих кафедр, а не со всеми подключениями
+    def __init__(self, backend):
+        self.id = uuid.uuid4().hex
+        self.backend = backend
+        self.subscribers = set()
+        self.unscoped = set()
+        self.by_department = {}
+        self.job_followers = {}
+
+    async def start(self):
+        await self.backend.start(self._on_message)
+
+    async def stop(self):
+        await self.backend.stop()
+        for subscriber in list(self.subscribers):
+            self.unsubscribe(subscriber)
+
+    def subscribe(self, websocket, protocol="snapshot", since=-1, encoding="json", scope=None):
+        subscriber = Subscriber(websocket, protocol, since, encoding, scope)
+        self.subscribers.add(subscriber)
+        if scope is None:
+            self.unscoped.add(subscriber)
+        else:
+            for department in scope.routes:
+                self.by_department.setdefault(department, set()).add(subscriber)
+        subscriber.task = asyncio.create_task(subscriber.run())
+        return subscriber
+
+    async def activate(self, subscriber, db):
+        # Первое сообщение клиенту; изменения, случившиеся до этого момента, в него уже вошли
+        revision, message = await run_db(subscriber.initial_payload, db)
+        subscriber.revision = revision
+        subscriber.ready = True
+        subscriber.offer(None, None, message)
+        if roster_log.revision > revision:
+            subscriber.offer(None, None, RESYNC)
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        self.unscoped.discard(subscriber)
+        if subscriber.scope is not None:
+            for department in subscriber.scope.routes:
+                subscribers = self.by_department.get(department)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self.by_department[department]
+        for job_id in subscriber.jobs:
+            followers = self.job_followers.get(job_id)
+            if followers is not None:
+                followers.discard(subscriber)
+                if not followers:
+                    del self.job_followers[job_id]
+        if subscriber.task:
+            subscriber.task.cancel()
+
+    def follow(self, subscriber, job_id):
+        # Клиент поставил задание или запросил его состояние: дальше он получает события о его ходе
+        subscriber.jobs.add(job_id)
+        self.job_followers.setdefault(job_id, set()).add(subscriber)
+
+    async def job_event(self, job):
+        # Событие задания: подписчикам этого воркера сразу, остальным воркерам — через шину.
+        # Итог задания (результат может быть большим) другие воркеры читают из БД сами
+        self._deliver_job(job)
+        compact = {key: job.get(key) for key in ("id", "kind", "status", "progress", "total", "error")}
+        await self.backend.publish({"origin": self.id, "job": compact})
+
+    def _deliver_job(self, job):
+        followers = self.job_followers.get(job["id"], ())
+        for subscriber in followers:
+            if subscriber.ready:
+                subscriber.send({"type": "job", "job": job})
+        if job["status"] in FINISHED:
+            for subscriber in followers:
+                subscriber.jobs.discard(job["id"])
+            self.job_followers.pop(job["id"], None)
+
+    async def publish(self, changes):
+        if not changes:
+            return
+        await self._apply(changes)
+        await self.backend.publish({"origin": self.id, **changes.as_dict()})
+
+    async def _on_message(self, message):
+        if message.get("origin") == self.id:
+            return
+        if "job" in message:
+            job = message["job"]
+            if job["id"] not in self.job_followers:
+                return
+            if job["status"] in FINISHED:
+                job = await run_db(load_job, job["id"]) or job
+            self._deliver_job(job)
+            return
+        # Вместимость групп изменил другой воркер: затронутые кафедры перечитаются из БД
+        capacity_cache.invalidate(None if message.get("full") else message.get("departments"))
+        if message.get("full"):
+            # Подробности изменения неизвестны: все клиенты получат актуальное состояние заново
+            roster_log.invalidate()
+            for subscriber in self.subscribers:
+                if subscriber.ready:
+                    subscriber.offer(None, None, RESYNC)
+            return
+        await self._apply(RosterChanges.from_dict(message))
+
+    def recipients(self, departments):
+        # Подписчики, которых касается изменение кафедр departments (None — неизвестно каких)
+        if departments is None:
+            return set(self.subscribers)
+        result = set(self.unscoped)
+        for department in departments:
+            result |= self.by_department.get(department, set())
+        return result
+
+    def _load(self, changes, legacy_scopes):
+        with SessionLocal() as db:
+            revision = record_changes(db, changes)
+            departments = roster_log.departments(revision)
+            # Полный снимок нужен только клиентам старого протокола, и строится он один раз на всех
+            # в каждой используемой кодировке и подписке (и сразу достаётся из кэша новым подключениям)
+            snapshots = {
+                (encoding, scope_key): snapshot_cache.get(db, "snapshot", encoding=encoding, scope=scope)[1]
+                for (encoding, scope_key), scope in legacy_scopes.items()
+                if scope is None or scope.touches(departments)
+            }
+        return revision, departments, snapshots
+
+    async def _apply(self, changes):
+        legacy_scopes = {(s.encoding, s.scope_key): s.scope for s in self.subscribers if s.protocol != "delta"}
+        revision, departments, snapshots = await run_db(self._load, changes, legacy_scopes)
+
+        # Дельта кодируется один раз на каждую пару (кодировка, подписка) среди получателей
+        deltas = {}
+        for subscriber in self.recipients(departments):
+            if not subscriber.ready:
+                continue
+            key = (subscriber.encoding, subscriber.scope_key)
+            if subscriber.protocol == "delta":
+                if key not in deltas:
+                    delta = roster_log.since(revision - 1, subscriber.scope)
+                    deltas[key] = (delta, encode(delta, subscriber.encoding) if delta else None)
+                    if delta:
+                        metrics.PAYLOAD_BYTES.observe(payload_size(deltas[key][1]), kind="delta", encoding=subscriber.encoding)
+                delta, data = deltas[key]
+                if delta:
+                    subscriber.offer(delta["from_revision"], delta["revision"], data)
+                else:
+                    subscriber.offer(None, None, RESYNC)
+            elif key in snapshots:
+                # Снимок содержит всё состояние на момент ревизии, поэтому пропусков в нём не бывает
+                subscriber.offer(-1, revision, snapshots[key])
+            else:
+                subscriber.offer(None, None, RESYNC)
+
+
+class InProcessBackend:
+    # Шина внутри процесса: несколько хабов в одном процессе ведут себя как несколько воркеров
+    def __init__(self):
+        self._listeners = []
+
+    async def start(self, deliver):
+        self._listeners.append(deliver)
+
+    async def stop(self):
+        self._listeners.clear()
+
+    async def publish(self, message):
+        for deliver in list(self._listeners):
+            await deliver(message)
+
+
+class PostgresBackend:
+    # Уведомляет остальные воркеры через LISTEN/NOTIFY; передаются только идентификаторы записей
+    channel = "roster_changes"
+    max_payload = 7900  # NOTIFY принимает не более 8000 байт
+
+    def __init__(self, dsn=DATABASE_DIRECT_URL):
+        # LISTEN держит сессию, поэтому подключается напрямую к Postgres, а не через PgBouncer
+        self.dsn = make_url(dsn).set(drivername="postgresql").render_as_string(hide_password=False)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    async def start(self, deliver):
+        loop = asyncio.get_running_loop()
+
+        def dispatch(payload):
+            message = json.loads(payload)
+            loop.call_soon_threadsafe(lambda: loop.create_task(deliver(message)))
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._listen, args=(dispatch,), daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopped.set()
+
+    def _listen(self, dispatch):
+        import psycopg2
+        import psycopg2.extensions
+
+        reconnect = False
+        while not self._stopped.is_set():
+            try:
+                conn = psycopg2.connect(self.dsn)
+            except psycopg2.Error as e:
+                logger.warning("Не удалось подключиться для LISTEN: %s", e)
+                self._stopped.wait(1.0)
+                continue
+            try:
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel}")
+                if reconnect:
+                    # Пока соединения не было, уведомления могли потеряться
+                    dispatch(json.dumps({"origin": None, "full": True}))
+                reconnect = True
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        dispatch(conn.notifies.pop(0).payload)
+            except psycopg2.Error as e:
+                logger.warning("Соединение LISTEN потеряно: %s", e)
+            finally:
+                conn.close()
+
+    async def publish(self, message):
+        payload = json.dumps(message)
+        if len(payload.encode()) > self.max_payload:
+            payload = json.dumps({"origin": message["origin"], "full": True})
+        await run_db(self._notify, payload)
+
+    def _notify(self, payload):
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": self.channel, "payload": payload})
+
+
+def create_backend():
+    if HUB_BACKEND == "postgres":
+        return PostgresBackend()
+    return InProcessBackend()
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+import uuid
+
+# Сколько секунд помнить результат действия с ключом requestId и сколько ключей хранить не больше.
+# Повтор действия с тем же ключом (например, после переподключения клиента) в течение этого времени
+# не выполняется заново: отправитель получает сохранённый ответ
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "600"))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", "10000"))
+# Длина ключа ограничена, чтобы клиент не мог занять кэш длинными строками
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+
+# Действие с этим ключом ещё выполняется
+PENDING = object()
+
+
+class IdempotencyCache:
+    # Ответы на действия по ключу клиента в памяти воркера. Кэш не общий для воркеров uvicorn: повтор,
+    # попавший на другой воркер, выполнится заново. Завершённые записи хранятся в порядке добавления,
+    # поэтому устаревшие (TTL) и лишние (сверх IDEMPOTENCY_MAX_KEYS) удаляются с начала. Ключи выполняемых
+    # сейчас действий хранятся отдельно и не вытесняются: иначе повтор посреди выполнения выполнил бы его дважды
+    def __init__(self, ttl=IDEMPOTENCY_TTL_SECONDS, max_keys=IDEMPOTENCY_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.entries = OrderedDict()
+        self.pending = set()
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self.entries:
+            key, (expires, _) = next(iter(self.entries.items()))
+            if expires > now and len(self.entries) <= self.max_keys:
+                break
+            del self.entries[key]
+
+    def begin(self, key):
+        # Сохранённый ответ, PENDING (действие с этим ключом выполняется сейчас) или None —
+        # тогда ключ занимается до finish или discard
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            if key in self.pending:
+                self.hits += 1
+                return PENDING
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[1]
+            self.pending.add(key)
+            return None
+
+    def finish(self, key, reply):
+        # Действие зафиксировано: ответ хранится TTL секунд с этого момента
+        with self._lock:
+            self.pending.discard(key)
+            self.entries.pop(key, None)
+            self.entries[key] = (time.monotonic() + self.ttl, reply)
+            self._evict(time.monotonic())
+
+    def discard(self, key):
+        # Действие не выполнено (ошибка или откат): повтор выполнит его заново
+        with self._lock:
+            self.pending.discard(key)
+
+
+idempotency_cache = IdempotencyCache()
+
+
+def client_id(value):
+    # Идентификатор клиента из параметра client подключения /ws (постоянный для вкладки, переживает
+    # переподключения). Без него ключи действуют только в пределах одного подключения
+    if isinstance(value, str) and 0 < len(value) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        return value
+    return uuid.uuid4().hex
+
+
+def request_key(request_data: dict, client: str):
+    # Ключ кэша: requestId в пространстве клиента, чтобы одинаковые requestId разных клиентов не совпали
+    key = request_data.get("requestId")
+    if key is None:
+        return None
+    if not isinstance(key, str) or not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise ValueError(f"requestId must be a string of at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+    return (client, key)
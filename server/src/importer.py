@@ -0,0 +1,358 @@
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+from datetime import date
+import codecs
+import csv
+import json
+import os
+import tempfile
+import time
+
+from .database import SessionLocal, run_db
+from .models import Teachers, Students
+from .changes import mark_changed, pop_committed
+from .jobs import job_handler, enqueue, LeaseLost, JOB_MAX_ATTEMPTS
+from . import placement, photos
+from .log import get_logger
+
+logger = get_logger("importer")
+
+# Сколько строк размещается и записывается одной транзакцией
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "500"))
+
+# Сколько ошибок по строкам возвращается в отчёте (счётчик failed учитывает все)
+MAX_REPORTED_ERRORS = 100
+
+# Каталог файлов фонового импорта: тело запроса пишется туда, а в задании хранится только имя файла.
+# Задание может выполнить любой воркер, поэтому при нескольких контейнерах каталог должен быть общим
+IMPORT_SPOOL_DIR = os.environ.get("IMPORT_SPOOL_DIR", "imports")
+# Размер куска, которым файл читается при импорте
+IMPORT_READ_CHUNK = 64 * 1024
+
+
+async def read_lines(stream):
+    # Разбивает поток байтов на строки, не загружая тело запроса целиком
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in stream:
+        buffer += decoder.decode(chunk)
+        if "\n" not in buffer:
+            continue
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer.strip():
+        yield buffer.rstrip("\r")
+
+
+async def read_csv(stream):
+    # CSV с заголовком; запись может занимать несколько строк, если поле в кавычках содержит перевод строки
+    header = None
+    record, record_line, line_no = "", 0, 0
+    async for line in read_lines(stream):
+        line_no += 1
+        if not record:
+            if not line.strip():
+                continue
+            record, record_line = line, line_no
+        else:
+            record = f"{record}\n{line}"
+        if record.count('"') % 2:
+            continue
+
+        values = next(csv.reader([record]))
+        record = ""
+        if header is None:
+            header = [column.strip() for column in values]
+            continue
+        if len(values) != len(header):
+            yield record_line, f"expected {len(header)} columns, got {len(values)}"
+            continue
+        yield record_line, dict(zip(header, values))
+
+    if record:
+        yield record_line, "unterminated quoted field"
+
+
+async def read_jsonl(stream):
+    line_no = 0
+    async for line in read_lines(stream):
+        line_no += 1
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_no, f"invalid JSON: {e}"
+            continue
+        if not isinstance(data, dict):
+            yield line_no, "expected a JSON object"
+            continue
+        yield line_no, data
+
+
+def parse_row(data: dict):
+    name = str(data.get("name") or "").strip()
+    if not name:
+        raise ValueError("name is required")
+    if len(name) > 100:
+        raise ValueError("name is longer than 100 characters")
+
+    teacher_id = data.get("teacher_id")
+    if teacher_id in ("", None):
+        teacher_id = None
+    else:
+        try:
+            teacher_id = int(teacher_id)
+        except (TypeError, ValueError):
+            raise ValueError("teacher_id must be an integer")
+
+    department = str(data.get("department") or "").strip() or None
+    if department is None and teacher_id is None:
+        raise ValueError("department or teacher_id is required")
+
+    date_of_birth = data.get("date_of_birth") or data.get("dateOfBirth")
+    if date_of_birth:
+        try:
+            date_of_birth = date.fromisoformat(date_of_birth)
+        except (TypeError, ValueError):
+            raise ValueError("date_of_birth must be an ISO date (YYYY-MM-DD)")
+    else:
+        date_of_birth = None
+
+    return {
+        "name": name,
+        "department": department,
+        "teacher_id": teacher_id,
+        "photo": data.get("photo") or None,
+        "date_of_birth": date_of_birth,
+    }
+
+
+def import_batch(db: Session, rows: list, before_commit=None):
+    # rows — список (номер строки, разобранные данные). Размещает студентов по правилам enroll_student
+    # (кафедра преподавателя, 10 человек в группе) и вставляет их одним запросом на кафедру.
+    # Возвращает число добавленных студентов и ошибки по строкам; before_commit(imported, errors)
+    # вызывается перед фиксацией в той же транзакции
+    teacher_ids = {row["teacher_id"] for _, row in rows if row["teacher_id"] is not None}
+    teacher_departments = dict(
+        db.query(Teachers.id, Teachers.department).filter(Teachers.id.in_(teacher_ids)).all()
+    ) if teacher_ids else {}
+
+    errors = []
+    by_department = {}
+    for line_no, row in rows:
+        try:
+            row["photo"] = photos.photo_ref(row["photo"])
+        except photos.PhotoError as e:
+            errors.append((line_no, str(e)))
+            continue
+        if row["teacher_id"] is not None:
+            if row["teacher_id"] not in teacher_departments:
+                errors.append((line_no, "Teacher not found"))
+                continue
+            department = teacher_departments[row["teacher_id"]]
+        else:
+            department = row["department"]
+        by_department.setdefault(department, []).append((line_no, row))
+
+    imported = 0
+    for department, items in by_department.items():
+        try:
+            group_ids = placement.place_batch(db, department, len(items))
+        except ValueError as e:
+            errors.extend((line_no, str(e)) for line_no, _ in items)
+            continue
+
+        student_ids = db.scalars(insert(Students).returning(Students.id), [
+            {
+                "name": row["name"],
+                "department": row["department"] or department,
+                "group_id": group_id,
+                "photo": row["photo"],
+                "date_of_birth": row["date_of_birth"],
+            }
+            for (_, row), group_id in zip(items, group_ids)
+        ]).all()
+        mark_changed(db, students=student_ids)
+        imported += len(student_ids)
+
+    if before_commit is not None:
+        before_commit(imported, errors)
+    db.commit()
+    return imported, errors
+
+
+def add_error(summary, line_no, message):
+    summary["failed"] += 1
+    if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+        summary["errors"].append({"line": line_no, "error": message})
+
+
+def add_batch(summary, imported, errors):
+    summary["imported"] += imported
+    for line_no, message in errors:
+        add_error(summary, line_no, message)
+
+
+async def import_stream(stream, fmt: str, publish, job=None):
+    # Читает поток записей, копит пачки по IMPORT_BATCH_SIZE строк и записывает каждую пачку
+    # одной транзакцией; после каждой пачки изменения рассылаются через publish.
+    # job — фоновое задание (jobs.py): с каждой пачкой в той же транзакции сохраняются номер последней
+    # прочитанной строки и сводка, поэтому после сбоя импорт продолжается со следующей строки
+    started = time.perf_counter()
+    summary = {"total": 0, "imported": 0, "failed": 0, "errors": []}
+    skip = 0
+    if job is not None and job.checkpoint:
+        summary = job.checkpoint["summary"]
+        skip = job.checkpoint["line"]
+
+    db = SessionLocal()
+    batch = []
+    last_line = skip
+
+    def save_checkpoint(imported, errors):
+        state = {**summary, "errors": list(summary["errors"])}
+        add_batch(state, imported, errors)
+        job.checkpoint = {"line": last_line, "summary": state}
+        job.progress(last_line)
+        job.save(db)
+
+    async def flush():
+        if not batch:
+            return
+        try:
+            imported, errors = await run_db(import_batch, db, list(batch), save_checkpoint if job is not None else None)
+        except LeaseLost:
+            await run_db(db.rollback)
+            raise
+        except Exception as e:
+            logger.exception("Ошибка при импорте пачки: %s", e)
+            await run_db(db.rollback)
+            imported, errors = 0, [(line_no, "Database error") for line_no, _ in batch]
+        add_batch(summary, imported, errors)
+        batch.clear()
+        await publish(pop_committed(db))
+
+    reader = read_csv if fmt == "csv" else read_jsonl
+    try:
+        async for line_no, record in reader(stream):
+            if line_no <= skip:
+                # Строка обработана до сбоя: она уже учтена в сохранённой сводке
+                continue
+            last_line = line_no
+            summary["total"] += 1
+            if isinstance(record, str):
+                add_error(summary, line_no, record)
+                continue
+            try:
+                batch.append((line_no, parse_row(record)))
+            except ValueError as e:
+                add_error(summary, line_no, str(e))
+                continue
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await flush()
+        await flush()
+    finally:
+        await run_db(db.close)
+
+    summary["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return summary
+
+
+class ImportSpool:
+    # Пишет тело запроса фонового импорта в файл по мере поступления и считает строки (для прогресса)
+    def __init__(self):
+        os.makedirs(IMPORT_SPOOL_DIR, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=IMPORT_SPOOL_DIR, prefix="import-")
+        self.file = os.fdopen(fd, "wb")
+        self.lines = 0
+        self.ends_with_newline = True
+
+    def write(self, chunk: bytes):
+        if not chunk:
+            return
+        self.file.write(chunk)
+        self.lines += chunk.count(b"\n")
+        self.ends_with_newline = chunk.endswith(b"\n")
+
+    def finish(self):
+        self.file.close()
+        return os.path.basename(self.path), self.lines + (not self.ends_with_newline)
+
+    def abort(self):
+        self.file.close()
+        remove_spool(os.path.basename(self.path))
+
+
+def spool_path(name: str):
+    return os.path.join(IMPORT_SPOOL_DIR, os.path.basename(name))
+
+
+def remove_spool(name: str):
+    try:
+        os.unlink(spool_path(name))
+    except FileNotFoundError:
+        pass
+
+
+async def read_spool(name: str):
+    # Файл импорта кусками по IMPORT_READ_CHUNK: в памяти не больше одного куска
+    try:
+        file = await run_db(open, spool_path(name), "rb")
+    except FileNotFoundError:
+        raise ValueError("Import file not found")
+    try:
+        while True:
+            chunk = await run_db(file.read, IMPORT_READ_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        await run_db(file.close)
+
+
+def enqueue_import(db: Session, fmt: str, name: str, lines: int, key: str = None):
+    # Если импорт с тем же ключом уже поставлен, новый файл не нужен
+    job = enqueue(db, "import_students", {"format": fmt, "file": name, "lines": lines}, key=key)
+    if job.params.get("file") != name:
+        remove_spool(name)
+    return job
+
+
+async def import_payload(job):
+    payload = job.payload or b""
+
+    async def body():
+        yield payload
+
+    if job.total is None:
+        job.progress(job.done, payload.count(b"\n") + (not payload.endswith(b"\n")))
+    summary = await import_stream(body(), job.params.get("format", "jsonl"), job.runner.publish, job)
+    job.progress(job.total)
+    return summary
+
+
+@job_handler("import_students")
+async def import_job(job):
+    # Фоновый импорт: тело запроса читается из файла IMPORT_SPOOL_DIR, имя которого хранится в задании
+    name = job.params.get("file")
+    if name is None:
+        # Задание, поставленное до появления файлов импорта: тело хранится в самом задании
+        return await import_payload(job)
+    if job.total is None:
+        # Всего строк; прогресс — номер последней прочитанной строки
+        job.progress(job.done, job.params.get("lines"))
+    try:
+        summary = await import_stream(read_spool(name), job.params.get("format", "jsonl"), job.runner.publish, job)
+    except LeaseLost:
+        raise
+    except Exception as e:
+        # Файл больше не нужен, если задание не будет запущено снова
+        if isinstance(e, ValueError) or job.attempts >= JOB_MAX_ATTEMPTS:
+            await run_db(remove_spool, name)
+        raise
+    await run_db(remove_spool, name)
+    job.progress(job.total)
+    return summary
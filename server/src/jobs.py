@@ -0,0 +1,292 @@
+from sqlalchemy import select, update, or_, and_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+import asyncio
+import os
+import uuid
+
+from .database import SessionLocal, run_db
+from .models import Job
+from .changes import pop_committed
+from .log import get_logger
+
+# Сколько заданий одновременно выполняет один воркер uvicorn
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# Как часто свободный исполнитель проверяет очередь (задания этого воркера будят его сразу)
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "1"))
+# Аренда задания: если воркер упал и не продлил её, задание забирает другой
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "300"))
+# Сколько раз задание запускается заново после сбоев, прежде чем считается неудачным
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+ACTIVE = ("queued", "running")
+FINISHED = ("done", "failed")
+
+logger = get_logger("jobs")
+
+# Обработчики по виду задания: async-функции, принимающие JobContext и возвращающие результат
+HANDLERS = {}
+
+
+def job_handler(kind):
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+class LeaseLost(Exception):
+    # Аренду задания забрал другой воркер: текущая транзакция откатывается, задание продолжит он
+    pass
+
+
+def lease_until():
+    return datetime.now() + timedelta(seconds=JOB_LEASE_SECONDS)
+
+
+def job_info(job):
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": job.progress,
+        "total": job.total,
+        "result": job.result,
+        "error": job.error,
+        "attempts": job.attempts,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+    }
+
+
+def enqueue(db: Session, kind: str, params: dict = None, key: str = None, payload: bytes = None):
+    # Ставит задание в очередь в транзакции вызывающего (оно станет видно исполнителям вместе с ней).
+    # Если незавершённое задание с тем же key уже есть, возвращается оно
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    if key is not None:
+        existing = db.query(Job).filter(Job.key == key, Job.status.in_(ACTIVE)).first()
+        if existing is not None:
+            return existing
+    try:
+        with db.begin_nested():
+            job = Job(kind=kind, params=params or {}, key=key, payload=payload, status="queued")
+            db.add(job)
+    except IntegrityError:
+        # Параллельный запрос успел поставить такое же задание
+        return db.query(Job).filter(Job.key == key, Job.status.in_(ACTIVE)).one()
+    return job
+
+
+def get_job(db: Session, job_id: int):
+    job = db.query(Job).filter(Job.id == job_id).first()
+    return job_info(job) if job is not None else None
+
+
+def load_job(job_id: int):
+    with SessionLocal() as db:
+        return get_job(db, job_id)
+
+
+def claim(worker_id: str):
+    # Забирает первое задание из очереди или задание с истёкшей арендой (его воркер упал).
+    # Задания, которые прямо сейчас забирают другие воркеры, пропускаются (SKIP LOCKED)
+    now = datetime.now()
+    with SessionLocal() as db:
+        candidate = (
+            select(Job.id)
+            .where(or_(Job.status == "queued", and_(Job.status == "running", Job.locked_until < now)))
+            .order_by(Job.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        job_id = db.execute(
+            update(Job)
+            .where(Job.id == candidate)
+            .values(status="running", locked_by=worker_id, locked_until=lease_until(), attempts=Job.attempts + 1)
+            .returning(Job.id)
+            .execution_options(synchronize_session=False)
+        ).scalar()
+        db.commit()
+        if job_id is None:
+            return None
+        return db.query(Job).filter(Job.id == job_id).one()
+
+
+def finish(job_id: int, worker_id: str, status: str, result=None, error: str = None, progress: int = None, total: int = None):
+    # Итог задания, которое не завершило себя в своей транзакции; None — аренду уже забрал другой воркер
+    with SessionLocal() as db:
+        values = {"status": status, "result": result, "error": error, "locked_by": None, "locked_until": None}
+        if status == "queued":
+            values.pop("result")
+        if progress is not None:
+            values.update(progress=progress, total=total)
+        updated = db.execute(
+            update(Job).where(Job.id == job_id, Job.locked_by == worker_id).values(**values)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        return get_job(db, job_id) if updated else None
+
+
+def release(worker_id: str):
+    with SessionLocal() as db:
+        db.execute(
+            update(Job).where(Job.locked_by == worker_id, Job.status == "running")
+            .values(status="queued", locked_by=None, locked_until=None)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+
+
+class JobContext:
+    # Выполняемое задание: параметры, сохранённое состояние и сессия БД обработчика
+    def __init__(self, runner, job):
+        self.runner = runner
+        self.id = job.id
+        self.kind = job.kind
+        self.params = job.params or {}
+        self.payload = job.payload
+        self.checkpoint = job.checkpoint
+        self.attempts = job.attempts
+        self.done = job.progress
+        self.total = job.total
+        self.finished = None
+        self.db = SessionLocal()
+
+    def info(self, status="running", result=None, error=None):
+        return {
+            "id": self.id, "kind": self.kind, "status": status, "progress": self.done, "total": self.total,
+            "result": result, "error": error, "attempts": self.attempts,
+        }
+
+    def progress(self, done, total=None):
+        # Прогресс для клиентов; в БД он попадает вместе со следующим save. Можно вызывать из потока пула БД
+        self.done = done
+        if total is not None:
+            self.total = total
+        self.runner.notify(self.info())
+
+    def save(self, db: Session, result=None, status="running"):
+        # Записывает прогресс и checkpoint (состояние для продолжения) в транзакции обработчика — вместе
+        # с самой работой — и продлевает аренду. Если задание уже забрал другой воркер, бросает LeaseLost
+        values = {"progress": self.done, "total": self.total, "checkpoint": self.checkpoint, "locked_until": lease_until()}
+        if status != "running":
+            values.update(status=status, result=result, locked_by=None, locked_until=None)
+        updated = db.execute(
+            update(Job)
+            .where(Job.id == self.id, Job.locked_by == self.runner.id, Job.status == "running")
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not updated:
+            raise LeaseLost()
+        if status != "running":
+            self.finished = self.info(status, result)
+
+    async def commit(self, fn, *args, finish=False):
+        # Выполняет fn(db, *args) одной транзакцией вместе с записью прогресса; с finish=True результат fn
+        # фиксируется как итог задания в той же транзакции, поэтому после сбоя задание не выполнится дважды
+        def work():
+            result = fn(self.db, *args)
+            self.save(self.db, result=result, status="done" if finish else "running")
+            self.db.commit()
+            return result
+
+        try:
+            return await run_db(work)
+        except BaseException:
+            await run_db(self.db.rollback)
+            raise
+        finally:
+            await self.runner.publish(pop_committed(self.db))
+
+
+class JobRunner:
+    # Исполнители заданий внутри воркера uvicorn. Очередь — таблица jobs, поэтому задания, поставленные
+    # любым воркером, выполняет первый свободный исполнитель, а после падения воркера — другой
+    def __init__(self, publish, notify, workers=JOB_WORKERS):
+        self.id = uuid.uuid4().hex
+        self.publish = publish
+        self.notify_async = notify
+        self.workers = workers
+        self._wake = None
+        self._loop = None
+        self._tasks = []
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Незавершённые задания сразу возвращаются в очередь, не дожидаясь конца аренды
+        await run_db(release, self.id)
+
+    def wake(self):
+        # В очереди появилось задание: свободные исполнители проверят её сразу
+        if self._wake is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def notify(self, info):
+        # Событие задания для подписчиков /ws; вызывается и из потоков пула БД
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(lambda: self._loop.create_task(self.notify_async(info)))
+
+    async def _work(self):
+        while True:
+            try:
+                job = await run_db(claim, self.id)
+            except Exception:
+                logger.exception("Не удалось получить задание из очереди")
+                job = None
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job):
+        context = JobContext(self, job)
+        try:
+            if context.attempts > JOB_MAX_ATTEMPTS:
+                # Задание уже несколько раз обрывалось вместе с воркером
+                info = await run_db(finish, context.id, self.id, "failed", error="Too many attempts")
+            else:
+                logger.info("Задание %s (%s) запущено, попытка %s", context.id, context.kind, context.attempts)
+                self.notify(context.info())
+                info = await self._execute(context)
+        finally:
+            await run_db(context.db.close)
+        if info is not None:
+            logger.info("Задание %s (%s): %s", info["id"], info["kind"], info["status"])
+            self.notify(info)
+
+    async def _execute(self, context):
+        try:
+            result = await HANDLERS[context.kind](context)
+        except LeaseLost:
+            logger.warning("Задание %s забрал другой воркер", context.id)
+            return None
+        except ValueError as e:
+            # Ошибка в данных: повтор не поможет
+            return await run_db(finish, context.id, self.id, "failed", error=str(e))
+        except asyncio.CancelledError:
+            # Воркер останавливается: задание вернётся в очередь по истечении аренды
+            raise
+        except Exception:
+            logger.exception("Ошибка при выполнении задания %s", context.id)
+            status = "queued" if context.attempts < JOB_MAX_ATTEMPTS else "failed"
+            return await run_db(finish, context.id, self.id, status, error="Internal error")
+        if context.finished is not None:
+            return context.finished
+        return await run_db(finish, context.id, self.id, "done", result, progress=context.done, total=context.total)
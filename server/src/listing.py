@@ -0,0 +1,156 @@
+from sqlalchemy import select, or_, and_, tuple_
+from sqlalchemy.orm import Session
+from datetime import date
+import base64
+import json
+
+from .models import Students, Group
+
+# Размер страницы по умолчанию и максимальный
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Поля, которые можно запросить через fields; photo в списках обычно не нужен
+STUDENT_FIELDS = {
+    "id": Students.id,
+    "uuid": Students.uuid,
+    "name": Students.name,
+    "department": Students.department,
+    "group_id": Students.group_id,
+    "group_name": Group.name.label("group_name"),
+    "photo": Students.photo,
+    "date_of_birth": Students.date_of_birth,
+    "created_at": Students.created_at,
+}
+
+# Допустимые ключи сортировки; при равенстве значений порядок задаёт id
+STUDENT_SORTS = {
+    "id": Students.id,
+    "name": Students.name,
+    "department": Students.department,
+    "group": Group.name,
+    "date_of_birth": Students.date_of_birth,
+}
+
+
+def encode_cursor(sort: str, value, last_id: int):
+    if isinstance(value, date):
+        value = value.isoformat()
+    raw = json.dumps([sort, value, last_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, last_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort or not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise ValueError("Cursor does not match the sort order")
+    # Значение сортировки попадает в сравнение с ключом в SQL: у id это число, у остальных ключей
+    # (в том числе дат в формате ISO) — строка, у строк с NULL в этом столбце — None
+    expected = int if sort == "id" else str
+    if value is not None and (isinstance(value, bool) or not isinstance(value, expected)):
+        raise ValueError("Invalid cursor")
+    if sort == "date_of_birth" and value is not None:
+        value = date.fromisoformat(value)
+    return value, last_id
+
+
+def parse_fields(fields: str):
+    if not fields:
+        return list(STUDENT_FIELDS)
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in STUDENT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    # id нужен для курсора, поэтому возвращается всегда
+    return ["id"] + [name for name in names if name != "id"]
+
+
+def after_cursor(column, value, last_id, descending):
+    # Условие «строго после (value, last_id)» в порядке column [DESC] NULLS LAST, id [DESC].
+    # Сравнение кортежей Postgres выполняет по составному индексу; строки с NULL идут в конце
+    if column is Students.id:
+        return Students.id < last_id if descending else Students.id > last_id
+    if value is None:
+        return and_(column.is_(None), Students.id < last_id if descending else Students.id > last_id)
+    key = tuple_(column, Students.id)
+    after = key < tuple_(value, last_id) if descending else key > tuple_(value, last_id)
+    if column is Students.name:
+        return after
+    return or_(after, column.is_(None))
+
+
+def list_students(
+    db: Session,
+    fields: str = None,
+    sort: str = "id",
+    order: str = "asc",
+    cursor: str = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    name: str = None,
+    department: str = None,
+    group_id: int = None,
+    group: str = None,
+    born_after: date = None,
+    born_before: date = None,
+):
+    # Страница списка студентов с пагинацией по курсору: следующая страница продолжает выборку
+    # с последней строки предыдущей, поэтому её стоимость не зависит от номера страницы (в отличие от OFFSET)
+    if sort not in STUDENT_SORTS:
+        raise ValueError(f"Unknown sort key: {sort}")
+    if order not in ("asc", "desc"):
+        raise ValueError("order must be asc or desc")
+    names = parse_fields(fields)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    descending = order == "desc"
+    column = STUDENT_SORTS[sort]
+    sort_field = "group_name" if sort == "group" else sort
+
+    # Выбираются только запрошенные столбцы; группа присоединяется, только если она нужна
+    query = select(*[STUDENT_FIELDS[name] for name in names])
+    if sort_field not in names:
+        query = query.add_columns(column.label("_sort"))
+    if "group_name" in names or sort == "group" or group:
+        query = query.outerjoin(Group, Students.group_id == Group.id)
+
+    if name:
+        query = query.where(Students.name.ilike(f"%{name}%"))
+    if department:
+        query = query.where(Students.department == department)
+    if group_id:
+        query = query.where(Students.group_id == group_id)
+    if group:
+        query = query.where(Group.name == group)
+    if born_after:
+        query = query.where(Students.date_of_birth >= born_after)
+    if born_before:
+        query = query.where(Students.date_of_birth <= born_before)
+
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort)
+        query = query.where(after_cursor(column, value, last_id, descending))
+
+    if column is Students.id:
+        query = query.order_by(Students.id.desc() if descending else Students.id)
+    else:
+        query = query.order_by(
+            (column.desc() if descending else column.asc()).nulls_last(),
+            Students.id.desc() if descending else Students.id,
+        )
+
+    # Лишняя строка показывает, есть ли следующая страница
+    rows = db.execute(query.limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]._mapping
+        value = last[sort_field] if sort_field in names else last["_sort"]
+        next_cursor = encode_cursor(sort, value, last["id"])
+
+    return {
+        "items": [{field: row._mapping[field] for field in names} for row in rows],
+        "next_cursor": next_cursor,
+    }
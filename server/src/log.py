@@ -0,0 +1,66 @@
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import json
+import logging
+import os
+import queue
+
+# Уровень и формат журнала: LOG_LEVEL=DEBUG|INFO|WARNING|ERROR, LOG_FORMAT=text|json
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+
+# Поля LogRecord, которые не относятся к переданным через extra
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    # Одна запись — одна строка JSON; поля из extra= попадают в неё как есть
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_FIELDS)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    # Обработчики пишут в очередь, а в поток вывода — отдельный поток QueueListener,
+    # поэтому запись в журнал не блокирует цикл событий и потоки пула БД
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    records = queue.SimpleQueue()
+    logger = logging.getLogger("roster")
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(QueueHandler(records))
+    logger.propagate = False
+
+    _listener = QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    # Дописывает накопившиеся записи
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name: str):
+    return logging.getLogger(f"roster.{name}")
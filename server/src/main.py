@@ -1,17 +1,133 @@
-from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, Request as HttpRequest
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, Response, PlainTextResponse, JSONResponse
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
-from .database import engine, SessionLocal, Base
-from .models import Teachers, Students, Group, Request, Stage
+from .database import engine, SessionLocal, run_db, pool_stats
+from .models import Teachers, Students, Group
+from .changes import mark_changed, pop_committed
+from .roster import roster_log, roster_snapshot, snapshot_cache, negotiate_encoding, resolve_scope
+from .hub import Hub, create_backend
+from .capacity import GROUP_CAPACITY, CAPACITY_RECONCILE_SECONDS, capacity_cache, mark_groups
+from . import placement, importer, photos, listing, metrics, jobs, workflow, search, patches, archive
+from .idempotency import idempotency_cache, request_key, client_id, PENDING
+from .log import setup_logging, get_logger
 from pydantic import BaseModel
-from datetime import date
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+import asyncio
 import json
 import os
+import time
 
 # Удаляем старые таблицы с использованием CASCADE
 # Base.metadata.drop_all(bind=engine)
-Base.metadata.create_all(bind=engine)
-
-app = FastAPI()
+# Схема создаётся до запуска сервера: python -m src.migrate
+
+setup_logging()
+logger = get_logger("main")
+metrics.instrument_engine(engine)
+
+# Реестр подключений /ws: изменения одного клиента рассылаются всем
+hub = Hub(create_backend())
+
+# Исполнители фоновых заданий (увольнение с переводом студентов, импорт, слияние кафедр)
+job_runner = jobs.JobRunner(hub.publish, hub.job_event)
+
+# Действия /ws, для которых ведутся отдельные метрики
+WS_ACTIONS = {"create", "fire", "update", "merge", "job", "ping"}
+
+# Сколько студентов переводится одной транзакцией при слиянии кафедр
+MERGE_BATCH_SIZE = int(os.environ.get("MERGE_BATCH_SIZE", "500"))
+
+# Окно сбора сообщений /ws в один пакет (0 — каждое сообщение обрабатывается сразу)
+# и предельное число сообщений в окне или действий в одном сообщении-массиве
+WS_BATCH_WINDOW_MS = int(os.environ.get("WS_BATCH_WINDOW_MS", "0"))
+WS_BATCH_MAX = int(os.environ.get("WS_BATCH_MAX", "100"))
+
+# Метрики, значения которых снимаются в момент опроса /metrics
+metrics.Gauge("roster_ws_connections", "Активные подключения /ws", callback=lambda: len(hub.subscribers))
+metrics.Gauge(
+    "roster_ws_send_queue_depth", "Сообщений в очередях отправки: всего и в самой длинной очереди", ["stat"],
+    callback=lambda: {
+        ("total",): sum(s.queue.qsize() for s in hub.subscribers),
+        ("max",): max((s.queue.qsize() for s in hub.subscribers), default=0),
+    },
+)
+metrics.Gauge(
+    "roster_db_pool_connections", "Соединения пула БД по состоянию", ["state"],
+    callback=lambda: {(state,): pool_stats().get(state) for state in ("checked_out", "idle", "overflow", "waiting")},
+)
+metrics.Counter("roster_db_pool_checkouts_total", "Выдачи соединений из пула", callback=lambda: pool_stats().get("checkouts"))
+metrics.Counter(
+    "roster_db_pool_wait_seconds_total", "Суммарное время ожидания соединения из пула",
+    callback=lambda: pool_stats().get("wait_seconds_total"),
+)
+metrics.Counter("roster_db_pool_timeouts_total", "Таймауты ожидания соединения из пула", callback=lambda: pool_stats().get("timeouts"))
+metrics.Counter(
+    "roster_snapshot_cache_requests_total", "Обращения к кэшу снимка состава", ["result"],
+    callback=lambda: {("hit",): snapshot_cache.hits, ("miss",): snapshot_cache.misses},
+)
+
+metrics.Counter(
+    "roster_capacity_cache_requests_total",
+    "Обращения к кэшу вместимости: попадания, промахи и подсказки, не подтверждённые БД", ["result"],
+    callback=lambda: {
+        ("hit",): capacity_cache.hits, ("miss",): capacity_cache.misses, ("rejected",): capacity_cache.rejections,
+    },
+)
+metrics.Counter(
+    "roster_capacity_cache_drift_total", "Записи кэша вместимости, исправленные при сверке с БД",
+    callback=lambda: capacity_cache.drift,
+)
+
+metrics.Counter(
+    "roster_ws_duplicate_actions_total", "Повторы действий /ws с уже известным requestId (не выполнялись заново)",
+    callback=lambda: idempotency_cache.hits,
+)
+
+async def reconcile_capacity():
+    # Периодическая сверка кэша вместимости с БД
+    while True:
+        await asyncio.sleep(CAPACITY_RECONCILE_SECONDS)
+        try:
+            await run_db(capacity_cache.reconcile)
+        except Exception:
+            logger.exception("Ошибка сверки кэша вместимости")
+
+async def schedule_compaction():
+    # Плановый перенос истории в архив (задание compact_archive)
+    while True:
+        await asyncio.sleep(archive.ARCHIVE_COMPACT_SECONDS)
+        try:
+            await run_db(submit_job, archive.enqueue_compaction, True)
+        except Exception:
+            logger.exception("Ошибка постановки задания compact_archive")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await hub.start()
+    await run_db(capacity_cache.warm)
+    reconciler = asyncio.create_task(reconcile_capacity()) if CAPACITY_RECONCILE_SECONDS > 0 else None
+    compactor = asyncio.create_task(schedule_compaction()) if archive.ARCHIVE_COMPACT_SECONDS > 0 else None
+    await job_runner.start()
+    yield
+    await job_runner.stop()
+    if reconciler is not None:
+        reconciler.cancel()
+    if compactor is not None:
+        compactor.cancel()
+    await hub.stop()
+
+app = FastAPI(lifespan=lifespan)
+
+# Клиент загружает фото напрямую через HTTP, поэтому ему нужен CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=os.environ.get("CORS_ORIGINS", "*").split(","),
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 # Модель для создания группы
 class GroupCreate(BaseModel):
@@ -29,18 +145,30 @@ def get_db():
     finally:
         db.close()
 
-# Вспомогательные функции
+async def run_write(fn, *args):
+    # Запись из HTTP-запроса: fn(db, *args) выполняется в пуле потоков БД и сама фиксирует транзакцию.
+    # Зафиксированные изменения, как у /ws и импорта, попадают в журнал ревизий (кэш /roster,
+    # дельты после переподключения) и рассылаются клиентам /ws
+    db = SessionLocal()
+    try:
+        return await run_db(fn, db, *args)
+    finally:
+        await hub.publish(pop_committed(db))
+        await run_db(db.close)
+
+# Вспомогательные функции только записывают изменения в текущую транзакцию (flush);
+# фиксирует её вызывающий код, поэтому несколько действий можно выполнить одной транзакцией
 def create_group(db: Session, teacher_id: int):
-    group_name = f"Group {teacher_id}-{db.query(Group).filter(Group.teacher_id == teacher_id).count() + 1}"
-    new_group = Group(name=group_name, teacher_id=teacher_id)
-    db.add(new_group)
-    db.commit()
-    db.refresh(new_group)
-    return new_group
+    return placement.new_group(db, teacher_id)
 
 def is_group_full(db: Session, group_id: int):
-    return db.query(Students).filter(Students.group_id == group_id).count() >= 10
+    student_count = capacity_cache.group_count(group_id)
+    if student_count is None:
+        group = db.query(Group).filter(Group.id == group_id).first()
+        student_count = group.student_count if group is not None else None
+    return student_count is not None and student_count >= GROUP_CAPACITY
 
+@metrics.ENROLL_SECONDS.time()
 def enroll_student(db: Session, student_data: dict):
     teacher_id = student_data.get("teacher_id")
     if not teacher_id:
@@ -51,127 +179,115 @@ def enroll_student(db: Session, student_data: dict):
     if not teacher:
         raise ValueError("Teacher not found")
 
-    # Находим всех преподавателей на той же кафедре
-    department_teachers = db.query(Teachers).filter(
-        Teachers.department == teacher.department
-    ).all()
-
-    # Ищем все группы на кафедре с менее чем 10 студентами
-    groups_with_space = []
-    for group in db.query(Group).join(Teachers).filter(
-        Teachers.department == teacher.department
-    ).all():
-        student_count = db.query(Students).filter(Students.group_id == group.id).count()
-        if student_count < 10:
-            groups_with_space.append(group)
-
-    # Если есть группы с незаполненными местами, добавляем студента в первую такую группу
-    if groups_with_space:
-        group = groups_with_space[0]  # Берём первую группу с незаполненными местами
-        new_student = Students(
-            name=student_data.get("name"),
-            department=student_data.get("department"),
-            group_id=group.id,
-            photo=student_data.get("photo"),
-            date_of_birth=student_data.get("date_of_birth"),
-        )
-        db.add(new_student)
-        db.commit()
-        db.refresh(new_student)
-        return new_student
-
-    # Если все группы заполнены, создаем новую группу
-    # Выбираем преподавателя с наименьшим количеством групп
-    teacher_with_min_groups = min(
-        department_teachers,
-        key=lambda t: db.query(Group).filter(Group.teacher_id == t.id).count()
-    )
-
-    # Создаем новую группу для выбранного преподавателя
-    new_group = create_group(db, teacher_with_min_groups.id)
+    # Место в первой группе кафедры со свободными местами или в новой группе
+    # у преподавателя с наименьшим количеством групп
+    group_id = placement.place_student(db, teacher.department)
 
-    # Создаем студента и привязываем его к новой группе
     new_student = Students(
         name=student_data.get("name"),
         department=student_data.get("department"),
-        group_id=new_group.id,
-        photo=student_data.get("photo"),
+        group_id=group_id,
+        photo=photos.photo_ref(student_data.get("photo")),
         date_of_birth=student_data.get("date_of_birth"),
     )
     db.add(new_student)
-    db.commit()
-    db.refresh(new_student)
+    db.flush()
     return new_student
 
 
 def expel_student(db: Session, student_id: int):
-    student = db.query(Students).filter(Students.id == student_id).first()
-    if not student:
-        raise ValueError("Student not found")
-
-    group_id = student.group_id
-    db.delete(student)
-    db.commit()
-
-    # Удаляем группу, если она пуста
-    if db.query(Students).filter(Students.group_id == group_id).count() == 0:
-        db.query(Group).filter(Group.id == group_id).delete()
-        db.commit()
-
-def redistribute_students(db: Session, teacher_id: int):
-    # Находим уволенного преподавателя
-    teacher = db.query(Teachers).filter(Teachers.id == teacher_id).first()
+    # Мягкое удаление: студент остаётся в истории, пока compact_archive не перенесёт его в архив
+    result = archive.expel_student(db, student_id)
+    if result["group_closed"]:
+        logger.info("Группа с ID %s закрыта, так как в ней больше нет студентов", result["group_id"])
+    return result
+
+@metrics.REDISTRIBUTE_SECONDS.time()
+def redistribute_students(db: Session, teacher_id: int, dry_run: bool = False, progress=None):
+    # План строится по заблокированным группам кафедры и применяется несколькими массовыми запросами
+    # в текущей транзакции; фиксирует её вызывающий код (вместе с удалением преподавателя).
+    # В режиме dry_run база не меняется, возвращается только план
+    plan = placement.plan_redistribution(db, teacher_id, lock=not dry_run)
+    if not dry_run:
+        placement.apply_redistribution(db, plan, progress)
+    return plan
+
+def dismissal_error(db: Session, teacher: Teachers):
+    # Причина, по которой преподавателя нельзя уволить, или None
+    students_in_department = db.query(Students).filter(Students.department == teacher.department).count()
+    teachers_in_department = db.query(Teachers).filter(Teachers.department == teacher.department).count()
+    if students_in_department > 0 and teachers_in_department <= 1:
+        return 'Нельзя уволить последнего преподавателя на кафедре, пока там есть студенты.'
+    return None
+
+def dismiss_teacher(db: Session, job: jobs.JobContext):
+    # Увольнение с переводом студентов одной транзакцией (фоновое задание dismiss_teacher)
+    teacher_id = job.params["teacher_id"]
+    teacher = db.query(Teachers).filter(Teachers.id == teacher_id).with_for_update().first()
     if not teacher:
-        raise ValueError("Teacher not found")
-
-    # Находим всех преподавателей той же кафедры
-    department_teachers = db.query(Teachers).filter(
-        Teachers.department == teacher.department,
-        Teachers.id != teacher_id  # Исключаем уволенного преподавателя
+        # Преподаватель уже удалён, например, другим заданием
+        return {"teacher_id": teacher_id, "moved": 0}
+
+    # Пока задание ждало в очереди, состав кафедры мог измениться
+    error = dismissal_error(db, teacher)
+    if error:
+        raise ValueError(error)
+
+    # Отчисленные студенты его групп и закрытые группы уходят в архив до удаления групп каскадом
+    archive.archive_teacher(db, teacher.id)
+    moved = 0
+    if db.query(Students).filter(Students.department == teacher.department).count() > 0:
+        plan = redistribute_students(db, teacher.id, progress=job.progress)
+        moved = len(plan["moves"])
+    workflow.detach_teacher(db, teacher.id)
+    db.delete(teacher)
+    db.flush()
+    logger.info("Преподаватель с ID %s удалён из базы данных", teacher_id)
+    return {"teacher_id": teacher_id, "moved": moved}
+
+@jobs.job_handler("dismiss_teacher")
+async def dismiss_teacher_job(job: jobs.JobContext):
+    # Работа и отметка о завершении фиксируются вместе: после сбоя воркера задание выполнится заново целиком
+    return await job.commit(dismiss_teacher, job, finish=True)
+
+def merge_teachers(db: Session, job: jobs.JobContext, source: str, target: str):
+    # Преподаватели (а с ними их группы) переходят на кафедру target одним запросом
+    teacher_ids = db.scalars(
+        update(Teachers).where(Teachers.department == source).values(department=target, version=Teachers.version + 1)
+        .returning(Teachers.id).execution_options(synchronize_session=False)
     ).all()
-
-    if not department_teachers:
-        raise ValueError("No other teachers in the department")
-
-    # Находим все группы уволенного преподавателя
-    groups = db.query(Group).filter(Group.teacher_id == teacher_id).all()
-
-    # Собираем всех студентов из групп уволенного преподавателя
-    students_to_redistribute = []
-    for group in groups:
-        students_in_group = db.query(Students).filter(Students.group_id == group.id).all()
-        students_to_redistribute.extend(students_in_group)
-
-    # Распределяем студентов поровну между преподавателями
-    teacher_index = 0
-    for student in students_to_redistribute:
-        # Находим группы текущего преподавателя
-        current_teacher = department_teachers[teacher_index]
-        teacher_groups = db.query(Group).filter(Group.teacher_id == current_teacher.id).all()
-
-        # Ищем группу с свободными местами
-        placed = False
-        for group in teacher_groups:
-            if db.query(Students).filter(Students.group_id == group.id).count() < 10:
-                # Если в группе есть свободное место, перемещаем студента
-                student.group_id = group.id
-                db.commit()
-                placed = True
-                break
-
-        # Если свободных мест в группах текущего преподавателя нет, создаем новую группу
-        if not placed:
-            new_group = create_group(db, current_teacher.id)
-            student.group_id = new_group.id
-            db.commit()
-
-        # Переходим к следующему преподавателю
-        teacher_index = (teacher_index + 1) % len(department_teachers)
-
-    # Удаляем группы уволенного преподавателя
-    for group in groups:
-        db.delete(group)
-    db.commit()
+    mark_changed(db, teachers=teacher_ids, departments={source, target})
+    mark_groups(db, stale_departments={source, target})
+    job.checkpoint = {"teachers": (job.checkpoint or {}).get("teachers", 0) + len(teacher_ids)}
+    return len(teacher_ids)
+
+def merge_students(db: Session, job: jobs.JobContext, source: str, target: str):
+    # Следующая пачка студентов кафедры source; повтор после сбоя просто продолжает с оставшихся
+    batch = select(Students.id).where(Students.department == source).order_by(Students.id).limit(MERGE_BATCH_SIZE)
+    student_ids = db.scalars(
+        update(Students).where(Students.id.in_(batch)).values(department=target, version=Students.version + 1)
+        .returning(Students.id).execution_options(synchronize_session=False)
+    ).all()
+    mark_changed(db, students=student_ids, departments={source, target})
+    if student_ids:
+        job.progress(job.done + len(student_ids))
+    return len(student_ids)
+
+@jobs.job_handler("merge_departments")
+async def merge_departments_job(job: jobs.JobContext):
+    # Слияние кафедры source с target: преподаватели одной транзакцией, студенты — пачками
+    source, target = job.params.get("source"), job.params.get("target")
+    remaining = await run_db(lambda: job.db.query(Students).filter(Students.department == source).count())
+    job.progress(job.done, job.done + remaining)
+    await job.commit(merge_teachers, job, source, target)
+    while await job.commit(merge_students, job, source, target):
+        pass
+    return {"source": source, "target": target, "teachers": job.checkpoint["teachers"], "students": job.done}
+
+def enqueue_merge(db: Session, source, target):
+    if not source or not target or source == target:
+        raise ValueError("Source and target departments are required and must differ")
+    return jobs.enqueue(db, "merge_departments", {"source": source, "target": target}, key=f"merge_departments:{source}")
 
 # @app.delete("/teachers/{teacher_id}")
 # def delete_teacher(teacher_id: int, db: Session = Depends(get_db)):
@@ -188,14 +304,25 @@ def redistribute_students(db: Session, teacher_id: int):
 #     return {"message": "Teacher deleted"}
 
 # Маршруты
+@app.get("/teachers/{teacher_id}/redistribution-plan")
+def preview_redistribution(teacher_id: int, db: Session = Depends(get_db)):
+    # Предпросмотр перевода студентов при увольнении преподавателя (без изменений в БД)
+    try:
+        return redistribute_students(db, teacher_id, dry_run=True)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post("/groups/")
-def create_group_endpoint(group: GroupCreate, db: Session = Depends(get_db)):
+async def create_group_endpoint(group: GroupCreate):
+    return await run_write(add_group, group)
+
+def add_group(db: Session, group: GroupCreate):
     teacher = db.query(Teachers).filter(Teachers.id == group.teacher_id).first()
     if not teacher:
         raise HTTPException(status_code=404, detail="Teacher not found")
 
     if not group.name:
-        group_name = f"Group {group.teacher_id}-{db.query(Group).filter(Group.teacher_id == group.teacher_id).count() + 1}"
+        group_name = placement.group_name(db, group.teacher_id)
     else:
         group_name = group.name
 
@@ -206,210 +333,639 @@ def create_group_endpoint(group: GroupCreate, db: Session = Depends(get_db)):
     return new_group
 
 @app.post("/students/")
-def create_student(student_data: dict, db: Session = Depends(get_db)):
+async def create_student(student_data: dict):
+    try:
+        return await run_write(add_student, student_data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def add_student(db: Session, student_data: dict):
+    new_student = enroll_student(db, student_data)
+    db.commit()
+    db.refresh(new_student)
+    return new_student
+
+@app.post("/students/import")
+async def import_students(request: HttpRequest, format: str = None, background: bool = False):
+    # Потоковый импорт студентов: CSV с заголовком (name,department,date_of_birth,teacher_id,photo)
+    # или JSONL (по объекту на строку). Тело разбирается по мере поступления и записывается пачками.
+    # С background=true тело сохраняется в файл и импортируется в фоне заданием; ответ — задание (202)
+    content_type = request.headers.get("content-type", "")
+    format = format or ("csv" if "csv" in content_type else "jsonl")
+    if format not in ("csv", "jsonl"):
+        raise HTTPException(status_code=400, detail="Unsupported format, use csv or jsonl")
+    if not background:
+        return await importer.import_stream(request.stream(), format, hub.publish)
+
+    # Тело пишется в файл по мере поступления (как при загрузке фото), задание хранит только имя файла
+    spool = await run_db(importer.ImportSpool)
+    try:
+        async for chunk in request.stream():
+            await run_db(spool.write, chunk)
+        name, lines = await run_db(spool.finish)
+    except BaseException:
+        await run_db(spool.abort)
+        raise
+    key = request.headers.get("idempotency-key")
+    job = await run_db(submit_job, importer.enqueue_import, format, name, lines, f"import_students:{key}" if key else None)
+    return JSONResponse(status_code=202, content=job)
+
+def submit_job(enqueue, *args):
+    # Постановка задания отдельной транзакцией (для HTTP-запросов); свободные исполнители будятся сразу
+    with SessionLocal() as db:
+        job = enqueue(db, *args)
+        db.commit()
+        # None — постановка не понадобилась (плановое задание уже ставилось)
+        info = jobs.job_info(job) if job is not None else None
+    job_runner.wake()
+    return info
+
+class DepartmentMerge(BaseModel):
+    source: str
+    target: str
+
+@app.post("/departments/merge", status_code=202)
+async def merge_departments(merge: DepartmentMerge):
+    # Слияние кафедры source с target фоновым заданием; ход выполнения — GET /jobs/{id} или события /ws
+    try:
+        return await run_db(submit_job, enqueue_merge, merge.source, merge.target)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/jobs/{job_id}")
+def read_job(job_id: int, db: Session = Depends(get_db)):
+    job = jobs.get_job(db, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+class RequestCreate(BaseModel):
+    teacher_id: int = None
+    student_id: int = None
+    stage: str = None
+
+class RequestTransition(BaseModel):
+    ids: list[int]
+    stage: str = None
+    status: str = None
+
+class StageTransition(BaseModel):
+    stage: str = None
+    status: str = None
+
+@app.post("/requests/")
+async def create_requests(items: list[RequestCreate]):
+    # Создание пачки заявок (каждая начинается с этапа stage, по умолчанию new)
+    try:
+        return await run_write(add_requests, [item.dict() for item in items])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def add_requests(db: Session, items: list):
+    created = workflow.create_requests(db, items)
+    db.commit()
+    return created
+
+@app.get("/requests/")
+def read_requests(
+    status: str = None,
+    teacher_id: int = None,
+    student_id: int = None,
+    stage: str = None,
+    order: str = "desc",
+    cursor: str = None,
+    limit: int = listing.DEFAULT_PAGE_SIZE,
+    db: Session = Depends(get_db),
+):
+    # Входящие заявки: {"items": [...], "next_cursor": "..."}, как у /students/
     try:
-        new_student = enroll_student(db, student_data)
-        return new_student
+        return workflow.list_requests(
+            db, status=status, teacher_id=teacher_id, student_id=student_id, stage=stage,
+            order=order, cursor=cursor, limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/requests/counts")
+def read_request_counts(teacher_id: int = None, db: Session = Depends(get_db)):
+    # teacher_id=0 — заявки без преподавателя
+    return workflow.request_counts(db, teacher_id)
+
+@app.post("/requests/transitions")
+async def transition_requests(batch: RequestTransition):
+    # Перевод пачки заявок одной транзакцией: {"updated": [id...], "skipped": [{"id", "error"}]}
+    try:
+        return await run_write(apply_transition, batch)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def apply_transition(db: Session, batch: RequestTransition):
+    result = workflow.transition(db, batch.ids, stage=batch.stage, status=batch.status)
+    db.commit()
+    return result
+
+@app.get("/requests/{request_id}")
+def read_request(request_id: int, db: Session = Depends(get_db)):
+    request = workflow.get_request(db, request_id)
+    if request is None:
+        raise HTTPException(status_code=404, detail="Request not found")
+    return request
+
+@app.post("/requests/{request_id}/transition")
+async def transition_request(request_id: int, step: StageTransition):
+    try:
+        return await run_write(apply_request_transition, request_id, step)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def apply_request_transition(db: Session, request_id: int, step: StageTransition):
+    result = workflow.transition(db, [request_id], stage=step.stage, status=step.status)
+    if result["skipped"]:
+        error = result["skipped"][0]["error"]
+        raise HTTPException(status_code=404 if error == "Request not found" else 409, detail=error)
+    db.commit()
+    return workflow.get_request(db, request_id)
+
+@app.get("/archive/students")
+def read_expelled_students(
+    department: str = None,
+    teacher_id: int = None,
+    since: datetime = None,
+    until: datetime = None,
+    cursor: str = None,
+    limit: int = listing.DEFAULT_PAGE_SIZE,
+    db: Session = Depends(get_db),
+):
+    # Отчисленные студенты за период [since, until) — ещё не перенесённые ("archived": false) и из архива
+    try:
+        return archive.expelled_students(
+            db, department=department, teacher_id=teacher_id, since=since, until=until, cursor=cursor, limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/archive/groups")
+def read_closed_groups(
+    department: str = None,
+    teacher_id: int = None,
+    since: datetime = None,
+    until: datetime = None,
+    cursor: str = None,
+    limit: int = listing.DEFAULT_PAGE_SIZE,
+    db: Session = Depends(get_db),
+):
+    try:
+        return archive.closed_groups(
+            db, department=department, teacher_id=teacher_id, since=since, until=until, cursor=cursor, limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/archive/requests")
+def read_archived_requests(
+    status: str = None,
+    teacher_id: int = None,
+    student_id: int = None,
+    since: datetime = None,
+    until: datetime = None,
+    cursor: str = None,
+    limit: int = listing.DEFAULT_PAGE_SIZE,
+    db: Session = Depends(get_db),
+):
+    try:
+        return archive.archived_requests(
+            db, status=status, teacher_id=teacher_id, student_id=student_id, since=since, until=until,
+            cursor=cursor, limit=limit,
+        )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.post("/archive/compact", status_code=202)
+async def compact_archive():
+    # Внеплановый перенос в архив; ход выполнения — GET /jobs/{id} или события /ws
+    return await run_db(submit_job, archive.enqueue_compaction)
+
+@app.post("/photos/")
+async def upload_photo(request: HttpRequest):
+    # Тело запроса — сам файл изображения; пишется на диск по мере поступления.
+    # Одинаковые фото хранятся один раз: адрес файла — SHA-256 содержимого
+    writer = await run_db(photos.PhotoWriter)
+    try:
+        async for chunk in request.stream():
+            # Запись на диск и хеширование — в пуле потоков, не в цикле событий
+            await run_db(writer.write, chunk)
+        digest = await run_db(writer.finish)
+    except photos.PhotoError as e:
+        await run_db(writer.abort)
+        status = 413 if writer.size > photos.PHOTO_MAX_BYTES else 400
+        raise HTTPException(status_code=status, detail=str(e))
+    except BaseException:
+        await run_db(writer.abort)
+        raise
+    url = photos.photo_url(digest)
+    return {"hash": digest, "url": url, "thumbnail_url": f"{url}?size=thumb"}
+
+@app.get("/photos/{digest}")
+def read_photo(digest: str, request: HttpRequest, size: str = None):
+    # Содержимое по адресу никогда не меняется, поэтому кэшировать его можно бессрочно
+    if not photos.is_photo_hash(digest) or not os.path.exists(photos.photo_path(digest)):
+        raise HTTPException(status_code=404, detail="Photo not found")
+
+    thumbnail = photos.make_thumbnail(digest) if size == "thumb" else None
+    etag = f'"{digest}-thumb"' if thumbnail else f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    if thumbnail:
+        return FileResponse(thumbnail, media_type="image/jpeg", headers=headers)
+    return FileResponse(photos.photo_path(digest), media_type=photos.content_type(digest), headers=headers)
+
+@app.get("/metrics")
+def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/db/pool")
+def read_pool_stats():
+    # Занятость пула соединений этого воркера: по ней подбирают DB_POOL_SIZE и число воркеров
+    return pool_stats()
+
+@app.get("/roster")
+def read_roster(request: HttpRequest, encoding: str = "json", db: Session = Depends(get_db)):
+    # Снимок состава в формате дельта-протокола (type, epoch, revision, teachers, students) из кэша;
+    # клиент может затем подключиться к /ws?protocol=delta&since=<revision>&epoch=<epoch>
+    encoding = negotiate_encoding(encoding)
+    etag = f'"{roster_log.epoch}-{roster_log.revision}-{encoding}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        revision, body = snapshot_cache.get(db, compressed=True, encoding=encoding)
+        headers["Content-Encoding"] = "gzip"
+    else:
+        revision, body = snapshot_cache.get(db, encoding=encoding)
+    headers["ETag"] = f'"{roster_log.epoch}-{revision}-{encoding}"'
+    media_type = "application/msgpack" if encoding == "msgpack" else "application/json"
+    return Response(content=body, media_type=media_type, headers=headers)
+
 @app.get("/students/")
-def read_students(department: str = None, group_id: int = None, db: Session = Depends(get_db)):
-    query = db.query(Students)
-    
-    if department:
-        query = query.filter(Students.department == department)
-    
-    if group_id:
-        query = query.filter(Students.group_id == group_id)
-
-    students = query.all()
-    return students
-
-def teacher_to_dict(teacher):
-    return {
-        "id": teacher.id,
-        "uuid": str(teacher.uuid),
-        "name": teacher.name,
-        "department": teacher.department,
-        "photo": teacher.photo,
-        "date_of_birth": teacher.date_of_birth.isoformat() if teacher.date_of_birth else None,
-        "created_at": teacher.created_at.isoformat() if teacher.created_at else None,
-        "groups": [group.name for group in teacher.groups]  # Добавляем список групп преподавателя
-    }
-
-def student_to_dict(student):
-    return {
-        "id": student.id,
-        "uuid": str(student.uuid),
-        "name": student.name,
-        "department": student.department,
-        "group_id": student.group_id,
-        "group_name": student.group.name if student.group else None,  # Название группы
-        "photo": student.photo,
-        "date_of_birth": student.date_of_birth.isoformat() if student.date_of_birth else None,
-        "created_at": student.created_at.isoformat() if student.created_at else None
-    }
+def read_students(
+    fields: str = None,
+    sort: str = "id",
+    order: str = "asc",
+    cursor: str = None,
+    limit: int = listing.DEFAULT_PAGE_SIZE,
+    name: str = None,
+    department: str = None,
+    group_id: int = None,
+    group: str = None,
+    born_after: date = None,
+    born_before: date = None,
+    db: Session = Depends(get_db),
+):
+    # Постраничный список: {"items": [...], "next_cursor": "..."}; следующая страница — ?cursor=<next_cursor>
+    # с теми же параметрами. fields=id,name,group_name выбирает столбцы (например, без photo)
+    try:
+        return listing.list_students(
+            db, fields=fields, sort=sort, order=order, cursor=cursor, limit=limit,
+            name=name, department=department, group_id=group_id, group=group,
+            born_after=born_after, born_before=born_before,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/search")
+def search_roster(
+    q: str,
+    types: str = None,
+    department: str = None,
+    limit: int = search.SEARCH_DEFAULT_LIMIT,
+    db: Session = Depends(get_db),
+):
+    # Подсказки при вводе: {"items": [{"type": "student"|"teacher", "id", "name", "department", ..., "score"}]}.
+    # types=student,teacher ограничивает типы записей, department — кафедру
+    try:
+        return search.search(db, q, types=types, department=department, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def connection_params(websocket: WebSocket):
+    # protocol=delta включает дельта-режим; since и epoch позволяют догнать пропущенные ревизии;
+    # encoding=columnar|msgpack — компактная кодировка сообщений (по умолчанию json)
+    params = websocket.query_params
+    protocol = params.get("protocol", "snapshot")
+    since = params.get("since", "")
+    encoding = negotiate_encoding(params.get("encoding", "json"))
+    if protocol == "delta" and since.isdigit() and params.get("epoch") == roster_log.epoch:
+        return protocol, int(since), encoding
+    return protocol, -1, encoding
+
+def connection_scope(db: Session, websocket: WebSocket):
+    # department=<кафедра> и group=<id группы> (можно несколько раз) ограничивают подписку частью состава
+    params = websocket.query_params
+    departments = [department for department in params.getlist("department") if department]
+    group_ids = [int(group_id) for group_id in params.getlist("group") if group_id.isdigit()]
+    if not departments and not group_ids:
+        return None
+    return resolve_scope(db, departments, group_ids)
+
+def handle_action(db: Session, request_data: dict, protocol: str, scope=None):
+    # Синхронная обработка одного действия /ws в текущей транзакции (без commit).
+    # Возвращает ответ только для отправителя или None
+    if request_data.get("action") == "create":
+        logger.debug("Создание нового элемента: %s", request_data.get("type"))
+        name = request_data.get("name")
+        department = request_data.get("department")
+        photo = photos.photo_ref(request_data.get("photo"))
+        date_of_birth = request_data.get("dateOfBirth")
+        if date_of_birth:
+            date_of_birth = date.fromisoformat(date_of_birth)  # Преобразуем строку в объект date
+
+        if request_data.get("type") == "teacher":
+            # Создаем нового преподавателя
+            new_item = Teachers(
+                name=name,
+                department=department,
+                photo=photo,
+                date_of_birth=date_of_birth
+            )
+            db.add(new_item)
+            db.flush()
+            logger.info("Новый преподаватель добавлен: id=%s", new_item.id)
+        else:
+            # Создаем нового студента
+            # Проверяем, есть ли в системе преподаватели
+            first_teacher = db.query(Teachers).order_by(Teachers.id).first()
+            if not first_teacher:
+                raise ValueError("Невозможно создать студента: в системе нет преподавателей")
+
+            # Используем функцию enroll_student для автоматического создания группы
+            student_data = {
+                "name": name,
+                "department": department,
+                "photo": photo,
+                "date_of_birth": date_of_birth,
+                "teacher_id": first_teacher.id  # Привязываем студента к первому преподавателю
+            }
+            new_student = enroll_student(db, student_data)
+            logger.info("Новый студент добавлен: id=%s", new_student.id)
+
+    elif request_data.get("action") == "fire":
+        # Удаляем преподавателя или студента из базы данных
+        item_id = request_data.get("id")
+        if request_data.get("type") == "teacher":
+            item_to_delete = db.query(Teachers).filter(Teachers.id == item_id).first()
+        else:
+            item_to_delete = db.query(Students).filter(Students.id == item_id).first()
+
+        if item_to_delete:
+            if request_data.get("type") == "teacher":
+                # Если на кафедре есть студенты и это последний преподаватель, запрещаем удаление
+                error = dismissal_error(db, item_to_delete)
+                if error:
+                    logger.info("Нельзя уволить последнего преподавателя на кафедре %s, пока там есть студенты", item_to_delete.department)
+                    payload = {'error': error}
+                    if protocol != "delta":
+                        payload.update(roster_snapshot(db, scope))
+                    return payload  # Пропускаем удаление
+
+                # Предпросмотр: вернуть план перевода, ничего не меняя
+                if request_data.get("dryRun"):
+                    try:
+                        plan = redistribute_students(db, item_to_delete.id, dry_run=True)
+                    except ValueError as e:
+                        plan = {"error": str(e)}
+                    return {"type": "redistribution_plan", "plan": plan}
+
+                # Перевод студентов и удаление выполняет фоновое задание: отправитель сразу получает его id,
+                # а затем события о ходе выполнения. Повторное увольнение того же преподавателя,
+                # пока задание не завершено, возвращает то же задание
+                job = jobs.enqueue(db, "dismiss_teacher", {"teacher_id": item_to_delete.id}, key=f"dismiss_teacher:{item_to_delete.id}")
+                logger.info("Увольнение преподавателя с ID %s поставлено в очередь: задание %s", item_id, job.id)
+                return {"type": "job", "job": jobs.job_info(job)}
+            else:
+                # Отчисляем студента (мягкое удаление, см. archive.py)
+                expel_student(db, item_to_delete.id)
+                logger.info("Студент с ID %s отчислен", item_id)
+        else:
+            logger.info("Элемент с ID %s не найден", item_id)
+    elif request_data.get("action") == "merge":
+        # Слияние кафедр: {"action": "merge", "type": "department", "source": "...", "target": "..."}
+        job = enqueue_merge(db, request_data.get("source"), request_data.get("target"))
+        return {"type": "job", "job": jobs.job_info(job)}
+    elif request_data.get("action") == "job":
+        # Состояние задания; дальше клиент получает события о его ходе
+        job_id = request_data.get("id")
+        job = jobs.get_job(db, job_id) if isinstance(job_id, int) else None
+        if job is None:
+            raise ValueError("Job not found")
+        return {"type": "job", "job": job}
+    elif request_data.get("action") == "update":
+        # Частичное обновление: меняются только присланные поля (name, department, photo, dateOfBirth,
+        # у студента — groupId). version — версия записи, которую видел клиент: если запись уже изменили,
+        # ответ {"type": "conflict"} с текущей записью. Без изменений запись и рассылка не затрагиваются
+        item_id = request_data.get("id")
+        reply = patches.patch_record(db, request_data.get("type"), item_id, request_data, request_data.get("version"))
+        if reply.get("changed"):
+            logger.info("Элемент с ID %s обновлён: %s", item_id, ", ".join(reply["changed"]))
+        return reply
+
+    return None
+
+def replay(db: Session, reply):
+    # Ответ на повтор уже выполненного действия; состояние задания — текущее
+    reply = dict(reply, duplicate=True)
+    if reply.get("type") == "job":
+        reply["job"] = jobs.get_job(db, reply["job"]["id"]) or reply["job"]
+    return reply
+
+def action_name(request_data):
+    action = request_data.get("action") if isinstance(request_data, dict) else None
+    return action if action in WS_ACTIONS else "unknown"
+
+def run_actions(db: Session, actions: list, protocol: str, scope=None, client: str = None):
+    # Выполняет действия одной транзакцией с одним commit. Если действий несколько, каждое
+    # выполняется в своём SAVEPOINT: ошибка в данных откатывает только это действие.
+    # Возвращает [(ответ, ошибка)] по действиям; прочие исключения откатывают всю транзакцию
+    # Действие с ключом requestId, уже выполненное этим воркером для того же клиента (client), не выполняется
+    # повторно: отправитель получает сохранённый ответ с duplicate=true, а транзакция и рассылка не нужны
+    results = []
+    claimed = {}
+    current = None
+    try:
+        for request_data in actions:
+            try:
+                if not isinstance(request_data, dict):
+                    raise ValueError("Invalid action format")
+                key = request_key(request_data, client)
+                cached = idempotency_cache.begin(key) if key is not None else None
+                if cached is PENDING:
+                    raise ValueError("Duplicate request in progress")
+            except ValueError as e:
+                results.append((None, str(e)))
+                continue
+            if cached is not None:
+                results.append((replay(db, cached), None))
+                continue
+            current = key
+            savepoint = db.begin_nested() if len(actions) > 1 else None
+            try:
+                reply = handle_action(db, request_data, protocol, scope)
+            except ValueError as e:
+                if savepoint is not None:
+                    savepoint.rollback()
+                else:
+                    db.rollback()
+                if key is not None:
+                    idempotency_cache.discard(key)
+                current = None
+                results.append((None, str(e)))
+                continue
+            if savepoint is not None:
+                savepoint.commit()
+            if key is not None:
+                reply = dict(reply or {"type": "ack"}, requestId=request_data["requestId"])
+                claimed[key] = reply
+            current = None
+            results.append((reply, None))
+        db.commit()
+    except BaseException:
+        db.rollback()
+        for key in [*claimed, current]:
+            if key is not None:
+                idempotency_cache.discard(key)
+        raise
+    for key, reply in claimed.items():
+        idempotency_cache.finish(key, reply)
+    return results
+
+async def receive_messages(websocket: WebSocket):
+    # Первое сообщение ждём без ограничения, следующие — в пределах окна WS_BATCH_WINDOW_MS.
+    # Если клиент отключился посреди окна, уже полученные сообщения всё равно обрабатываются
+    messages = [await websocket.receive_text()]
+    if WS_BATCH_WINDOW_MS <= 0:
+        return messages, None
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + WS_BATCH_WINDOW_MS / 1000
+    while len(messages) < WS_BATCH_MAX:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            messages.append(await asyncio.wait_for(websocket.receive_text(), timeout))
+        except asyncio.TimeoutError:
+            break
+        except WebSocketDisconnect as e:
+            return messages, e
+    return messages, None
 
 # WebSocket
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    print("WebSocket подключен")
+    logger.debug("WebSocket подключен")
 
     db = SessionLocal()  # Открываем сессию БД
+    scope = await run_db(connection_scope, db, websocket)
+    subscriber = hub.subscribe(websocket, *connection_params(websocket), scope=scope)
+    # client=<id> — постоянный идентификатор клиента: ключи requestId действуют в его пространстве
+    client = client_id(websocket.query_params.get("client"))
 
     try:
-        # При первом подключении отправляем актуальные данные
-        teachers = db.query(Teachers).order_by(Teachers.id).all()
-        students = db.query(Students).order_by(Students.id).all()
-
-        await websocket.send_text(json.dumps({
-            'teachers': [teacher_to_dict(teacher) for teacher in teachers],
-            'students': [student_to_dict(student) for student in students],
-        }))
+        # При первом подключении отправляем актуальные данные (или только пропущенные изменения)
+        await hub.activate(subscriber, db)
 
         while True:
-            # Ожидаем сообщение от клиента
-            data = await websocket.receive_text()
-            print(f"Получено сообщение: {data}")
-
-            try:
-                # Разбираем JSON-строку
-                request_data = json.loads(data)
-
-                if request_data.get("action") == "create":
-                    print("Создание нового элемента:", request_data)  # Логируем данные
-                    name = request_data.get("name")
-                    department = request_data.get("department")
-                    photo = request_data.get("photo")
-                    date_of_birth = request_data.get("dateOfBirth")
-                    if date_of_birth:
-                        date_of_birth = date.fromisoformat(date_of_birth)  # Преобразуем строку в объект date
-
-                    if request_data.get("type") == "teacher":
-                        # Создаем нового преподавателя
-                        new_item = Teachers(
-                            name=name,
-                            department=department,
-                            photo=photo,
-                            date_of_birth=date_of_birth
-                        )
-                        db.add(new_item)
-                        db.commit()  # Сохраняем изменения в базе данных
-                        print(f"Новый преподаватель добавлен: {new_item}")
-                    else:
-                        # Создаем нового студента
-                        # Проверяем, есть ли в системе преподаватели
-                        first_teacher = db.query(Teachers).order_by(Teachers.id).first()
-                        if not first_teacher:
-                            raise ValueError("Невозможно создать студента: в системе нет преподавателей")
-
-                        # Используем функцию enroll_student для автоматического создания группы
-                        student_data = {
-                            "name": name,
-                            "department": department,
-                            "photo": photo,
-                            "date_of_birth": date_of_birth,
-                            "teacher_id": first_teacher.id  # Привязываем студента к первому преподавателю
-                        }
-                        new_student = enroll_student(db, student_data)
-                        print(f"Новый студент добавлен: {new_student}")
-
-                elif request_data.get("action") == "fire":
-                    # Удаляем преподавателя или студента из базы данных
-                    item_id = request_data.get("id")
-                    if request_data.get("type") == "teacher":
-                        item_to_delete = db.query(Teachers).filter(Teachers.id == item_id).first()
-                    else:
-                        item_to_delete = db.query(Students).filter(Students.id == item_id).first()
-
-                    if item_to_delete:
-                        if request_data.get("type") == "teacher":
-                            # Проверяем, есть ли студенты на кафедре этого преподавателя
-                            students_in_department = db.query(Students).filter(Students.department == item_to_delete.department).count()
-                            teachers_in_department = db.query(Teachers).filter(Teachers.department == item_to_delete.department).count()
-
-                            if students_in_department > 0 and teachers_in_department <= 1:
-                                # Если есть студенты и это последний преподаватель, запрещаем удаление
-                                print(f"Нельзя уволить последнего преподавателя на кафедре {item_to_delete.department}, пока там есть студенты.")
-                                await websocket.send_text(json.dumps({
-                                    'error': 'Нельзя уволить последнего преподавателя на кафедре, пока там есть студенты.',
-                                    'teachers': [teacher_to_dict(teacher) for teacher in db.query(Teachers).all()],
-                                    'students': [student_to_dict(student) for student in db.query(Students).all()],
-                                }))
-                                continue  # Пропускаем удаление
-
-                            # Если студентов нет, или это не последний преподаватель, перераспределяем студентов (если есть)
-                            if students_in_department > 0:
-                                try:
-                                    redistribute_students(db, item_to_delete.id)
-                                except ValueError as e:
-                                    await websocket.send_text(json.dumps({"error": str(e)}))
-                                    continue
-
-                            # Удаляем преподавателя
-                            db.delete(item_to_delete)
-                            db.commit()
-                            print(f"Преподаватель с ID {item_id} удалён из базы данных")
+            # Ожидаем сообщения от клиента: одиночные действия или массивы действий
+            messages, disconnect = await receive_messages(websocket)
+            logger.debug("Получено сообщений: %s", len(messages))
+
+            # units — [(действия, пришли ли они массивом)]; все действия пакета выполняются одной транзакцией
+            units, actions = [], []
+            for data in messages:
+                try:
+                    # Разбираем JSON-строку
+                    request_data = json.loads(data)
+                except json.JSONDecodeError as e:
+                    logger.warning("Ошибка при разборе JSON: %s", e)
+                    metrics.WS_ACTION_ERRORS.inc(action="invalid", error="json")
+                    subscriber.send({"error": "Invalid JSON format"})
+                    continue
+
+                if isinstance(request_data, list):
+                    if len(request_data) > WS_BATCH_MAX:
+                        metrics.WS_ACTION_ERRORS.inc(action="batch", error="value")
+                        subscriber.send({"error": f"Too many actions in batch (max {WS_BATCH_MAX})"})
+                        continue
+                    units.append((request_data, True))
+                    actions.extend(request_data)
+                elif action_name(request_data) == "ping":
+                    # Проверка связи без обращения к БД (используется и нагрузочным тестом)
+                    with metrics.WS_ACTION_SECONDS.time(action="ping"):
+                        subscriber.send({"type": "pong", "id": request_data.get("id")})
+                else:
+                    units.append(([request_data], False))
+                    actions.append(request_data)
+
+            if not actions:
+                if disconnect:
+                    raise disconnect
+                continue
+
+            action = action_name(actions[0]) if len(units) == 1 and not units[0][1] else "batch"
+            started = time.perf_counter()
+            with metrics.count_queries() as queries:
+                try:
+                    results = await run_db(run_actions, db, actions, subscriber.protocol, subscriber.scope, client)
+                except Exception as e:
+                    logger.exception("Ошибка при обработке данных: %s", e)
+                    metrics.WS_ACTION_ERRORS.inc(action=action, error="internal")
+                    for _ in units:
+                        subscriber.send({"error": "Internal server error"})
+                else:
+                    # Отправитель получает события о заданиях, которые поставил или запросил
+                    queued = False
+                    for reply, _ in results:
+                        if isinstance(reply, dict) and reply.get("type") == "job" and reply["job"]["status"] in jobs.ACTIVE:
+                            hub.follow(subscriber, reply["job"]["id"])
+                            queued = queued or reply["job"]["status"] == "queued"
+
+                    # Ответы отправителю: на одиночное сообщение — как раньше, на массив — результаты по действиям
+                    position = 0
+                    for unit, batched in units:
+                        unit_results = results[position:position + len(unit)]
+                        position += len(unit)
+                        for request_data, (reply, error) in zip(unit, unit_results):
+                            if error is not None:
+                                logger.info("Ошибка в данных: %s", error)
+                                metrics.WS_ACTION_ERRORS.inc(action=action_name(request_data), error="value")
+                        if batched:
+                            subscriber.send({
+                                "type": "batch_result",
+                                "results": [
+                                    {"index": index, "ok": False, "error": error} if error is not None
+                                    else {"index": index, "ok": True, "result": reply}
+                                    for index, (reply, error) in enumerate(unit_results)
+                                ],
+                            })
                         else:
-                            # Удаляем студента
-                            group_id = item_to_delete.group_id  # Получаем ID группы студента
-                            db.delete(item_to_delete)
-                            db.commit()
-                            print(f"Студент с ID {item_id} удалён из базы данных")
-
-                            # Проверяем, остались ли студенты в группе
-                            students_in_group = db.query(Students).filter(Students.group_id == group_id).count()
-                            if students_in_group == 0:
-                                # Если студентов в группе больше нет, удаляем группу
-                                group_to_delete = db.query(Group).filter(Group.id == group_id).first()
-                                if group_to_delete:
-                                    db.delete(group_to_delete)
-                                    db.commit()
-                                    print(f"Группа с ID {group_id} удалена, так как в ней больше нет студентов")
-                    else:
-                        print(f"Элемент с ID {item_id} не найден")
-                elif request_data.get("action") == "update":
-                    # Обновляем существующую запись
-                    item_id = request_data.get("id")
-                    if request_data.get("type") == "teacher":
-                        item_to_update = db.query(Teachers).filter(Teachers.id == item_id).first()
-                    else:
-                        item_to_update = db.query(Students).filter(Students.id == item_id).first()
-
-                    if item_to_update:
-                        item_to_update.name = request_data.get("name")
-                        item_to_update.department = request_data.get("department")
-                        item_to_update.group = request_data.get("group")
-                        item_to_update.photo = request_data.get("photo")
-                        item_to_update.date_of_birth = request_data.get("dateOfBirth")  # Обновляем дату рождения
-                        db.commit()
-                        print(f"Элемент с ID {item_id} обновлён")
-                    else:
-                        print(f"Элемент с ID {item_id} не найден")
-
-                # Получаем обновленные данные и сортируем их
-                teachers = db.query(Teachers).order_by(Teachers.id).all()
-                students = db.query(Students).order_by(Students.id).all()
-
-                # Отправляем обновленные данные всем подключенным клиентам
-                await websocket.send_text(json.dumps({
-                    'teachers': [teacher_to_dict(teacher) for teacher in teachers],
-                    'students': [student_to_dict(student) for student in students],
-                }))
-            except json.JSONDecodeError as e:
-                print(f"Ошибка при разборе JSON: {e}")
-                await websocket.send_text(json.dumps({"error": "Invalid JSON format"}))
-            except ValueError as e:
-                print(f"Ошибка в данных: {e}")
-                await websocket.send_text(json.dumps({"error": str(e)}))
-            except Exception as e:
-                print(f"Ошибка при обработке данных: {e}")
-                db.rollback()  # Откатываем изменения в случае ошибки
-                await websocket.send_text(json.dumps({"error": "Internal server error"}))
+                            reply, error = unit_results[0]
+                            if error is not None:
+                                subscriber.send({"error": error})
+                            elif reply:
+                                subscriber.send(reply)
+                    if queued:
+                        job_runner.wake()
+                finally:
+                    # Отправляем зафиксированные изменения всем подключенным клиентам одной дельтой на пакет
+                    await hub.publish(pop_committed(db))
+                    metrics.WS_ACTION_SECONDS.observe(time.perf_counter() - started, action=action)
+                    metrics.WS_MESSAGE_QUERIES.observe(queries[0])
+
+            if disconnect:
+                raise disconnect
 
     except WebSocketDisconnect:
-        print("WebSocket отключен")
+        logger.debug("WebSocket отключен")
     finally:
-        db.close()  # Закрываем сессию БД
\ No newline at end of file
+        hub.unsubscribe(subscriber)
+        await run_db(db.close)  # Закрываем сессию БД
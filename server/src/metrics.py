@@ -0,0 +1,166 @@
+from sqlalchemy import event
+from contextlib import contextmanager
+import bisect
+import contextvars
+import threading
+import time
+
+# Метрики в текстовом формате Prometheus (GET /metrics). Значения хранятся в памяти воркера;
+# при нескольких воркерах Prometheus опрашивает каждый отдельно
+
+# Границы корзин гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        # callback() вычисляет значение при опросе: число (или None — нет значения),
+        # для метрики с метками — {кортеж значений меток: число}
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.callback = callback
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name}: expected labels {self.label_names}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        if self.callback is not None:
+            value = self.callback()
+            if not self.label_names:
+                return [] if value is None else [(self.name, (), [], value)]
+            return [(self.name, key, [], item) for key, item in value.items() if item is not None]
+        with self._lock:
+            return [(self.name, key, [], value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.label_names, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            state["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, state in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), state["counts"]):
+                    cumulative += count
+                    result.append((f"{self.name}_bucket", key, [("le", _format_value(float(bound)))], cumulative))
+                result.append((f"{self.name}_sum", key, [], state["sum"]))
+                result.append((f"{self.name}_count", key, [], state["count"]))
+        return result
+
+
+def render():
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+# Счётчик SQL-запросов текущего сообщения. run_db копирует контекст в поток пула,
+# поэтому запросы из пула попадают в счётчик того сообщения, которое их вызвало
+_query_count = contextvars.ContextVar("query_count", default=None)
+
+
+def _count_query(*args):
+    counter = _query_count.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", _count_query)
+
+
+@contextmanager
+def count_queries():
+    # with count_queries() as queries: ...; queries[0] — число запросов внутри блока
+    counter = [0]
+    token = _query_count.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_count.reset(token)
+
+
+WS_ACTION_SECONDS = Histogram("roster_ws_action_seconds", "Время обработки сообщения /ws по действию", ["action"])
+WS_ACTION_ERRORS = Counter("roster_ws_action_errors_total", "Сообщения /ws, завершившиеся ошибкой", ["action", "error"])
+WS_MESSAGE_QUERIES = Histogram(
+    "roster_ws_message_db_queries", "Число SQL-запросов на одно сообщение /ws",
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+ENROLL_SECONDS = Histogram("roster_enroll_student_seconds", "Время зачисления студента (enroll_student)")
+REDISTRIBUTE_SECONDS = Histogram("roster_redistribute_students_seconds", "Время перераспределения студентов (redistribute_students)")
+WS_SEND_DROPPED = Counter("roster_ws_send_dropped_total", "Сообщения, выброшенные из переполненных очередей отправки")
+PAYLOAD_BYTES = Histogram(
+    "roster_payload_bytes", "Размер закодированного снимка или дельты", ["kind", "encoding"],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864),
+)
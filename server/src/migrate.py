@@ -0,0 +1,161 @@
+from sqlalchemy import MetaData, Table, UniqueConstraint, inspect, text
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
+
+from .database import Base, DATABASE_DIRECT_URL, create_db_engine
+from .placement import recount_groups
+from .workflow import recount_requests
+# Условие «только действующие строки» для запросов ORM, в том числе в сессиях миграции
+from . import archive  # noqa: F401
+
+# Ключ advisory-блокировки: миграцию, запущенную одновременно несколькими контейнерами, выполняет один
+MIGRATION_LOCK_ID = 7242001
+
+# Полные индексы, заменённые частичными индексами по действующим строкам (ix_students_active_*)
+REPLACED_INDEXES = {
+    "students": ("ix_students_department", "ix_students_group_id"),
+}
+
+
+def rebuild_without_unique(conn, table_name, column_names):
+    # В SQLite ограничение из CREATE TABLE не снимается через ALTER TABLE, поэтому таблица пересоздаётся
+    # без него: новая таблица с теми же столбцами, копирование строк, удаление старой, переименование.
+    # Внешние ключи других таблиц ссылаются на неё по имени и после переименования указывают на новую.
+    # Индексы удаляются вместе со старой таблицей и создаются заново в ensure_indexes
+    table = Table(table_name, MetaData(), autoload_with=conn)
+    for constraint in list(table.constraints):
+        if isinstance(constraint, UniqueConstraint) and [column.name for column in constraint.columns] == column_names:
+            table.constraints.remove(constraint)
+    rebuilt = table.to_metadata(table.metadata, name=f"{table_name}_rebuild")
+    conn.execute(CreateTable(rebuilt))
+    columns = ", ".join(f'"{column.name}"' for column in table.columns)
+    conn.execute(text(f"INSERT INTO {rebuilt.name} ({columns}) SELECT {columns} FROM {table_name}"))
+    conn.execute(text(f"DROP TABLE {table_name}"))
+    conn.execute(text(f"ALTER TABLE {rebuilt.name} RENAME TO {table_name}"))
+
+
+def ensure_soft_delete(conn):
+    # Мягкое удаление студентов и групп (archive.py): столбцы deleted_at появились позже таблиц.
+    # Уникальность названия группы теперь только среди действующих групп (частичный индекс
+    # ux_groups_active_name), поэтому прежнее ограничение UNIQUE снимается. В SQLite ограничение
+    # из CREATE TABLE снять нельзя — там таблица groups создаётся заново (rebuild_without_unique)
+    added = []
+    for table in ("students", "groups"):
+        columns = {column["name"] for column in inspect(conn).get_columns(table)}
+        if "deleted_at" not in columns:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN deleted_at TIMESTAMP"))
+            added.append(table)
+    for constraint in inspect(conn).get_unique_constraints("groups"):
+        if constraint["column_names"] != ["name"]:
+            continue
+        if conn.dialect.name == "postgresql":
+            conn.execute(text(f'ALTER TABLE groups DROP CONSTRAINT "{constraint["name"]}"'))
+        elif conn.dialect.name == "sqlite":
+            rebuild_without_unique(conn, "groups", ["name"])
+    return added
+
+
+def ensure_student_counts(conn):
+    # Столбец groups.student_count появился позже самой таблицы: добавляем и заполняем его в существующих БД
+    columns = {column["name"] for column in inspect(conn).get_columns("groups")}
+    if "student_count" in columns:
+        return False
+    conn.execute(text("ALTER TABLE groups ADD COLUMN student_count INTEGER NOT NULL DEFAULT 0"))
+    with Session(bind=conn) as db:
+        recount_groups(db)
+        db.flush()
+    return True
+
+
+def ensure_versions(conn):
+    # Столбец version у преподавателей и студентов появился позже: существующие записи получают версию 1
+    added = []
+    for table in ("teachers", "students"):
+        columns = {column["name"] for column in inspect(conn).get_columns(table)}
+        if "version" not in columns:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+            added.append(table)
+    return added
+
+
+def ensure_request_stage(conn):
+    # Столбец requests.stage (текущий этап) появился позже: заполняем его из активных этапов
+    columns = {column["name"] for column in inspect(conn).get_columns("requests")}
+    if "stage" in columns:
+        return False
+    conn.execute(text("ALTER TABLE requests ADD COLUMN stage VARCHAR(100)"))
+    conn.execute(text(
+        "UPDATE requests SET stage = (SELECT stages.stage_name FROM stages WHERE stages.request_id = requests.id "
+        "ORDER BY stages.status = 'active' DESC, stages.id DESC LIMIT 1)"
+    ))
+    return True
+
+
+def ensure_request_counts(conn, created):
+    # Счётчики заявок заполняются по самим заявкам, когда таблица request_counts только что создана
+    if not created:
+        return False
+    with Session(bind=conn) as db:
+        recount_requests(db)
+        db.flush()
+    return True
+
+
+def ensure_indexes(conn):
+    # create_all не добавляет индексы в уже существующие таблицы
+    existing = {
+        table: {index["name"] for index in inspect(conn).get_indexes(table)}
+        for table in inspect(conn).get_table_names()
+    }
+    for table, names in REPLACED_INDEXES.items():
+        for name in names:
+            if name in existing.get(table, ()):
+                conn.execute(text(f"DROP INDEX {name}"))
+    attempted = []
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing.get(table.name, ()):
+                index.create(bind=conn)
+                attempted.append((table.name, index.name))
+    # Индексы только для PostgreSQL (триграммные) в других БД не создаются
+    return [
+        name for table, name in attempted
+        if name in {index["name"] for index in inspect(conn).get_indexes(table)}
+    ]
+
+
+def migrate(engine):
+    # Создаёт недостающие таблицы, столбцы и индексы. Выполняется один раз при деплое
+    # (до запуска воркеров), а не при импорте модулей каждым воркером
+    with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+            # Триграммные индексы поиска (search.py)
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        had_request_counts = inspect(conn).has_table("request_counts")
+        Base.metadata.create_all(bind=conn)
+        # До пересчётов: запросы ORM уже отбирают строки по deleted_at
+        soft_delete = ensure_soft_delete(conn)
+        added_counts = ensure_student_counts(conn)
+        added_stage = ensure_request_stage(conn)
+        versions = ensure_versions(conn)
+        request_counts = ensure_request_counts(conn, created=not had_request_counts)
+        indexes = ensure_indexes(conn)
+    return {
+        "deleted_at_added": soft_delete,
+        "student_count_added": added_counts,
+        "request_stage_added": added_stage,
+        "version_added": versions,
+        "request_counts_filled": request_counts,
+        "indexes_created": indexes,
+    }
+
+
+if __name__ == "__main__":
+    # python -m src.migrate
+    migration_engine = create_db_engine(DATABASE_DIRECT_URL)
+    try:
+        result = migrate(migration_engine)
+    finally:
+        migration_engine.dispose()
+    print(f"Миграция выполнена: {result}")
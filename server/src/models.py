@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, TIMESTAMP, ForeignKey, LargeBinary, Date
+from sqlalchemy import Column, Integer, String, Float, TIMESTAMP, ForeignKey, LargeBinary, Date, Index, JSON, text
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
@@ -30,12 +30,39 @@ class Item(Base):
 #     requests = relationship("Request", back_populates="client")
 
 
+def trigram_index(name, column):
+    # Индекс GIN pg_trgm для поиска по подстроке (см. search.py); создаётся только в PostgreSQL
+    return Index(name, column, postgresql_using="gin", postgresql_ops={column: "gin_trgm_ops"}).ddl_if(dialect="postgresql")
+
+
+def active_index(name, *columns, unique=False):
+    # Частичный индекс только по действующим (не удалённым) строкам (см. archive.py)
+    return Index(
+        name, *columns, unique=unique,
+        postgresql_where=text("deleted_at IS NULL"),
+        sqlite_where=text("deleted_at IS NULL"),
+    )
+
+
+def deleted_index(name, *columns):
+    # Частичный индекс по удалённым строкам для истории и архивации (см. archive.py)
+    return Index(
+        name, *columns,
+        postgresql_where=text("deleted_at IS NOT NULL"),
+        sqlite_where=text("deleted_at IS NOT NULL"),
+    )
+
 class Group(Base):
     __tablename__ = 'groups'
 
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False, unique=True)
-    teacher_id = Column(Integer, ForeignKey('teachers.id', ondelete="CASCADE"), nullable=False)
+    # Название уникально среди действующих групп (индекс ux_groups_active_name)
+    name = Column(String, nullable=False)
+    teacher_id = Column(Integer, ForeignKey('teachers.id', ondelete="CASCADE"), nullable=False, index=True)
+    # Число студентов в группе; поддерживается при зачислении, отчислении и переводе (см. placement.py)
+    student_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Время закрытия опустевшей группы; закрытые группы скрыты из запросов ORM (см. archive.py)
+    deleted_at = Column(TIMESTAMP, nullable=True)
 
     # Связь с таблицей Students
     students = relationship("Students", back_populates="group")
@@ -43,6 +70,12 @@ class Group(Base):
     # Связь с таблицей Teachers
     teacher = relationship("Teachers", back_populates="groups")
 
+    __table_args__ = (
+        trigram_index("ix_groups_name_trgm", "name"),
+        active_index("ux_groups_active_name", "name", unique=True),
+        deleted_index("ix_groups_deleted_at", "deleted_at", "id"),
+    )
+
 class Teachers(Base):
     __tablename__ = 'teachers'
 
@@ -50,9 +83,11 @@ class Teachers(Base):
     uuid = Column(UUID(as_uuid=True), unique=True, nullable=False, default=uuid.uuid4)
     name = Column(String(100), nullable=False)
     created_at = Column(TIMESTAMP, server_default=func.now())
-    department = Column(String, nullable=True)
+    department = Column(String, nullable=True, index=True)
     photo = Column(String, nullable=True)
     date_of_birth = Column(Date, nullable=True)
+    # Номер версии записи: растёт при каждом изменении, обновление с устаревшим номером отклоняется (см. patches.py)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
     # Связь с таблицей Group (один преподаватель может вести несколько групп)
     groups = relationship("Group", back_populates="teacher")
@@ -60,17 +95,27 @@ class Teachers(Base):
     # Связь с таблицей Request
     requests = relationship("Request", back_populates="teacher")  # Добавьте эту строку
 
+    __table_args__ = (
+        trigram_index("ix_teachers_name_trgm", "name"),
+        trigram_index("ix_teachers_department_trgm", "department"),
+    )
+
 class Students(Base):
     __tablename__ = 'students'
 
     id = Column(Integer, primary_key=True, index=True)
     uuid = Column(UUID(as_uuid=True), unique=True, nullable=False, default=uuid.uuid4)
     name = Column(String(100), nullable=False)
+    # Индексы по кафедре и группе — частичные, только по действующим студентам (см. __table_args__)
     department = Column(String, nullable=True)
     group_id = Column(Integer, ForeignKey('groups.id', ondelete="CASCADE"), nullable=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
     photo = Column(String, nullable=True)
     date_of_birth = Column(Date, nullable=True)
+    # Номер версии записи (см. patches.py)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    # Время отчисления; отчисленные студенты скрыты из запросов ORM (см. archive.py)
+    deleted_at = Column(TIMESTAMP, nullable=True)
     
     # Связь с таблицей Group
     group = relationship("Group", back_populates="students")
@@ -78,6 +123,18 @@ class Students(Base):
     # Связь с таблицей Request
     requests = relationship("Request", back_populates="student")  # Добавьте эту строку
 
+    # Индексы для постраничного списка с сортировкой по имени и дате рождения (см. listing.py)
+    __table_args__ = (
+        Index("ix_students_name_id", "name", "id"),
+        Index("ix_students_date_of_birth_id", "date_of_birth", "id"),
+        trigram_index("ix_students_name_trgm", "name"),
+        trigram_index("ix_students_department_trgm", "department"),
+        # Выборки действующих студентов по кафедре и группе не читают строки отчисленных
+        active_index("ix_students_active_department", "department", "id"),
+        active_index("ix_students_active_group_id", "group_id"),
+        deleted_index("ix_students_deleted_at", "deleted_at", "id"),
+    )
+
 class Request(Base):
     __tablename__ = 'requests'
     
@@ -85,6 +142,8 @@ class Request(Base):
     teacher_id = Column(Integer, ForeignKey('teachers.id', ondelete="CASCADE"), nullable=True)
     student_id = Column(Integer, ForeignKey('students.id', ondelete="CASCADE"), nullable=True)
     status = Column(String(50), nullable=False)
+    # Название текущего этапа (копия из stages для выборок по этапу без соединения)
+    stage = Column(String(100), nullable=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
     updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
     
@@ -93,6 +152,13 @@ class Request(Base):
     student = relationship("Students", back_populates="requests")  # Связь со студентами
     stages = relationship("Stage", back_populates="request")  # Связь с этапами (если требуется)
 
+    # Входящие по статусу, преподавателю и студенту — от новых изменений к старым (см. workflow.py)
+    __table_args__ = (
+        Index("ix_requests_status_updated_at", "status", "updated_at", "id"),
+        Index("ix_requests_teacher_id_status", "teacher_id", "status", "updated_at", "id"),
+        Index("ix_requests_student_id_status", "student_id", "status", "updated_at", "id"),
+    )
+
 class Stage(Base):
     __tablename__ = 'stages'
     
@@ -103,4 +169,124 @@ class Stage(Base):
     started_at = Column(TIMESTAMP, server_default=func.now())
     completed_at = Column(TIMESTAMP, nullable=True)
     
-    request = relationship("Request", back_populates="stages")
\ No newline at end of file
+    request = relationship("Request", back_populates="stages")
+
+    __table_args__ = (
+        Index("ix_stages_request_id", "request_id", "id"),
+        # У заявки не больше одного активного этапа
+        Index(
+            "ux_stages_active_request_id", "request_id", unique=True,
+            postgresql_where=text("status = 'active'"),
+            sqlite_where=text("status = 'active'"),
+        ),
+    )
+
+class RequestCount(Base):
+    __tablename__ = 'request_counts'
+
+    # Число заявок по преподавателю, статусу и этапу; меняется вместе с заявками (см. workflow.py).
+    # teacher_id = 0 — заявки без преподавателя, stage = '' — без этапа
+    teacher_id = Column(Integer, primary_key=True)
+    status = Column(String(50), primary_key=True)
+    stage = Column(String(100), primary_key=True)
+    total = Column(Integer, nullable=False, default=0, server_default="0")
+
+# Архив (см. archive.py): отчисленные студенты, закрытые группы и завершённые заявки старше срока хранения.
+# В PostgreSQL таблицы секционированы по годам времени удаления или закрытия (секции создаются по мере
+# надобности), поэтому ключ секционирования входит в первичный ключ
+
+class StudentArchive(Base):
+    __tablename__ = 'students_archive'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    deleted_at = Column(TIMESTAMP, primary_key=True)
+    uuid = Column(UUID(as_uuid=True), nullable=False)
+    name = Column(String(100), nullable=False)
+    department = Column(String, nullable=True)
+    # Группа и её преподаватель на момент отчисления
+    group_id = Column(Integer, nullable=True)
+    group_name = Column(String, nullable=True)
+    teacher_id = Column(Integer, nullable=True)
+    photo = Column(String, nullable=True)
+    date_of_birth = Column(Date, nullable=True)
+    created_at = Column(TIMESTAMP, nullable=True)
+    version = Column(Integer, nullable=False, default=1)
+    archived_at = Column(TIMESTAMP, server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_students_archive_deleted_at", "deleted_at", "id"),
+        Index("ix_students_archive_department", "department", "deleted_at", "id"),
+        {"postgresql_partition_by": "RANGE (deleted_at)"},
+    )
+
+class GroupArchive(Base):
+    __tablename__ = 'groups_archive'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    deleted_at = Column(TIMESTAMP, primary_key=True)
+    name = Column(String, nullable=False)
+    teacher_id = Column(Integer, nullable=True)
+    # Кафедра преподавателя на момент архивации
+    department = Column(String, nullable=True)
+    archived_at = Column(TIMESTAMP, server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_groups_archive_deleted_at", "deleted_at", "id"),
+        Index("ix_groups_archive_teacher_id", "teacher_id", "deleted_at", "id"),
+        {"postgresql_partition_by": "RANGE (deleted_at)"},
+    )
+
+class RequestArchive(Base):
+    __tablename__ = 'requests_archive'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    # Время закрытия (updated_at заявки)
+    closed_at = Column(TIMESTAMP, primary_key=True)
+    teacher_id = Column(Integer, nullable=True)
+    student_id = Column(Integer, nullable=True)
+    status = Column(String(50), nullable=False)
+    stage = Column(String(100), nullable=True)
+    created_at = Column(TIMESTAMP, nullable=True)
+    # Этапы заявки в том же виде, что в GET /requests/{id}
+    stages = Column(JSON, nullable=False, default=list)
+    archived_at = Column(TIMESTAMP, server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_requests_archive_closed_at", "closed_at", "id"),
+        Index("ix_requests_archive_teacher_id", "teacher_id", "closed_at", "id"),
+        Index("ix_requests_archive_student_id", "student_id", "closed_at", "id"),
+        {"postgresql_partition_by": "RANGE (closed_at)"},
+    )
+
+class Job(Base):
+    __tablename__ = 'jobs'
+
+    # Фоновое задание (см. jobs.py): увольнение с переводом студентов, импорт, слияние кафедр
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(50), nullable=False)
+    # Ключ идемпотентности: пока задание с этим ключом не завершено, повторная постановка возвращает его же
+    key = Column(String(200), nullable=True)
+    params = Column(JSON, nullable=False, default=dict)
+    payload = Column(LargeBinary, nullable=True)
+    status = Column(String(20), nullable=False, default="queued", server_default="queued")
+    progress = Column(Integer, nullable=False, default=0, server_default="0")
+    total = Column(Integer, nullable=True)
+    # Состояние, с которого продолжается задание после сбоя воркера
+    checkpoint = Column(JSON, nullable=True)
+    result = Column(JSON, nullable=True)
+    error = Column(String, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    locked_by = Column(String(64), nullable=True)
+    locked_until = Column(TIMESTAMP, nullable=True)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        # Очередь выбирается по статусу в порядке id
+        Index("ix_jobs_status_id", "status", "id"),
+        Index(
+            "ux_jobs_active_key", "key", unique=True,
+            postgresql_where=text("status IN ('queued', 'running')"),
+            sqlite_where=text("status IN ('queued', 'running')"),
+        ),
+    )
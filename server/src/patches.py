@@ -0,0 +1,144 @@
+from sqlalchemy import select, update, event
+from sqlalchemy.orm import Session
+from datetime import date
+
+from .database import SessionLocal
+from .models import Teachers, Students
+from .changes import mark_changed
+from .capacity import mark_groups
+from .roster import load_teachers, load_students
+from . import photos, placement
+
+MODELS = {"teacher": Teachers, "student": Students}
+
+# Сколько раз частичное обновление без номера версии повторяется, если запись одновременно изменили
+PATCH_ATTEMPTS = 3
+
+
+def parse_name(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError("Name is required")
+    return value
+
+
+def parse_department(value):
+    return value or None
+
+
+def parse_date(value):
+    # Дата рождения приходит строкой YYYY-MM-DD; пустое значение стирает её
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError("dateOfBirth must be a date in YYYY-MM-DD format")
+
+
+def parse_group(value):
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError("groupId must be an integer")
+    return value
+
+
+# Поля действия update: имя в сообщении -> (столбец, разбор значения). Меняются только присланные поля
+PATCH_FIELDS = {
+    "teacher": {
+        "name": ("name", parse_name),
+        "department": ("department", parse_department),
+        "photo": ("photo", photos.photo_ref),
+        "dateOfBirth": ("date_of_birth", parse_date),
+    },
+    "student": {
+        "name": ("name", parse_name),
+        "department": ("department", parse_department),
+        "photo": ("photo", photos.photo_ref),
+        "dateOfBirth": ("date_of_birth", parse_date),
+        "groupId": ("group_id", parse_group),
+    },
+}
+
+
+def parse_patch(kind: str, data: dict):
+    return {column: parse(data[field]) for field, (column, parse) in PATCH_FIELDS[kind].items() if field in data}
+
+
+def load_record(db: Session, kind: str, record_id: int):
+    # Запись в том же виде, что в снимке и дельтах состава
+    rows = (load_teachers if kind == "teacher" else load_students)(db, ids=[record_id])
+    return rows[0] if rows else None
+
+
+def conflict(db: Session, kind: str, record_id: int):
+    record = load_record(db, kind, record_id)
+    if record is None:
+        raise ValueError("Record not found")
+    return {"type": "conflict", "kind": kind, "id": record_id, "version": record["version"], "current": record}
+
+
+def patch_record(db: Session, kind: str, record_id, data: dict, expected_version=None):
+    # Частичное обновление с проверкой версии (compare-and-set): UPDATE записывает только изменившиеся
+    # столбцы и срабатывает, только если версия записи не изменилась с момента чтения.
+    # expected_version — версия, которую видел клиент: если запись с тех пор изменили, возвращается
+    # {"type": "conflict", ...} с текущей записью. Если значения не отличаются от текущих, запись не меняется
+    model = MODELS.get(kind)
+    if model is None:
+        raise ValueError(f"Unknown type: {kind}")
+    if not isinstance(record_id, int):
+        raise ValueError("id must be an integer")
+    if expected_version is not None and not isinstance(expected_version, int):
+        raise ValueError("version must be an integer")
+    values = parse_patch(kind, data)
+
+    for _ in range(PATCH_ATTEMPTS):
+        # Столбцы ORM, а не таблицы: отчисленные студенты (archive.py) так не находятся
+        row = db.execute(select(*[getattr(model, column.key) for column in model.__table__.c]).where(model.id == record_id)).first()
+        if row is None:
+            raise ValueError("Record not found")
+        if expected_version is not None and row.version != expected_version:
+            return conflict(db, kind, record_id)
+        changed = {column: value for column, value in values.items() if getattr(row, column) != value}
+        if not changed:
+            return {"type": "updated", "kind": kind, "id": record_id, "version": row.version, "changed": []}
+
+        version = db.execute(
+            update(model)
+            .where(model.id == record_id, model.version == row.version)
+            .values(**changed, version=model.version + 1)
+            .returning(model.version)
+            .execution_options(synchronize_session=False)
+        ).scalar()
+        if version is None:
+            # Запись изменили между чтением и записью
+            if expected_version is not None:
+                return conflict(db, kind, record_id)
+            continue
+
+        departments = {row.department, changed.get("department", row.department)}
+        if kind == "teacher":
+            mark_changed(db, teachers=[record_id], departments=departments)
+            if "department" in changed:
+                # Группы преподавателя переходят на другую кафедру вместе с ним
+                mark_groups(db, stale_departments=departments)
+        else:
+            if "group_id" in changed:
+                move_seat(db, row.group_id, changed["group_id"])
+            mark_changed(db, students=[record_id], departments=departments, groups={row.group_id} - {None})
+        return {"type": "updated", "kind": kind, "id": record_id, "version": version, "changed": sorted(changed)}
+    raise ValueError("Record is being modified concurrently, try again")
+
+
+def move_seat(db: Session, old_group_id, new_group_id):
+    # Перевод студента: место в новой группе занимается тем же условным UPDATE, что и при зачислении
+    if placement.take_seat(db, new_group_id) is None:
+        raise ValueError("Group not found or full")
+    if old_group_id is not None:
+        placement.release_seat(db, old_group_id)
+
+
+@event.listens_for(SessionLocal, "before_flush")
+def _bump_versions(session, flush_context, instances):
+    # Изменения преподавателей и студентов через ORM тоже увеличивают версию (одним выражением в UPDATE)
+    for obj in session.dirty:
+        if isinstance(obj, (Teachers, Students)) and session.is_modified(obj, include_collections=False):
+            obj.version = type(obj).version + 1
@@ -0,0 +1,193 @@
+from sqlalchemy.orm import Session
+import base64
+import binascii
+import hashlib
+import os
+import re
+import sys
+import tempfile
+
+from .database import SessionLocal
+from .models import Teachers, Students
+from .log import get_logger, setup_logging
+
+logger = get_logger("photos")
+
+# Каталог хранилища фотографий: файлы лежат по SHA-256 содержимого, одинаковые фото хранятся один раз
+PHOTO_DIR = os.environ.get("PHOTO_DIR", "photos")
+PHOTO_MAX_BYTES = int(os.environ.get("PHOTO_MAX_BYTES", str(5 * 1024 * 1024)))
+THUMBNAIL_SIZE = int(os.environ.get("PHOTO_THUMBNAIL_SIZE", "160"))
+
+PHOTO_URL_PREFIX = "/photos/"
+
+_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+_DATA_URL_RE = re.compile(r"^data:([\w/+.-]+)?(;[\w=.-]+)*;base64,", re.IGNORECASE)
+
+# Сигнатуры поддерживаемых форматов
+_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+class PhotoError(ValueError):
+    pass
+
+
+def is_photo_hash(value: str):
+    return bool(_HASH_RE.match(value or ""))
+
+
+def photo_path(digest: str):
+    return os.path.join(PHOTO_DIR, digest[:2], digest)
+
+
+def thumbnail_path(digest: str):
+    return os.path.join(PHOTO_DIR, digest[:2], f"{digest}.thumb.jpg")
+
+
+def photo_url(digest: str):
+    return f"{PHOTO_URL_PREFIX}{digest}"
+
+
+def sniff_content_type(head: bytes):
+    for signature, content_type in _SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def content_type(digest: str):
+    with open(photo_path(digest), "rb") as f:
+        return sniff_content_type(f.read(16)) or "application/octet-stream"
+
+
+class PhotoWriter:
+    # Пишет фото во временный файл, считая хеш на лету; finish() переносит файл на место по хешу.
+    # Если такое содержимое уже есть, временный файл просто удаляется
+    def __init__(self):
+        os.makedirs(PHOTO_DIR, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=PHOTO_DIR, prefix=".upload-")
+        self.file = os.fdopen(fd, "wb")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > PHOTO_MAX_BYTES:
+            raise PhotoError(f"Photo is larger than {PHOTO_MAX_BYTES} bytes")
+        if len(self.head) < 16:
+            self.head += chunk[:16]
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def finish(self):
+        self.file.close()
+        if self.size == 0:
+            raise PhotoError("Photo is empty")
+        if sniff_content_type(self.head) is None:
+            raise PhotoError("Unsupported image format")
+
+        name = self.digest.hexdigest()
+        path = photo_path(name)
+        if os.path.exists(path):
+            os.unlink(self.tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.tmp_path, path)
+        make_thumbnail(name)
+        return name
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+
+def store_bytes(data: bytes):
+    writer = PhotoWriter()
+    try:
+        writer.write(data)
+        return writer.finish()
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def make_thumbnail(digest: str):
+    # Миниатюра строится Pillow; без него клиенты получают оригинал
+    path = thumbnail_path(digest)
+    if os.path.exists(path):
+        return path
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        with Image.open(photo_path(digest)) as image:
+            image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".thumb-")
+            with os.fdopen(fd, "wb") as tmp:
+                image.convert("RGB").save(tmp, "JPEG", quality=85)
+            os.replace(tmp_path, path)
+        return path
+    except OSError as e:
+        logger.warning("Не удалось построить миниатюру %s: %s", digest, e)
+        return None
+
+
+def photo_ref(value):
+    # Фото, пришедшее строкой data:...;base64, сохраняется в хранилище; в БД остаётся короткий URL
+    if not value or not isinstance(value, str) or not value.startswith("data:"):
+        return value
+    match = _DATA_URL_RE.match(value)
+    if not match:
+        raise PhotoError("Unsupported photo data URL")
+    try:
+        data = base64.b64decode(value[match.end():], validate=False)
+    except (binascii.Error, ValueError):
+        raise PhotoError("Invalid base64 in photo data URL")
+    return photo_url(store_bytes(data))
+
+
+def migrate_inline_photos(db: Session, batch_size: int = 100):
+    # Переносит фото, хранившиеся в таблицах как data URL, в хранилище; идёт пачками по id
+    migrated = 0
+    for model in (Teachers, Students):
+        last_id = 0
+        while True:
+            rows = (
+                db.query(model)
+                # Фото отчисленных студентов тоже переносятся: их записи остаются в таблице
+                .execution_options(include_deleted=True)
+                .filter(model.id > last_id, model.photo.like("data:%"))
+                .order_by(model.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            for row in rows:
+                try:
+                    row.photo = photo_ref(row.photo)
+                    migrated += 1
+                except PhotoError as e:
+                    logger.warning("%s %s: %s", model.__tablename__, row.id, e)
+            last_id = rows[-1].id
+            db.commit()
+    return migrated
+
+
+if __name__ == "__main__":
+    # python -m src.photos migrate
+    if sys.argv[1:] != ["migrate"]:
+        print("Использование: python -m src.photos migrate")
+        sys.exit(2)
+    setup_logging()
+    with SessionLocal() as db:
+        print(f"Перенесено фото: {migrate_inline_photos(db)}")
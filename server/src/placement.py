@@ -0,0 +1,335 @@
+from sqlalchemy import select, insert, update, delete, func
+from sqlalchemy.orm import Session
+
+from .models import Teachers, Students, Group
+from .changes import mark_changed
+from .capacity import GROUP_CAPACITY, capacity_cache, overlay, mark_groups
+
+
+def _next_group_name(teacher_id, names):
+    # Имя вида "Group <teacher_id>-<n>"; n пропускает номера, уже занятые (после удаления групп)
+    number = len(names) + 1
+    while f"Group {teacher_id}-{number}" in names:
+        number += 1
+    return f"Group {teacher_id}-{number}"
+
+
+def group_name(db: Session, teacher_id: int):
+    existing = {name for (name,) in db.query(Group.name).filter(Group.teacher_id == teacher_id)}
+    return _next_group_name(teacher_id, existing)
+
+
+def new_group(db: Session, teacher_id: int, student_count: int = 0, department: str = None):
+    # Строка преподавателя блокируется, чтобы параллельные транзакции не выбрали одно имя группы.
+    # С department преподаватель заодно проверяется (выбран по кэшу): если он уже не на этой кафедре, возвращается None
+    query = db.query(Teachers.id).filter(Teachers.id == teacher_id)
+    if department is not None:
+        query = query.filter(Teachers.department == department)
+    if query.with_for_update().first() is None and department is not None:
+        return None
+    group = Group(name=group_name(db, teacher_id), teacher_id=teacher_id, student_count=student_count)
+    db.add(group)
+    db.flush()
+    return group
+
+
+def _take_seat(db: Session, candidate):
+    # Занимает место в группе candidate (подзапрос), если оно ещё свободно; новое состояние группы попадёт в кэш
+    row = db.execute(
+        update(Group)
+        .where(Group.id == candidate, Group.student_count < GROUP_CAPACITY)
+        .values(student_count=Group.student_count + 1)
+        .returning(Group.id, Group.teacher_id, Group.student_count)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if row is not None:
+        mark_groups(db, {row.id: {"teacher_id": row.teacher_id, "student_count": row.student_count}})
+    return row
+
+
+def take_seat(db: Session, group_id: int):
+    # Занимает место в конкретной группе (перевод студента); None — группы нет или она заполнена
+    row = _take_seat(db, group_id)
+    return row.id if row is not None else None
+
+
+def reserve_seat(db: Session, department: str, group_id: int = None, wait: bool = False):
+    # Одним запросом находим первую группу кафедры со свободным местом и занимаем место в ней.
+    # Строка группы остаётся заблокированной до конца транзакции; группы, которые сейчас заполняют
+    # параллельные зачисления, пропускаются (SKIP LOCKED), поэтому десятое место не займут дважды.
+    # С wait=True заблокированные группы не пропускаются: запрос ждёт их транзакции и берёт место,
+    # если оно после неё осталось. group_id — группа, подсказанная кэшем: проверяется только она
+    candidate = (
+        select(Group.id)
+        .join(Teachers, Group.teacher_id == Teachers.id)
+        .where(Teachers.department == department, Group.student_count < GROUP_CAPACITY)
+    )
+    if group_id is not None:
+        candidate = candidate.where(Group.id == group_id)
+    candidate = candidate.order_by(Group.id).limit(1).with_for_update(of=Group, skip_locked=not wait).scalar_subquery()
+    row = _take_seat(db, candidate)
+    return row.id if row is not None else None
+
+
+def least_loaded_teacher(db: Session, department: str):
+    # Преподаватель кафедры с наименьшим числом групп (при равенстве — с меньшим id)
+    group_count = func.count(Group.id)
+    row = (
+        db.query(Teachers.id)
+        .outerjoin(Group, Group.teacher_id == Teachers.id)
+        .filter(Teachers.department == department)
+        .group_by(Teachers.id)
+        .order_by(group_count, Teachers.id)
+        .first()
+    )
+    return row.id if row else None
+
+
+def place_student(db: Session, department: str):
+    # Возвращает id группы с уже занятым местом для нового студента.
+    # Группа и преподаватель выбираются по кэшу вместимости, и обычно хватает одного UPDATE (или
+    # блокировки преподавателя и INSERT новой группы); если подсказка не подтвердилась (группу заполнил
+    # другой воркер или её сейчас заполняет параллельное зачисление), место ищется по БД, как без кэша.
+    # Новая группа открывается, только если свободных мест нет и по БД: кэш этого воркера может не знать
+    # о местах, освободившихся в других воркерах до очередной сверки
+    capacity = capacity_cache.get(db, department) if department is not None else None
+    hint = capacity.first_free(overlay(db)) if capacity is not None else None
+    group_id = reserve_seat(db, department, hint) if hint is not None else None
+    if group_id is None:
+        group_id = reserve_seat(db, department)
+        if group_id is None:
+            # SKIP LOCKED пропускает и группы, где после параллельного зачисления ещё останутся места:
+            # прежде чем открыть новую группу, дожидаемся их
+            group_id = reserve_seat(db, department, wait=True)
+        # Подсказка не подтвердилась или кэш считал кафедру заполненной, а место нашлось
+        if capacity is not None and (hint is not None or group_id is not None):
+            capacity_cache.reject()
+    if group_id is not None:
+        return group_id
+
+    # Все группы заполнены: открываем новую у преподавателя с наименьшим числом групп
+    if capacity is not None:
+        teacher_id = capacity.least_loaded(overlay(db))
+        if teacher_id is not None:
+            group = new_group(db, teacher_id, student_count=1, department=department)
+            if group is not None:
+                return group.id
+            capacity_cache.reject()
+    teacher_id = least_loaded_teacher(db, department)
+    if teacher_id is None:
+        raise ValueError("No teachers in the department")
+    return new_group(db, teacher_id, student_count=1).id
+
+
+def release_seat(db: Session, group_id: int):
+    # Освобождает место в группе и возвращает оставшееся число студентов
+    row = db.execute(
+        update(Group)
+        .where(Group.id == group_id)
+        .values(student_count=Group.student_count - 1)
+        .returning(Group.teacher_id, Group.student_count)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if row is None:
+        return None
+    mark_groups(db, {group_id: {"teacher_id": row.teacher_id, "student_count": row.student_count}})
+    return row.student_count
+
+
+def recount_groups(db: Session):
+    # Пересчитывает счётчики по таблице студентов (источник истины)
+    db.execute(
+        update(Group)
+        .values(student_count=select(func.count(Students.id)).where(Students.group_id == Group.id).scalar_subquery())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def plan_redistribution(db: Session, teacher_id: int, lock: bool = False):
+    # Строит полный план перевода студентов увольняемого преподавателя. Число запросов не зависит
+    # от числа студентов: преподаватели кафедры, группы получателей со счётчиками, переводимые студенты.
+    # Студенты распределяются по кругу между преподавателями в том же порядке, что и раньше
+    teacher = db.query(Teachers).filter(Teachers.id == teacher_id).first()
+    if not teacher:
+        raise ValueError("Teacher not found")
+
+    teacher_ids = [
+        row.id for row in db.query(Teachers.id)
+        .filter(Teachers.department == teacher.department, Teachers.id != teacher_id)
+        .order_by(Teachers.id)
+    ]
+    if not teacher_ids:
+        raise ValueError("No other teachers in the department")
+
+    # Группы получателей блокируются до конца транзакции, чтобы параллельные зачисления не заняли места из плана
+    groups_query = (
+        db.query(Group.id, Group.name, Group.teacher_id, Group.student_count)
+        .filter(Group.teacher_id.in_(teacher_ids))
+        .order_by(Group.id)
+    )
+    if lock:
+        groups_query = groups_query.with_for_update()
+    groups = {receiver: [] for receiver in teacher_ids}
+    names = {receiver: set() for receiver in teacher_ids}
+    for row in groups_query:
+        groups[row.teacher_id].append({"id": row.id, "name": row.name, "student_count": row.student_count})
+        names[row.teacher_id].add(row.name)
+
+    students = (
+        db.query(Students.id, Students.name, Group.name.label("group_name"))
+        .join(Group, Students.group_id == Group.id)
+        .filter(Group.teacher_id == teacher_id)
+        .order_by(Group.id, Students.id)
+        .all()
+    )
+    removed_groups = [row.name for row in db.query(Group.name).filter(Group.teacher_id == teacher_id).order_by(Group.id)]
+
+    moves = []
+    new_groups = []
+    for index, student in enumerate(students):
+        receiver = teacher_ids[index % len(teacher_ids)]
+        target = next((g for g in groups[receiver] if g["student_count"] < GROUP_CAPACITY), None)
+        if target is None:
+            # Свободных мест у преподавателя нет: в плане появляется новая группа
+            target = {"id": None, "name": _next_group_name(receiver, names[receiver]), "student_count": 0}
+            names[receiver].add(target["name"])
+            groups[receiver].append(target)
+            new_groups.append({"teacher_id": receiver, "group": target})
+        target["student_count"] += 1
+        moves.append({
+            "student_id": student.id,
+            "student_name": student.name,
+            "from_group": student.group_name,
+            "to_group": target["name"],
+            "to_group_id": target["id"],
+            "to_teacher_id": receiver,
+        })
+
+    targets = {move["to_group_id"] for move in moves}
+    return {
+        "teacher_id": teacher_id,
+        "department": teacher.department,
+        "moves": moves,
+        "new_groups": [
+            {"name": g["group"]["name"], "teacher_id": g["teacher_id"], "student_count": g["group"]["student_count"]}
+            for g in new_groups
+        ],
+        "removed_groups": removed_groups,
+        # Итоговое число студентов в существующих группах, куда переводятся студенты
+        "group_counts": {
+            g["id"]: g["student_count"]
+            for receiver_groups in groups.values() for g in receiver_groups
+            if g["id"] is not None and g["id"] in targets
+        },
+    }
+
+
+def apply_redistribution(db: Session, plan: dict, progress=None):
+    # Применяет план несколькими массовыми запросами; фиксирует транзакцию вызывающий код.
+    # progress(done, total) вызывается после перевода студентов каждой группы-получателя
+    group_ids = {}
+    if plan["new_groups"]:
+        group_ids.update(
+            (row.name, row.id)
+            for row in db.execute(insert(Group).returning(Group.id, Group.name), plan["new_groups"])
+        )
+
+    # Один UPDATE на каждую группу-получатель
+    by_group = {}
+    for move in plan["moves"]:
+        group_id = move["to_group_id"] if move["to_group_id"] is not None else group_ids[move["to_group"]]
+        by_group.setdefault(group_id, []).append(move["student_id"])
+    moved = 0
+    for group_id, student_ids in by_group.items():
+        db.execute(
+            update(Students).where(Students.id.in_(student_ids)).values(group_id=group_id, version=Students.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        moved += len(student_ids)
+        if progress is not None:
+            progress(moved, len(plan["moves"]))
+
+    # Новые значения счётчиков существующих групп (строки заблокированы при планировании)
+    if plan["group_counts"]:
+        db.execute(update(Group), [
+            {"id": group_id, "student_count": count} for group_id, count in plan["group_counts"].items()
+        ])
+
+    db.execute(
+        delete(Group).where(Group.teacher_id == plan["teacher_id"]).execution_options(synchronize_session=False)
+    )
+
+    mark_changed(
+        db,
+        teachers={plan["teacher_id"]} | {g["teacher_id"] for g in plan["new_groups"]},
+        students=[move["student_id"] for move in plan["moves"]],
+    )
+    # Группы кафедры меняются целиком: кэш вместимости перечитает её после фиксации
+    mark_groups(db, stale_departments={plan["department"]})
+
+
+def place_batch(db: Session, department: str, count: int):
+    # Те же правила, что у place_student, но сразу для count студентов одной кафедры:
+    # группы кафедры загружаются и блокируются один раз, места раздаются в памяти,
+    # новые группы и счётчики записываются массово. Возвращает id группы для каждого студента
+    teacher_ids = [
+        row.id for row in db.query(Teachers.id)
+        .filter(Teachers.department == department)
+        .order_by(Teachers.id)
+        .with_for_update()
+    ]
+    if not teacher_ids:
+        raise ValueError("No teachers in the department")
+
+    names = {teacher_id: set() for teacher_id in teacher_ids}
+    groups = []
+    for row in (
+        db.query(Group.id, Group.name, Group.teacher_id, Group.student_count)
+        .filter(Group.teacher_id.in_(teacher_ids))
+        .order_by(Group.id)
+        .with_for_update()
+    ):
+        names[row.teacher_id].add(row.name)
+        groups.append({"id": row.id, "name": row.name, "teacher_id": row.teacher_id, "student_count": row.student_count})
+
+    open_groups = [g for g in groups if g["student_count"] < GROUP_CAPACITY]
+    created = []
+    assigned = []
+    position = 0
+    for _ in range(count):
+        while position < len(open_groups) and open_groups[position]["student_count"] >= GROUP_CAPACITY:
+            position += 1
+        if position == len(open_groups):
+            # Все группы заполнены: новая группа у преподавателя с наименьшим числом групп
+            teacher_id = min(teacher_ids, key=lambda t: (len(names[t]), t))
+            group = {"id": None, "name": _next_group_name(teacher_id, names[teacher_id]), "teacher_id": teacher_id, "student_count": 0}
+            names[teacher_id].add(group["name"])
+            open_groups.append(group)
+            created.append(group)
+        group = open_groups[position]
+        group["student_count"] += 1
+        assigned.append(group)
+
+    if created:
+        ids = dict(
+            (row.name, row.id)
+            for row in db.execute(
+                insert(Group).returning(Group.id, Group.name),
+                [{"name": g["name"], "teacher_id": g["teacher_id"], "student_count": g["student_count"]} for g in created],
+            )
+        )
+        for group in created:
+            group["id"] = ids[group["name"]]
+        mark_changed(db, teachers={g["teacher_id"] for g in created})
+
+    # Счётчики существующих групп, в которые попали студенты (у новых они записаны при вставке)
+    created_keys = {id(g) for g in created}
+    touched = {id(g): g for g in assigned if id(g) not in created_keys}
+    if touched:
+        db.execute(update(Group), [{"id": g["id"], "student_count": g["student_count"]} for g in touched.values()])
+    mark_groups(db, {
+        g["id"]: {"teacher_id": g["teacher_id"], "student_count": g["student_count"]}
+        for g in created + list(touched.values())
+    })
+
+    return [group["id"] for group in assigned]
@@ -0,0 +1,227 @@
+from sqlalchemy import select, or_
+from sqlalchemy.orm import Session
+import gzip
+import json
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .models import Teachers, Students, Group
+from .changes import ChangeLog, Scope
+from . import metrics
+
+# Журнал ревизий состава, общий для всех подключений процесса
+roster_log = ChangeLog()
+
+
+# Столбцы, которые попадают в сообщения клиентам. Состав читается проекциями этих столбцов
+# (без ORM-объектов и ленивой загрузки связей): снимок любого размера — три запроса
+TEACHER_COLUMNS = (
+    Teachers.id, Teachers.uuid, Teachers.name, Teachers.department,
+    Teachers.photo, Teachers.date_of_birth, Teachers.created_at, Teachers.version,
+)
+STUDENT_COLUMNS = (
+    Students.id, Students.uuid, Students.name, Students.department, Students.group_id,
+    Group.name.label("group_name"), Students.photo, Students.date_of_birth, Students.created_at, Students.version,
+)
+
+
+# Кодировки сообщений /ws: json — списки записей (по умолчанию), columnar — JSON с одним массивом
+# на поле вместо повторения ключей в каждой записи, msgpack — тот же columnar в MessagePack (бинарные кадры)
+ENCODINGS = ("json", "columnar", "msgpack")
+
+
+def negotiate_encoding(requested):
+    # Неизвестная кодировка или msgpack без установленного пакета — обычный JSON
+    if requested == "msgpack" and msgpack is None:
+        return "json"
+    return requested if requested in ENCODINGS else "json"
+
+
+def _plain(value):
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def columnar(payload):
+    # {"teachers": [{"id": 1, "name": ...}, ...]} -> {"teachers": {"id": [1, ...], "name": [...]}}
+    result = dict(payload)
+    for key in ("teachers", "students"):
+        rows = payload.get(key)
+        if isinstance(rows, list):
+            result[key] = {field: [row[field] for row in rows] for field in rows[0]} if rows else {}
+            result["layout"] = "columnar"
+    return result
+
+
+def encode(payload, encoding="json"):
+    # json и columnar — строка, msgpack — байты.
+    # Даты и UUID orjson кодирует сам; без него — стандартный json.
+    # Числовые ключи (например, в плане перевода) превращаются в строки, как в json
+    if encoding != "json":
+        payload = columnar(payload)
+    if encoding == "msgpack":
+        return msgpack.packb(payload, default=_plain)
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(payload, default=_plain)
+
+
+def payload_size(message):
+    return len(message) if isinstance(message, bytes) else len(message.encode())
+
+
+def teacher_scope_filter(scope):
+    # Преподаватели кафедр подписки и преподаватели её групп
+    return or_(
+        Teachers.department.in_(scope.departments),
+        Teachers.id.in_(select(Group.teacher_id).where(Group.id.in_(scope.groups))),
+    )
+
+
+def student_scope_filter(scope):
+    return or_(Students.department.in_(scope.departments), Students.group_id.in_(scope.groups))
+
+
+def load_teachers(db: Session, ids=None, scope=None):
+    query = select(*TEACHER_COLUMNS).order_by(Teachers.id)
+    groups_query = select(Group.teacher_id, Group.name).order_by(Group.id)
+    if ids is not None:
+        query = query.where(Teachers.id.in_(ids))
+        groups_query = groups_query.where(Group.teacher_id.in_(ids))
+    if scope is not None:
+        query = query.where(teacher_scope_filter(scope))
+        groups_query = groups_query.where(Group.teacher_id.in_(select(Teachers.id).where(teacher_scope_filter(scope))))
+
+    teachers = [dict(row._mapping, groups=[]) for row in db.execute(query)]
+    by_id = {teacher["id"]: teacher for teacher in teachers}
+    for teacher_id, name in db.execute(groups_query):
+        if teacher_id in by_id:
+            by_id[teacher_id]["groups"].append(name)  # Список групп преподавателя
+    return teachers
+
+
+def load_students(db: Session, ids=None, scope=None):
+    query = (
+        select(*STUDENT_COLUMNS)
+        .outerjoin(Group, Students.group_id == Group.id)
+        .order_by(Students.id)
+    )
+    if ids is not None:
+        query = query.where(Students.id.in_(ids))
+    if scope is not None:
+        query = query.where(student_scope_filter(scope))
+    return [dict(row._mapping) for row in db.execute(query)]
+
+
+def resolve_scope(db: Session, departments=(), group_ids=()):
+    # Подписка на кафедры и группы; несуществующие группы пропускаются
+    groups = {}
+    if group_ids:
+        for group_id, name, department in db.execute(
+            select(Group.id, Group.name, Teachers.department)
+            .join(Teachers, Group.teacher_id == Teachers.id)
+            .where(Group.id.in_(group_ids))
+        ):
+            groups[group_id] = (name, department)
+    return Scope(departments, groups)
+
+
+def roster_snapshot(db: Session, scope=None):
+    return {
+        'teachers': load_teachers(db, scope=scope),
+        'students': load_students(db, scope=scope),
+    }
+
+def snapshot_message(db: Session, scope=None):
+    # Ревизию читаем до запроса: изменения, пришедшие во время чтения, придут дельтой ещё раз
+    revision = roster_log.revision
+    return {"type": "snapshot", "epoch": roster_log.epoch, "revision": revision, **roster_snapshot(db, scope)}
+
+class SnapshotCache:
+    # Закодированный снимок состава, помеченный ревизией журнала. Пока в журнал не добавлено
+    # новое изменение, все подключения (в том числе волна переподключений после деплоя)
+    # получают готовую строку из памяти; при следующей ревизии снимок строится заново один раз
+    def __init__(self, log):
+        self.log = log
+        self.key = None
+        self.payloads = {}
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, kind: str = "delta", compressed: bool = False, encoding: str = "json", scope=None):
+        # kind=delta — сообщение {"type": "snapshot", "epoch", "revision", ...}, snapshot — старый формат.
+        # Возвращает (ревизия, закодированный снимок) или (ревизия, gzip-байты) при compressed=True.
+        # Построение идёт под блокировкой: одновременные запросы ждут один запрос к БД, а не делают свои.
+        # Снимок читается из БД один раз на ревизию и подписку, в остальные кодировки перекодируется из памяти
+        with self._lock:
+            key = (self.log.epoch, self.log.revision)
+            if key != self.key:
+                self.key = key
+                self.payloads = {}
+                self.entries = {}
+            scope_key = scope.key if scope is not None else None
+            entry = self.entries.get((kind, encoding, scope_key))
+            if entry is None:
+                self.misses += 1
+                payload = self.payloads.get((kind, scope_key))
+                if payload is None:
+                    payload = snapshot_message(db, scope) if kind == "delta" else roster_snapshot(db, scope)
+                    self.payloads[(kind, scope_key)] = payload
+                entry = self.entries[(kind, encoding, scope_key)] = {"data": encode(payload, encoding), "gzip": None}
+                metrics.PAYLOAD_BYTES.observe(
+                    payload_size(entry["data"]),
+                    kind="snapshot" if kind == "delta" else "legacy_snapshot", encoding=encoding,
+                )
+            else:
+                self.hits += 1
+            if compressed and entry["gzip"] is None:
+                data = entry["data"]
+                entry["gzip"] = gzip.compress(data if isinstance(data, bytes) else data.encode(), compresslevel=6)
+            return key[1], entry["gzip"] if compressed else entry["data"]
+
+snapshot_cache = SnapshotCache(roster_log)
+
+def record_changes(db: Session, changes):
+    # Загружаем затронутые записи и добавляем изменение в журнал ревизий
+    teacher_ids = changes.upserted_teachers()
+    student_ids = changes.upserted_students()
+    teachers = load_teachers(db, teacher_ids) if teacher_ids else []
+    students = load_students(db, student_ids) if student_ids else []
+
+    # Строки, которых уже нет в БД (например, удалённые каскадом), считаем удалёнными
+    missing_teachers = teacher_ids - {t["id"] for t in teachers}
+    missing_students = student_ids - {s["id"] for s in students}
+    deleted_teachers = (changes.deleted_teachers | missing_teachers) - {None}
+    deleted_students = (changes.deleted_students | missing_students) - {None}
+
+    # Кафедры изменения: прежние (из отслеживания изменений) и текущие (по загруженным строкам).
+    # Кафедры записей, удалённых каскадом, неизвестны — такое изменение получат все подписки
+    # Подписки на группы маршрутизируются по кафедре преподавателя группы, поэтому добавляем и её
+    departments = None
+    if not (changes.departments_unknown or missing_teachers or missing_students):
+        departments = (changes.departments | {row["department"] for row in teachers + students}) - {None}
+        group_ids = (changes.groups | {row["group_id"] for row in students}) - {None}
+        if group_ids:
+            departments |= set(db.scalars(
+                select(Teachers.department).distinct()
+                .join(Group, Group.teacher_id == Teachers.id)
+                .where(Group.id.in_(group_ids), Teachers.department.is_not(None))
+            ))
+
+    return roster_log.append(
+        teachers,
+        students,
+        deleted_teachers,
+        deleted_students,
+        departments,
+    )
@@ -0,0 +1,201 @@
+from sqlalchemy import select, func, case, literal, or_, and_
+from sqlalchemy.orm import Session
+import bisect
+import os
+import re
+import threading
+
+from .models import Teachers, Students, Group
+from .changes import commit_hooks
+from .roster import roster_log
+
+# Результатов поиска по умолчанию и максимум
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+# Запросы короче не выполняются: по одной букве совпадает слишком много записей
+SEARCH_MIN_LENGTH = 2
+SEARCH_TYPES = ("student", "teacher")
+
+# auto — триграммный поиск в PostgreSQL (индексы GIN pg_trgm) и префиксный индекс в памяти для других БД
+# (SQLite в тестах); memory — всегда индекс в памяти
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "auto")
+
+# Вес совпадения в кафедре и названии группы относительно совпадения в имени
+SECONDARY_WEIGHT = 0.5
+
+WORD = re.compile(r"\w+")
+
+
+def parse_query(q: str):
+    q = " ".join((q or "").split())
+    if len(q) < SEARCH_MIN_LENGTH:
+        raise ValueError(f"Query must be at least {SEARCH_MIN_LENGTH} characters")
+    return q
+
+
+def parse_types(types: str):
+    if not types:
+        return SEARCH_TYPES
+    names = tuple(name.strip() for name in types.split(",") if name.strip())
+    unknown = [name for name in names if name not in SEARCH_TYPES]
+    if unknown:
+        raise ValueError(f"Unknown types: {', '.join(unknown)}")
+    return names
+
+
+def student_item(row, score):
+    return {
+        "type": "student", "id": row.id, "name": row.name, "department": row.department,
+        "group_id": row.group_id, "group_name": row.group_name, "score": round(score, 3),
+    }
+
+
+def teacher_item(row, score):
+    return {"type": "teacher", "id": row.id, "name": row.name, "department": row.department, "score": round(score, 3)}
+
+
+def ranked(items, limit):
+    # Лучшие совпадения первыми; при равенстве — по имени и id, чтобы порядок был стабильным
+    items.sort(key=lambda item: (-item["score"], item["name"].lower(), item["type"], item["id"]))
+    return items[:limit]
+
+
+# PostgreSQL: каждое слово запроса должно встретиться (ILIKE '%слово%') в имени, кафедре или названии группы —
+# такие условия выполняются по индексам GIN gin_trgm_ops. Опечатки в имени находит оператор <% (word_similarity).
+# Ранг: сходство с именем, плюс 1 за совпадение начала имени, плюс половина сходства с кафедрой и группой
+
+def like_escape(value):
+    return value.replace("/", "//").replace("%", "/%").replace("_", "/_")
+
+
+def _pg_match(words, columns):
+    # Шаблон — одна константа, чтобы планировщик выбрал триграммный индекс
+    return and_(*[
+        or_(*[column.ilike(f"%{like_escape(word)}%", escape="/") for column in columns]) for word in words
+    ])
+
+
+def _pg_score(q, name, secondary):
+    score = func.word_similarity(q, name) + case((name.ilike(f"{like_escape(q)}%", escape="/"), 1.0), else_=0.0)
+    for column in secondary:
+        score = score + SECONDARY_WEIGHT * func.coalesce(func.word_similarity(q, column), 0.0)
+    return score
+
+
+def _pg_search(db: Session, q, types, department, limit):
+    words = WORD.findall(q) or [q]
+    items = []
+    if "student" in types:
+        columns = (Students.name, Students.department, Group.name)
+        score = _pg_score(q, Students.name, columns[1:]).label("score")
+        query = (
+            select(Students.id, Students.name, Students.department, Students.group_id, Group.name.label("group_name"), score)
+            .outerjoin(Group, Students.group_id == Group.id)
+            .where(or_(_pg_match(words, columns), literal(q).op("<%")(Students.name)))
+        )
+        if department:
+            query = query.where(Students.department == department)
+        rows = db.execute(query.order_by(score.desc(), Students.id).limit(limit)).all()
+        items += [student_item(row, row.score) for row in rows]
+    if "teacher" in types:
+        columns = (Teachers.name, Teachers.department)
+        score = _pg_score(q, Teachers.name, columns[1:]).label("score")
+        query = (
+            select(Teachers.id, Teachers.name, Teachers.department, score)
+            .where(or_(_pg_match(words, columns), literal(q).op("<%")(Teachers.name)))
+        )
+        if department:
+            query = query.where(Teachers.department == department)
+        rows = db.execute(query.order_by(score.desc(), Teachers.id).limit(limit)).all()
+        items += [teacher_item(row, row.score) for row in rows]
+    return ranked(items, limit)
+
+
+class PrefixIndex:
+    # Индекс в памяти для БД без pg_trgm: отсортированный список слов имён, кафедр и названий групп.
+    # Записи, слова которых начинаются с префикса, находятся bisect'ом. Индекс строится заново
+    # при первом поиске после изменения состава (новая ревизия журнала или фиксация в этом процессе)
+    def __init__(self, log):
+        self.log = log
+        self.key = None
+        self.generation = 0
+        self.words = []
+        self.records = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, changes=None):
+        # Обработчик фиксации транзакции
+        if changes is None or changes:
+            with self._lock:
+                self.generation += 1
+
+    def _build(self, db: Session):
+        records, words = {}, []
+        students = db.execute(
+            select(Students.id, Students.name, Students.department, Students.group_id, Group.name.label("group_name"))
+            .outerjoin(Group, Students.group_id == Group.id)
+        ).all()
+        teachers = db.execute(select(Teachers.id, Teachers.name, Teachers.department)).all()
+        for kind, rows in (("student", students), ("teacher", teachers)):
+            for row in rows:
+                records[(kind, row.id)] = row
+                fields = [("name", row.name), ("department", row.department)]
+                if kind == "student":
+                    fields.append(("group", row.group_name))
+                for field, value in fields:
+                    for word in WORD.findall((value or "").lower()):
+                        words.append((word, kind, row.id, field))
+        words.sort()
+        self.records, self.words = records, words
+
+    def _lookup(self, prefix):
+        # {(тип, id): поля, в которых есть слово с началом prefix}
+        found = {}
+        position = bisect.bisect_left(self.words, (prefix,))
+        while position < len(self.words) and self.words[position][0].startswith(prefix):
+            word, kind, record_id, field = self.words[position]
+            found.setdefault((kind, record_id), set()).add(field)
+            position += 1
+        return found
+
+    def search(self, db: Session, q, types, department, limit):
+        with self._lock:
+            key = (self.log.epoch, self.log.revision, self.generation)
+            if key != self.key:
+                self._build(db)
+                self.key = key
+            words = WORD.findall(q.lower()) or [q.lower()]
+            matches = None
+            for word in words:
+                found = self._lookup(word)
+                if matches is None:
+                    matches = found
+                else:
+                    matches = {record: matches[record] | fields for record, fields in found.items() if record in matches}
+            items = []
+            for (kind, record_id), fields in (matches or {}).items():
+                row = self.records[(kind, record_id)]
+                if kind not in types or (department and row.department != department):
+                    continue
+                # Та же шкала, что у триграммного поиска: имя, начало имени, кафедра и группа
+                score = (1.0 if "name" in fields else 0.0) + (1.0 if row.name.lower().startswith(q.lower()) else 0.0)
+                score += SECONDARY_WEIGHT * len(fields - {"name"})
+                items.append(student_item(row, score) if kind == "student" else teacher_item(row, score))
+        return ranked(items, limit)
+
+
+prefix_index = PrefixIndex(roster_log)
+commit_hooks.append(prefix_index.invalidate)
+
+
+def search(db: Session, q: str, types: str = None, department: str = None, limit: int = SEARCH_DEFAULT_LIMIT):
+    # Поиск студентов и преподавателей по имени, кафедре и названию группы для подсказок при вводе.
+    # Возвращает лёгкие записи (без фото и дат) с рангом score, лучшие первыми
+    q = parse_query(q)
+    types = parse_types(types)
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    if SEARCH_BACKEND == "auto" and db.get_bind().dialect.name == "postgresql":
+        items = _pg_search(db, q, types, department, limit)
+    else:
+        items = prefix_index.search(db, q, types, department, limit)
+    return {"items": items}
@@ -0,0 +1,278 @@
+from sqlalchemy import select, update, insert, func, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from datetime import datetime
+
+from .models import Teachers, Students, Request, Stage, RequestCount
+from .listing import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, encode_cursor, decode_cursor
+
+# Статусы заявки: open — создана, in_progress — прошла хотя бы один этап, done и cancelled — закрыта
+REQUEST_STATUSES = ("open", "in_progress", "done", "cancelled")
+CLOSED_STATUSES = ("done", "cancelled")
+# Этап, с которого начинается заявка, если не указан другой
+DEFAULT_STAGE = "new"
+# Сколько заявок можно создать или перевести одним запросом
+MAX_BATCH_SIZE = 1000
+
+
+def request_info(row):
+    return {
+        "id": row.id,
+        "teacher_id": row.teacher_id,
+        "student_id": row.student_id,
+        "status": row.status,
+        "stage": row.stage,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+        "updated_at": row.updated_at.isoformat() if row.updated_at else None,
+    }
+
+
+def stage_info(stage: Stage):
+    return {
+        "id": stage.id,
+        "stage": stage.stage_name,
+        "status": stage.status,
+        "started_at": stage.started_at.isoformat() if stage.started_at else None,
+        "completed_at": stage.completed_at.isoformat() if stage.completed_at else None,
+    }
+
+
+def count_key(teacher_id, status, stage):
+    # Ключ строки request_counts: в первичном ключе нет NULL
+    return (teacher_id or 0, status, stage or "")
+
+
+def apply_counts(db: Session, deltas: dict):
+    # Прибавляет к счётчикам {(teacher_id, status, stage): изменение} одним запросом (UPSERT пачкой)
+    # в транзакции вызывающего, поэтому счётчики меняются вместе с заявками
+    rows = [
+        {"teacher_id": teacher_id, "status": status, "stage": stage, "total": delta}
+        for (teacher_id, status, stage), delta in deltas.items() if delta
+    ]
+    if not rows:
+        return
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    statement = dialect.insert(RequestCount)
+    statement = statement.on_conflict_do_update(
+        index_elements=[RequestCount.teacher_id, RequestCount.status, RequestCount.stage],
+        set_={"total": RequestCount.total + statement.excluded.total},
+    )
+    db.execute(statement, rows)
+
+
+def add_count(deltas: dict, key, delta):
+    deltas[key] = deltas.get(key, 0) + delta
+
+
+def recount_requests(db: Session):
+    # Пересчитывает счётчики по таблице заявок (источник истины)
+    db.query(RequestCount).delete(synchronize_session=False)
+    rows = db.execute(
+        select(Request.teacher_id, Request.status, Request.stage, func.count(Request.id))
+        .group_by(Request.teacher_id, Request.status, Request.stage)
+    ).all()
+    deltas = {}
+    for teacher_id, status, stage, total in rows:
+        add_count(deltas, count_key(teacher_id, status, stage), total)
+    apply_counts(db, deltas)
+
+
+def create_requests(db: Session, items: list):
+    # Создаёт заявки [{"teacher_id", "student_id", "stage"}] с первым активным этапом.
+    # Число запросов не зависит от числа заявок: проверка ссылок, вставка заявок, вставка этапов, счётчики
+    if not items:
+        return []
+    if len(items) > MAX_BATCH_SIZE:
+        raise ValueError(f"At most {MAX_BATCH_SIZE} requests per batch")
+    teacher_ids = {item.get("teacher_id") for item in items} - {None}
+    student_ids = {item.get("student_id") for item in items} - {None}
+    if any(item.get("teacher_id") is None and item.get("student_id") is None for item in items):
+        raise ValueError("Request needs a teacher or a student")
+    if teacher_ids and len(db.scalars(select(Teachers.id).where(Teachers.id.in_(teacher_ids))).all()) < len(teacher_ids):
+        raise ValueError("Teacher not found")
+    if student_ids and len(db.scalars(select(Students.id).where(Students.id.in_(student_ids))).all()) < len(student_ids):
+        raise ValueError("Student not found")
+
+    values = [
+        {
+            "teacher_id": item.get("teacher_id"),
+            "student_id": item.get("student_id"),
+            "status": "open",
+            "stage": item.get("stage") or DEFAULT_STAGE,
+        }
+        for item in items
+    ]
+    rows = db.execute(
+        insert(Request).returning(Request, sort_by_parameter_order=True), values
+    ).scalars().all()
+    db.execute(insert(Stage), [{"request_id": row.id, "stage_name": row.stage, "status": "active"} for row in rows])
+
+    deltas = {}
+    for row in rows:
+        add_count(deltas, count_key(row.teacher_id, row.status, row.stage), 1)
+    apply_counts(db, deltas)
+    return [request_info(row) for row in rows]
+
+
+def transition(db: Session, request_ids: list, stage: str = None, status: str = None):
+    # Переводит пачку заявок на этап stage и/или в статус status. Текущий активный этап закрывается,
+    # новый открывается; заявка без явного статуса после первого перехода становится in_progress.
+    # Запросов на пачку — постоянное число: блокировка заявок, закрытие этапов, вставка этапов,
+    # обновление заявок (по запросу на итоговый статус) и счётчики
+    if stage is None and status is None:
+        raise ValueError("stage or status is required")
+    if status is not None and status not in REQUEST_STATUSES:
+        raise ValueError(f"Unknown status: {status}")
+    if stage is not None and status in CLOSED_STATUSES:
+        raise ValueError("A closed request has no next stage")
+    ids = sorted(set(request_ids))
+    if len(ids) > MAX_BATCH_SIZE:
+        raise ValueError(f"At most {MAX_BATCH_SIZE} requests per batch")
+    if not ids:
+        return {"updated": [], "skipped": []}
+
+    # Блокировка в порядке id: параллельные пачки с пересекающимися заявками не блокируют друг друга взаимно
+    rows = db.execute(
+        select(Request.id, Request.teacher_id, Request.status, Request.stage)
+        .where(Request.id.in_(ids)).order_by(Request.id).with_for_update()
+    ).all()
+    found = {row.id for row in rows}
+    skipped = [{"id": request_id, "error": "Request not found"} for request_id in ids if request_id not in found]
+    skipped += [{"id": row.id, "error": "Request is closed"} for row in rows if row.status in CLOSED_STATUSES]
+    rows = [row for row in rows if row.status not in CLOSED_STATUSES]
+    if not rows:
+        return {"updated": [], "skipped": skipped}
+    moved = [row.id for row in rows]
+
+    if stage is not None or status in CLOSED_STATUSES:
+        db.execute(
+            update(Stage)
+            .where(Stage.request_id.in_(moved), Stage.status == "active")
+            .values(status="cancelled" if status == "cancelled" else "completed", completed_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+    if stage is not None:
+        db.execute(insert(Stage), [{"request_id": request_id, "stage_name": stage, "status": "active"} for request_id in moved])
+
+    by_status = {}
+    deltas = {}
+    for row in rows:
+        new_status = status or ("in_progress" if row.status == "open" else row.status)
+        by_status.setdefault(new_status, []).append(row.id)
+        add_count(deltas, count_key(row.teacher_id, row.status, row.stage), -1)
+        add_count(deltas, count_key(row.teacher_id, new_status, stage or row.stage), 1)
+    for new_status, request_ids in by_status.items():
+        values = {"status": new_status}
+        if stage is not None:
+            values["stage"] = stage
+        db.execute(
+            update(Request).where(Request.id.in_(request_ids)).values(**values)
+            .execution_options(synchronize_session=False)
+        )
+    apply_counts(db, deltas)
+    return {"updated": moved, "skipped": skipped}
+
+
+def detach_teacher(db: Session, teacher_id: int):
+    # Перед удалением преподавателя его заявки остаются без преподавателя (как сделал бы ORM),
+    # но одним UPDATE, а их счётчики переходят к заявкам без преподавателя
+    rows = db.execute(
+        select(Request.status, Request.stage, func.count(Request.id))
+        .where(Request.teacher_id == teacher_id)
+        .group_by(Request.status, Request.stage)
+    ).all()
+    if not rows:
+        return 0
+    db.execute(
+        update(Request).where(Request.teacher_id == teacher_id).values(teacher_id=None)
+        .execution_options(synchronize_session=False)
+    )
+    deltas = {}
+    for status, stage, total in rows:
+        add_count(deltas, count_key(teacher_id, status, stage), -total)
+        add_count(deltas, count_key(None, status, stage), total)
+    apply_counts(db, deltas)
+    return sum(total for _, _, total in rows)
+
+
+def get_request(db: Session, request_id: int):
+    request = db.query(Request).filter(Request.id == request_id).first()
+    if request is None:
+        return None
+    info = request_info(request)
+    stages = db.query(Stage).filter(Stage.request_id == request_id).order_by(Stage.id)
+    info["stages"] = [stage_info(stage) for stage in stages]
+    return info
+
+
+def list_requests(
+    db: Session,
+    status: str = None,
+    teacher_id: int = None,
+    student_id: int = None,
+    stage: str = None,
+    order: str = "desc",
+    cursor: str = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+):
+    # Входящие: заявки по статусу, преподавателю, студенту и этапу в порядке updated_at, id
+    # (по умолчанию — сначала недавно изменённые). Пагинация по курсору, как у списка студентов;
+    # выборка по статусу идёт по индексам (status | teacher_id, status | student_id, status), updated_at, id
+    if order not in ("asc", "desc"):
+        raise ValueError("order must be asc or desc")
+    if status is not None and status not in REQUEST_STATUSES:
+        raise ValueError(f"Unknown status: {status}")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    descending = order == "desc"
+
+    query = select(
+        Request.id, Request.teacher_id, Request.student_id, Request.status, Request.stage,
+        Request.created_at, Request.updated_at,
+    )
+    if status:
+        query = query.where(Request.status == status)
+    if teacher_id:
+        query = query.where(Request.teacher_id == teacher_id)
+    if student_id:
+        query = query.where(Request.student_id == student_id)
+    if stage:
+        query = query.where(Request.stage == stage)
+
+    if cursor:
+        value, last_id = decode_cursor(cursor, "updated_at")
+        try:
+            value = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+        key, position = tuple_(Request.updated_at, Request.id), tuple_(value, last_id)
+        query = query.where(key < position if descending else key > position)
+
+    if descending:
+        query = query.order_by(Request.updated_at.desc(), Request.id.desc())
+    else:
+        query = query.order_by(Request.updated_at, Request.id)
+
+    # Лишняя строка показывает, есть ли следующая страница
+    rows = db.execute(query.limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor("updated_at", rows[-1].updated_at, rows[-1].id)
+    return {"items": [request_info(row) for row in rows], "next_cursor": next_cursor}
+
+
+def request_counts(db: Session, teacher_id: int = None):
+    # Число заявок по статусам и открытых заявок по этапам — из счётчиков, без подсчёта самих заявок
+    query = select(RequestCount.status, RequestCount.stage, func.sum(RequestCount.total)).group_by(
+        RequestCount.status, RequestCount.stage
+    )
+    if teacher_id is not None:
+        query = query.where(RequestCount.teacher_id == teacher_id)
+    by_status, by_stage = {status: 0 for status in REQUEST_STATUSES}, {}
+    for status, stage, total in db.execute(query):
+        if not total:
+            continue
+        by_status[status] = by_status.get(status, 0) + total
+        if status not in CLOSED_STATUSES and stage:
+            by_stage[stage] = by_stage.get(stage, 0) + total
+    return {"total": sum(by_status.values()), "by_status": by_status, "by_stage": by_stage}
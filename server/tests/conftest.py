@@ -0,0 +1,76 @@
+# Тесты идут на SQLite: окружение задаётся до первого импорта src (движок создаётся при импорте)
+import os
+import shutil
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp(prefix="roster-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{TEST_DIR}/roster.db"
+os.environ["PHOTO_DIR"] = os.path.join(TEST_DIR, "photos")
+os.environ["IMPORT_SPOOL_DIR"] = os.path.join(TEST_DIR, "imports")
+os.environ["CAPACITY_RECONCILE_SECONDS"] = "0"
+os.environ["ARCHIVE_COMPACT_SECONDS"] = "0"
+os.environ["JOB_POLL_SECONDS"] = "0.05"
+os.environ["JOB_WORKERS"] = "1"
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from src.database import Base, engine, SessionLocal
+
+
+@event.listens_for(engine, "connect")
+def _sqlite_connect(dbapi_connection, connection_record):
+    # Транзакции открывает SQLAlchemy (BEGIN ниже), а не драйвер: иначе pysqlite ломает SAVEPOINT.
+    # WAL и ожидание блокировки — для фоновых заданий, пишущих параллельно с тестом
+    dbapi_connection.isolation_level = None
+    dbapi_connection.execute("PRAGMA busy_timeout=30000")
+    dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+
+@event.listens_for(engine, "begin")
+def _sqlite_begin(conn):
+    conn.exec_driver_sql("BEGIN")
+
+
+from src import main, migrate  # noqa: E402
+from src.capacity import capacity_cache  # noqa: E402
+from src.idempotency import idempotency_cache  # noqa: E402
+from src.roster import roster_log  # noqa: E402
+
+migrate.migrate(engine)
+
+
+def pytest_unconfigure(config):
+    engine.dispose()
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+
+@pytest.fixture(autouse=True)
+def clean_database():
+    # Каждый тест начинает с пустой БД и пустых кэшей процесса
+    yield
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    capacity_cache.invalidate()
+    roster_log.invalidate()
+    with idempotency_cache._lock:
+        idempotency_cache.entries.clear()
+        idempotency_cache.pending.clear()
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def client():
+    # С запуском lifespan: хаб, кэш вместимости и исполнитель фоновых заданий
+    with TestClient(main.app) as test_client:
+        yield test_client
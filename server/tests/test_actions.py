@@ -0,0 +1,145 @@
+import pytest
+
+from src import main
+from src.capacity import GROUP_CAPACITY
+from src.changes import pop_committed
+from src.idempotency import IdempotencyCache, PENDING, idempotency_cache
+from src.models import Teachers, Students, Group
+from src.patches import patch_record
+
+
+def create(kind, name, department="A", **extra):
+    return {"action": "create", "type": kind, "name": name, "department": department, **extra}
+
+
+def run(db, *actions, client="c1"):
+    return main.run_actions(db, list(actions), "delta", client=client)
+
+
+@pytest.fixture
+def student(db):
+    run(db, create("teacher", "T"), create("student", "S"))
+    pop_committed(db)
+    return db.query(Students).one()
+
+
+def test_failed_action_rolls_back_only_itself(db, monkeypatch):
+    original = main.handle_action
+
+    def half_done(db, request_data, protocol, scope=None):
+        reply = original(db, request_data, protocol, scope)
+        if request_data.get("name") == "Half":
+            raise ValueError("half done")
+        return reply
+
+    monkeypatch.setattr(main, "handle_action", half_done)
+    results = run(db, create("teacher", "T"), create("teacher", "Half"), "oops", create("student", "S"))
+
+    assert [error for _, error in results] == [None, "half done", "Invalid action format", None]
+    # INSERT преподавателя Half уже выполнился, но откатился вместе со своим SAVEPOINT
+    assert [name for (name,) in db.query(Teachers.name)] == ["T"]
+    student = db.query(Students).one()
+    changes = pop_committed(db)
+    assert changes.upserted_teachers() == {student.group.teacher_id}
+    assert changes.upserted_students() == {student.id}
+
+
+def test_failed_update_rolls_back_only_itself(db, student):
+    full = Group(name="Full", teacher_id=student.group.teacher_id, student_count=GROUP_CAPACITY)
+    db.add(full)
+    db.commit()
+    pop_committed(db)
+
+    results = run(
+        db,
+        {"action": "update", "type": "student", "id": student.id, "name": "Moved", "groupId": full.id},
+        create("teacher", "T2"),
+        {"action": "update", "type": "student", "id": 999, "name": "x"},
+    )
+
+    assert [error for _, error in results] == ["Group not found or full", None, "Record not found"]
+    db.expire_all()
+    # UPDATE студента уже выполнился, но откатился вместе со своим SAVEPOINT
+    assert (student.name, student.group_id, student.version) == ("S", student.group.id, 1)
+    assert db.get(Group, full.id).student_count == GROUP_CAPACITY
+    assert sorted(name for (name,) in db.query(Teachers.name)) == ["T", "T2"]
+    changes = pop_committed(db)
+    assert changes.upserted_students() == set()
+    assert changes.upserted_teachers() == {db.query(Teachers.id).filter(Teachers.name == "T2").scalar()}
+
+
+def test_unexpected_error_rolls_back_whole_batch(db, monkeypatch):
+    original = main.handle_action
+
+    def failing(db, request_data, protocol, scope=None):
+        if request_data.get("name") == "boom":
+            raise RuntimeError("boom")
+        return original(db, request_data, protocol, scope)
+
+    monkeypatch.setattr(main, "handle_action", failing)
+    with pytest.raises(RuntimeError):
+        run(db, create("teacher", "T", requestId="r1"), create("teacher", "boom"))
+    assert db.query(Teachers).count() == 0
+    assert pop_committed(db).upserted_teachers() == set()
+    # Ключ действия освобождён: повтор выполнится заново
+    monkeypatch.setattr(main, "handle_action", original)
+    assert run(db, create("teacher", "T", requestId="r1")) == [({"type": "ack", "requestId": "r1"}, None)]
+
+
+def test_patch_record_conflict(db, student):
+    reply = patch_record(db, "student", student.id, {"name": "First"}, expected_version=1)
+    db.commit()
+    assert (reply["version"], reply["changed"]) == (2, ["name"])
+
+    # Клиент правил по устаревшей версии: получает текущую запись
+    reply = patch_record(db, "student", student.id, {"name": "Second"}, expected_version=1)
+    assert reply["type"] == "conflict"
+    assert reply["version"] == 2 and reply["current"]["name"] == "First"
+
+    # Без изменений запись и версия остаются прежними
+    reply = patch_record(db, "student", student.id, {"name": "First"})
+    assert (reply["version"], reply["changed"]) == (2, [])
+
+
+def test_retried_request_is_replayed(db, student):
+    action = {"action": "update", "type": "student", "id": student.id, "name": "Once", "requestId": "u1"}
+    [(first, _)] = run(db, action)
+    # Повтор с тем же ключом не выполняется заново, даже если запись с тех пор изменили
+    patch_record(db, "student", student.id, {"name": "Other"})
+    db.commit()
+    [(second, _)] = run(db, action)
+    assert second == dict(first, duplicate=True)
+    db.expire_all()
+    assert db.get(Students, student.id).name == "Other"
+
+    # Тот же requestId другого клиента — другое действие
+    [(third, _)] = run(db, action, client="c2")
+    assert "duplicate" not in third and third["changed"] == ["name"]
+
+
+def test_duplicate_inside_batch_is_rejected(db, student):
+    action = {"action": "update", "type": "student", "id": student.id, "name": "Once", "requestId": "b1"}
+    results = run(db, action, dict(action, name="Twice"))
+    assert [error for _, error in results] == [None, "Duplicate request in progress"]
+    assert idempotency_cache.pending == set()
+
+
+def test_cache_eviction_keeps_pending_keys():
+    cache = IdempotencyCache(ttl=60, max_keys=2)
+    assert cache.begin("running") is None
+    for key in ("a", "b", "c"):
+        assert cache.begin(key) is None
+        cache.finish(key, {"key": key})
+    # Завершённые ответы вытесняются по порядку, выполняющееся действие — нет
+    assert list(cache.entries) == ["b", "c"]
+    assert cache.begin("running") is PENDING
+    assert cache.begin("a") is None
+    cache.discard("running")
+    assert cache.begin("running") is None
+
+
+def test_cache_expires_replies():
+    cache = IdempotencyCache(ttl=0, max_keys=10)
+    cache.begin("a")
+    cache.finish("a", {"type": "ack"})
+    assert cache.begin("a") is None
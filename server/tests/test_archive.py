@@ -0,0 +1,59 @@
+from sqlalchemy import select, update
+
+from src import photos
+from src.archive import expel_student
+from src.main import enroll_student
+from src.models import Teachers, Students, Group
+
+PIXEL = (
+    "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+
+def enroll(db, *names):
+    teacher = Teachers(name="T", department="A")
+    db.add(teacher)
+    db.flush()
+    students = [enroll_student(db, {"name": name, "department": "A", "teacher_id": teacher.id}) for name in names]
+    db.commit()
+    return students
+
+
+def test_expelled_student_is_hidden_from_orm_queries(db):
+    kept, expelled = enroll(db, "Kept", "Expelled")
+    group_id = kept.group_id
+    expel_student(db, expelled.id)
+    db.commit()
+    db.expunge_all()
+
+    assert [s.name for s in db.query(Students)] == ["Kept"]
+    assert db.get(Group, group_id).student_count == 1
+    assert [s.name for s in db.get(Group, group_id).students] == ["Kept"]
+    # UPDATE через ORM отчисленного не задевает
+    db.execute(update(Students).values(name="Renamed"))
+    db.commit()
+    rows = db.execute(select(Students.name, Students.deleted_at).execution_options(include_deleted=True).order_by(Students.id))
+    assert [(name, deleted_at is not None) for name, deleted_at in rows] == [("Renamed", False), ("Expelled", True)]
+
+
+def test_last_student_closes_group(db):
+    [student] = enroll(db, "Only")
+    result = expel_student(db, student.id)
+    db.commit()
+    assert result["group_closed"] is True
+    assert db.query(Group).count() == 0
+    assert db.query(Group).execution_options(include_deleted=True).count() == 1
+    # Название закрытой группы снова свободно
+    [again] = enroll(db, "Next")
+    assert again.group.name == f"Group {again.group.teacher_id}-1"
+
+
+def test_inline_photos_of_expelled_students_are_migrated(db):
+    [student] = enroll(db, "Expelled")
+    expel_student(db, student.id)
+    db.execute(update(Students).execution_options(include_deleted=True).values(photo=PIXEL))
+    db.commit()
+
+    assert photos.migrate_inline_photos(db) == 1
+    photo = db.scalar(select(Students.photo).execution_options(include_deleted=True))
+    assert not photo.startswith("data:")
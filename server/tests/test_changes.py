@@ -0,0 +1,82 @@
+from src.changes import ChangeLog, Scope
+from src.roster import roster_log
+
+
+def teacher(teacher_id, department, name="T"):
+    return {"id": teacher_id, "name": name, "department": department, "groups": []}
+
+
+def student(student_id, department, group_id=None, name="S"):
+    return {"id": student_id, "name": name, "department": department, "group_id": group_id}
+
+
+def test_since_merges_missed_revisions():
+    log = ChangeLog()
+    log.append([teacher(1, "A", "old")], [], [], [])
+    log.append([teacher(1, "A", "new"), teacher(2, "A")], [student(1, "A")], [], [])
+    log.append([], [], [], [1])
+
+    delta = log.since(1)
+    assert (delta["from_revision"], delta["revision"]) == (1, 3)
+    assert [(item["id"], item["name"]) for item in delta["teachers"]] == [(1, "new"), (2, "T")]
+    assert delta["students"] == []
+    assert delta["deleted"] == {"teachers": [], "students": [1]}
+    assert delta["epoch"] == log.epoch
+
+
+def test_since_current_revision_is_empty_delta():
+    log = ChangeLog()
+    log.append([teacher(1, "A")], [], [], [])
+    delta = log.since(1)
+    assert delta["teachers"] == [] and delta["students"] == []
+    assert delta["revision"] == 1
+
+
+def test_since_needs_snapshot_when_history_is_gone():
+    log = ChangeLog(size=2)
+    for teacher_id in range(1, 5):
+        log.append([teacher(teacher_id, "A")], [], [], [])
+    # Ревизии 1 и 2 вытеснены из журнала
+    assert log.since(1) is None
+    assert log.since(2)["revision"] == 4
+    # Ревизия из будущего — журнал другого процесса
+    assert log.since(10) is None
+    log.invalidate()
+    assert log.since(4) is None
+    assert log.since(5)["revision"] == 5
+
+
+def test_since_with_scope_reports_departed_records_as_deleted():
+    log = ChangeLog()
+    log.append([], [student(1, "A"), student(2, "B")], [], [], departments={"A", "B"})
+    log.append([], [student(1, "B")], [], [], departments={"A", "B"})
+
+    delta = log.since(1, Scope(departments={"A"}))
+    assert delta["students"] == []
+    assert delta["deleted"]["students"] == [1]
+
+    # Изменение чужой кафедры подписке не нужно: дельта годится и с более ранней ревизии
+    log.append([teacher(1, "C")], [], [], [], departments={"C"})
+    delta = log.since(2, Scope(departments={"A"}))
+    assert delta["from_revision"] == 2 and delta["revision"] == 3
+    assert delta["teachers"] == [] and delta["students"] == []
+
+
+def test_reconnect_with_foreign_epoch_gets_snapshot(client):
+    with client.websocket_connect("/ws?protocol=delta") as ws:
+        first = ws.receive_json()
+        ws.send_json({"action": "create", "type": "teacher", "name": "T1", "department": "A"})
+        ws.receive_json()
+    revision = first["revision"]
+
+    with client.websocket_connect(f"/ws?protocol=delta&since={revision}&epoch={roster_log.epoch}") as ws:
+        message = ws.receive_json()
+        assert message["type"] == "delta"
+        assert [item["name"] for item in message["teachers"]] == ["T1"]
+
+    # Журнал после перезапуска: та же ревизия другой эпохи ничего не значит
+    with client.websocket_connect(f"/ws?protocol=delta&since={revision}&epoch=other") as ws:
+        message = ws.receive_json()
+        assert message["type"] == "snapshot"
+        assert message["epoch"] == roster_log.epoch
+        assert [item["name"] for item in message["teachers"]] == ["T1"]
@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+from src import hub
+from src.changes import Scope, pop_committed
+from src.database import SessionLocal
+from src.hub import Hub, InProcessBackend, RESYNC, Subscriber
+from src.models import Teachers
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, message):
+        self.sent.append(json.loads(message))
+
+
+async def received(websocket, count):
+    for _ in range(200):
+        if len(websocket.sent) >= count:
+            return websocket.sent
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"expected {count} messages, got {websocket.sent}")
+
+
+async def connect(target, **options):
+    websocket = FakeWebSocket()
+    subscriber = target.subscribe(websocket, protocol="delta", **options)
+    with SessionLocal() as db:
+        await target.activate(subscriber, db)
+    await received(websocket, 1)
+    return websocket, subscriber
+
+
+def test_full_queue_collapses_to_resync(monkeypatch):
+    monkeypatch.setattr(hub, "SEND_QUEUE_SIZE", 3)
+    subscriber = Subscriber(FakeWebSocket())
+    for revision in range(1, 6):
+        subscriber.offer(revision - 1, revision, f"delta {revision}")
+
+    queued = [subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize())]
+    # Медленный клиент не копит сообщения: выброшенные заменяет один маркер догоняющего снимка
+    assert queued == [(None, None, RESYNC), (3, 4, "delta 4"), (4, 5, "delta 5")]
+    assert subscriber.dropped == 3
+
+
+def test_changes_reach_only_subscribed_departments():
+    async def scenario():
+        target = Hub(InProcessBackend())
+        await target.start()
+        a_socket, _ = await connect(target, scope=Scope(departments={"A"}))
+        b_socket, _ = await connect(target, scope=Scope(departments={"B"}))
+        with SessionLocal() as db:
+            db.add(Teachers(name="T", department="A"))
+            db.commit()
+            await target.publish(pop_committed(db))
+        [_, delta] = await received(a_socket, 2)
+        await asyncio.sleep(0.05)
+        await target.stop()
+        return delta, b_socket.sent
+
+    delta, others = asyncio.run(scenario())
+    assert delta["type"] == "delta"
+    assert [item["name"] for item in delta["teachers"]] == ["T"]
+    assert len(others) == 1
+
+
+def test_changes_are_broadcast_to_other_clients(client):
+    with client.websocket_connect("/ws?protocol=delta") as sender, client.websocket_connect("/ws?protocol=delta") as other:
+        sender.receive_json()
+        other.receive_json()
+        sender.send_json({"action": "create", "type": "teacher", "name": "T1", "department": "A"})
+        delta = other.receive_json()
+        assert delta["type"] == "delta"
+        assert [item["name"] for item in delta["teachers"]] == ["T1"]
+
+
+def test_http_writes_are_broadcast(client, db):
+    teacher = Teachers(name="T", department="A")
+    db.add(teacher)
+    db.flush()
+    teacher_id = teacher.id
+    db.commit()
+    with client.websocket_connect("/ws?protocol=delta") as delta_client, client.websocket_connect("/ws") as snapshot_client:
+        delta_client.receive_json()
+        snapshot_client.receive_json()
+        client.post("/students/", json={"name": "S", "department": "A", "teacher_id": teacher_id})
+        delta = delta_client.receive_json()
+        snapshot = snapshot_client.receive_json()
+    assert delta["type"] == "delta"
+    assert [item["name"] for item in delta["students"]] == ["S"]
+    assert [item["name"] for item in snapshot["students"]] == ["S"]
+
+
+def test_other_worker_events_over_backend():
+    async def scenario():
+        backend = InProcessBackend()
+        first, second = Hub(backend), Hub(backend)
+        await first.start()
+        await second.start()
+        websocket, subscriber = await connect(second)
+
+        # Изменение, зафиксированное другим воркером
+        with SessionLocal() as db:
+            db.add(Teachers(name="T", department="A"))
+            db.commit()
+            await first.publish(pop_committed(db))
+        await received(websocket, 2)
+
+        # Ход задания, которое выполняет другой воркер
+        second.follow(subscriber, 7)
+        await first.job_event({"id": 7, "kind": "import_students", "status": "running", "progress": 1, "total": 2})
+        await received(websocket, 3)
+
+        # Изменение неизвестного состава: все клиенты догоняют состояние снимком
+        await backend.publish({"origin": first.id, "full": True})
+        messages = await received(websocket, 4)
+        await first.stop()
+        await second.stop()
+        return messages
+
+    initial, delta, job, resync = asyncio.run(scenario())
+    assert initial["type"] == "snapshot"
+    assert [item["name"] for item in delta["teachers"]] == ["T"]
+    assert job == {"type": "job", "job": {"id": 7, "kind": "import_students", "status": "running", "progress": 1, "total": 2, "error": None}}
+    assert resync["type"] == "snapshot" and resync["revision"] > delta["revision"]
+    assert [item["name"] for item in resync["teachers"]] == ["T"]
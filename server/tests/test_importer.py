@@ -0,0 +1,67 @@
+import json
+import os
+import time
+
+from src import importer
+from src.models import Teachers, Students
+
+
+def wait_job(client, job_id):
+    for _ in range(200):
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_import_reports_errors_per_row(client, db):
+    db.add(Teachers(name="T", department="A"))
+    db.commit()
+    body = "\n".join([
+        json.dumps({"name": "Ann", "department": "A"}),
+        "{broken",
+        json.dumps({"name": "", "department": "A"}),
+        json.dumps({"name": "Bob", "department": "A", "date_of_birth": "not a date"}),
+        json.dumps({"name": "Eve", "department": "Nowhere"}),
+        json.dumps(["not", "an", "object"]),
+        json.dumps({"name": "Dan", "department": "A", "dateOfBirth": "2001-02-03"}),
+    ])
+
+    summary = client.post("/students/import?format=jsonl", content=body).json()
+
+    assert (summary["total"], summary["imported"], summary["failed"]) == (7, 2, 5)
+    errors = {error["line"]: error["error"] for error in summary["errors"]}
+    assert errors.pop(2).startswith("invalid JSON")
+    assert errors == {
+        3: "name is required",
+        4: "date_of_birth must be an ISO date (YYYY-MM-DD)",
+        5: "No teachers in the department",
+        6: "expected a JSON object",
+    }
+    assert sorted(name for (name,) in db.query(Students.name)) == ["Ann", "Dan"]
+
+
+def test_csv_import_keeps_multiline_fields(client, db):
+    db.add(Teachers(name="T", department="A"))
+    db.commit()
+    body = 'name,department\n"Ann\nLee",A\nBob\n'
+    summary = client.post("/students/import", content=body, headers={"Content-Type": "text/csv"}).json()
+    assert (summary["imported"], summary["failed"]) == (1, 1)
+
+
+def test_background_import_streams_spooled_file(client, db, monkeypatch):
+    monkeypatch.setattr(importer, "IMPORT_BATCH_SIZE", 4)
+    db.add(Teachers(name="T", department="A"))
+    db.commit()
+    body = "\n".join(json.dumps({"name": f"S{number}", "department": "A"}) for number in range(10)) + "\n{bad\n"
+
+    response = client.post("/students/import?background=true&format=jsonl", content=body)
+    assert response.status_code == 202
+    job = wait_job(client, response.json()["id"])
+
+    assert job["status"] == "done"
+    assert (job["result"]["total"], job["result"]["imported"], job["result"]["failed"]) == (11, 10, 1)
+    assert db.query(Students).count() == 10
+    # Файл задания удаляется после импорта
+    assert os.listdir(importer.IMPORT_SPOOL_DIR) == []
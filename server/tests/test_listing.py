@@ -0,0 +1,51 @@
+from datetime import date
+
+from src.listing import encode_cursor
+from src.models import Students
+
+
+def seed(db):
+    births = [date(2001, 5, 1), None, date(2000, 1, 1), date(2001, 5, 1), None]
+    db.add_all([
+        Students(name=name, department="A", date_of_birth=born)
+        for name, born in zip(["Bob", "Ann", "Bob", "Cid", "Ann"], births)
+    ])
+    db.commit()
+
+
+def pages(client, **params):
+    items, cursor = [], None
+    while True:
+        page = client.get("/students/", params={**params, **({"cursor": cursor} if cursor else {})}).json()
+        items += page["items"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return items
+
+
+def test_pages_follow_sort_order(client, db):
+    seed(db)
+    by_name = pages(client, sort="name", limit=2, fields="name")
+    assert [(item["name"], item["id"]) for item in by_name] == [("Ann", 2), ("Ann", 5), ("Bob", 1), ("Bob", 3), ("Cid", 4)]
+    assert set(by_name[0]) == {"id", "name"}
+
+    # Пустые даты — в конце в обоих направлениях
+    by_birth = pages(client, sort="date_of_birth", order="desc", limit=2)
+    assert [item["id"] for item in by_birth] == [4, 1, 3, 5, 2]
+
+
+def test_filters_apply_to_pages(client, db):
+    seed(db)
+    assert [item["id"] for item in pages(client, name="bo", limit=1)] == [1, 3]
+    assert [item["id"] for item in pages(client, born_after="2001-01-01", limit=10)] == [1, 4]
+
+
+def test_invalid_requests(client, db):
+    seed(db)
+    assert client.get("/students/", params={"cursor": "garbage"}).status_code == 400
+    assert client.get("/students/", params={"sort": "name", "cursor": encode_cursor("id", 1, 1)}).status_code == 400
+    # Значение в курсоре не того типа, что ключ сортировки
+    for sort, value in (("name", 5), ("name", ["Bob"]), ("id", "1"), ("date_of_birth", 20010101), ("group", True)):
+        assert client.get("/students/", params={"sort": sort, "cursor": encode_cursor(sort, value, 1)}).status_code == 400
+    assert client.get("/students/", params={"sort": "photo"}).status_code == 400
+    assert client.get("/students/", params={"fields": "password"}).status_code == 400
@@ -0,0 +1,50 @@
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import IntegrityError
+
+from src import migrate
+
+# Таблицы в том виде, в каком их создавала первая версия сервера
+OLD_SCHEMA = [
+    "CREATE TABLE teachers (id INTEGER NOT NULL, uuid CHAR(32) NOT NULL, name VARCHAR(100) NOT NULL, "
+    "created_at TIMESTAMP DEFAULT (CURRENT_TIMESTAMP), department VARCHAR, photo VARCHAR, date_of_birth DATE, "
+    "PRIMARY KEY (id), UNIQUE (uuid))",
+    "CREATE TABLE groups (id INTEGER NOT NULL, name VARCHAR NOT NULL, teacher_id INTEGER NOT NULL, "
+    "PRIMARY KEY (id), UNIQUE (name), FOREIGN KEY(teacher_id) REFERENCES teachers (id) ON DELETE CASCADE)",
+    "CREATE TABLE students (id INTEGER NOT NULL, uuid CHAR(32) NOT NULL, name VARCHAR(100) NOT NULL, "
+    "department VARCHAR, group_id INTEGER, created_at TIMESTAMP DEFAULT (CURRENT_TIMESTAMP), photo VARCHAR, "
+    "date_of_birth DATE, PRIMARY KEY (id), UNIQUE (uuid), FOREIGN KEY(group_id) REFERENCES groups (id) ON DELETE CASCADE)",
+    "INSERT INTO teachers (id, uuid, name, department) VALUES (1, 't1', 'T', 'A')",
+    "INSERT INTO groups (id, name, teacher_id) VALUES (1, 'G1', 1)",
+    "INSERT INTO students (id, uuid, name, department, group_id) VALUES (1, 's1', 'S1', 'A', 1), (2, 's2', 'S2', 'A', 1)",
+]
+
+
+@pytest.fixture
+def old_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    with engine.begin() as conn:
+        for statement in OLD_SCHEMA:
+            conn.execute(text(statement))
+    yield engine
+    engine.dispose()
+
+
+def test_migrate_drops_unique_group_name_on_sqlite(old_engine):
+    result = migrate.migrate(old_engine)
+    assert result["deleted_at_added"] == ["students", "groups"] and result["student_count_added"]
+    # Повторный запуск ничего не меняет
+    migrate.migrate(old_engine)
+
+    with old_engine.begin() as conn:
+        assert inspect(conn).get_unique_constraints("groups") == []
+        assert "ux_groups_active_name" in {index["name"] for index in inspect(conn).get_indexes("groups")}
+        assert [fk["referred_table"] for fk in inspect(conn).get_foreign_keys("students")] == ["groups"]
+        assert [fk["options"] for fk in inspect(conn).get_foreign_keys("groups")] == [{"ondelete": "CASCADE"}]
+        assert conn.execute(text("SELECT name, teacher_id, student_count FROM groups")).all() == [("G1", 1, 2)]
+
+        # Название закрытой группы можно занять снова, действующей — нельзя
+        conn.execute(text("UPDATE groups SET deleted_at = CURRENT_TIMESTAMP"))
+        conn.execute(text("INSERT INTO groups (name, teacher_id) VALUES ('G1', 1)"))
+    with pytest.raises(IntegrityError), old_engine.begin() as conn:
+        conn.execute(text("INSERT INTO groups (name, teacher_id) VALUES ('G1', 1)"))
@@ -0,0 +1,39 @@
+import base64
+
+import pytest
+
+from src import photos
+
+PIXEL = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+
+def test_upload_is_content_addressed(client):
+    first = client.post("/photos/", content=PIXEL).json()
+    second = client.post("/photos/", content=PIXEL).json()
+    assert first == second
+    assert first["url"] == f"/photos/{first['hash']}"
+
+    response = client.get(first["url"])
+    assert response.content == PIXEL
+    assert response.headers["content-type"] == "image/png"
+    etag = response.headers["etag"]
+    assert client.get(first["url"], headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_thumbnail(client):
+    pytest.importorskip("PIL")
+    uploaded = client.post("/photos/", content=PIXEL).json()
+    assert client.get(uploaded["thumbnail_url"]).headers["content-type"] == "image/jpeg"
+
+
+def test_upload_rejects_non_images(client):
+    assert client.post("/photos/", content=b"plain text").status_code == 400
+    assert client.get("/photos/" + "0" * 64).status_code == 404
+
+
+def test_data_url_is_stored_as_reference():
+    url = photos.photo_ref("data:image/png;base64," + base64.b64encode(PIXEL).decode())
+    assert url.startswith("/photos/")
+    assert photos.photo_ref(url) == url
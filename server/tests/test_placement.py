@@ -0,0 +1,160 @@
+from collections import Counter
+
+import pytest
+from sqlalchemy import func, update
+
+from src import placement
+from src.capacity import GROUP_CAPACITY, capacity_cache
+from src.models import Teachers, Students, Group
+from src.placement import place_student, place_batch, plan_redistribution, apply_redistribution
+
+
+def add_teachers(db, department, count):
+    teachers = [Teachers(name=f"T{number}", department=department) for number in range(count)]
+    db.add_all(teachers)
+    db.commit()
+    return [teacher.id for teacher in teachers]
+
+
+def group_counts(db):
+    return [(row.teacher_id, row.student_count) for row in db.query(Group.teacher_id, Group.student_count).order_by(Group.id)]
+
+
+def test_place_student_fills_groups_before_opening_new(db):
+    first, second = add_teachers(db, "A", 2)
+    for _ in range(2 * GROUP_CAPACITY + 1):
+        place_student(db, "A")
+        db.commit()
+    # Новая группа — у преподавателя с наименьшим числом групп
+    assert group_counts(db) == [(first, GROUP_CAPACITY), (second, GROUP_CAPACITY), (first, 1)]
+
+
+def test_place_student_reuses_freed_seat(db):
+    [teacher] = add_teachers(db, "A", 1)
+    db.add_all([
+        Group(name="Full", teacher_id=teacher, student_count=GROUP_CAPACITY),
+        Group(name="Freed", teacher_id=teacher, student_count=GROUP_CAPACITY - 1),
+    ])
+    db.commit()
+    place_student(db, "A")
+    db.commit()
+    assert group_counts(db) == [(teacher, GROUP_CAPACITY), (teacher, GROUP_CAPACITY)]
+
+
+def test_place_student_without_teachers(db):
+    with pytest.raises(ValueError):
+        place_student(db, "Empty")
+
+
+def test_place_student_rejects_stale_hint(db):
+    add_teachers(db, "A", 1)
+    place_student(db, "A")
+    db.commit()
+    assert capacity_cache.get(db, "A").first_free({}) is not None
+    db.rollback()
+
+    # Группу заполнил другой воркер: подсказка кэша устарела, но переполнить группу не даёт SQL
+    db.execute(update(Group).values(student_count=GROUP_CAPACITY))
+    db.commit()
+    rejections = capacity_cache.rejections
+
+    place_student(db, "A")
+    db.commit()
+    assert [count for _, count in group_counts(db)] == [GROUP_CAPACITY, 1]
+    assert capacity_cache.rejections == rejections + 1
+
+
+def test_place_student_uses_seat_freed_behind_cache(db):
+    add_teachers(db, "A", 1)
+    for _ in range(GROUP_CAPACITY):
+        place_student(db, "A")
+        db.commit()
+    assert capacity_cache.get(db, "A").first_free({}) is None
+    db.rollback()
+
+    # Место освободил другой воркер: кэш этого процесса о нём не знает
+    db.execute(update(Group).values(student_count=GROUP_CAPACITY - 1))
+    db.commit()
+    rejections = capacity_cache.rejections
+
+    place_student(db, "A")
+    db.commit()
+    assert [count for _, count in group_counts(db)] == [GROUP_CAPACITY]
+    assert capacity_cache.rejections == rejections + 1
+
+
+def test_place_student_waits_for_locked_group(db, monkeypatch):
+    [teacher] = add_teachers(db, "A", 1)
+    place_student(db, "A")
+    db.commit()
+    original = placement.reserve_seat
+
+    def locked(db, department, group_id=None, wait=False):
+        # Группу сейчас заполняет параллельное зачисление: SKIP LOCKED её не видит
+        return original(db, department, group_id, wait) if wait else None
+
+    monkeypatch.setattr(placement, "reserve_seat", locked)
+    place_student(db, "A")
+    db.commit()
+    assert group_counts(db) == [(teacher, 2)]
+
+
+def test_place_student_reuses_group_opened_in_transaction(db):
+    [teacher] = add_teachers(db, "A", 1)
+    # Группа, открытая в этой же транзакции, ещё не попала в кэш
+    for _ in range(3):
+        place_student(db, "A")
+    db.commit()
+    assert group_counts(db) == [(teacher, 3)]
+
+
+def test_place_batch_respects_capacity(db):
+    first, second = add_teachers(db, "A", 2)
+    db.add(Group(name="Existing", teacher_id=second, student_count=GROUP_CAPACITY - 3))
+    db.commit()
+
+    assigned = place_batch(db, "A", 25)
+    db.commit()
+
+    assert len(assigned) == 25
+    counts = group_counts(db)
+    assert all(count <= GROUP_CAPACITY for _, count in counts)
+    assert sum(count for _, count in counts) == GROUP_CAPACITY - 3 + 25
+    # Сначала занимаются свободные места существующей группы
+    assert Counter(assigned)[assigned[0]] == 3
+    assert counts == [(second, GROUP_CAPACITY), (first, GROUP_CAPACITY), (first, GROUP_CAPACITY), (second, 2)]
+
+
+def test_place_batch_without_teachers(db):
+    with pytest.raises(ValueError):
+        place_batch(db, "Empty", 1)
+
+
+def test_redistribution_keeps_groups_within_capacity(db):
+    leaving, first, second = add_teachers(db, "A", 3)
+    for name, teacher_id, count in (("L1", leaving, GROUP_CAPACITY), ("L2", leaving, 3), ("F1", first, GROUP_CAPACITY - 2)):
+        group = Group(name=name, teacher_id=teacher_id, student_count=count)
+        db.add(group)
+        db.flush()
+        db.add_all([Students(name=f"{name}-{number}", department="A", group_id=group.id) for number in range(count)])
+    db.commit()
+
+    plan = plan_redistribution(db, leaving, lock=True)
+    assert len(plan["moves"]) == GROUP_CAPACITY + 3
+    # Студенты распределяются по кругу между оставшимися преподавателями
+    assert [move["to_teacher_id"] for move in plan["moves"][:4]] == [first, second, first, second]
+    apply_redistribution(db, plan)
+    db.commit()
+
+    actual = dict(db.query(Students.group_id, func.count()).group_by(Students.group_id).all())
+    counts = {row.id: (row.teacher_id, row.student_count) for row in db.query(Group.id, Group.teacher_id, Group.student_count)}
+    assert all(teacher_id != leaving for teacher_id, _ in counts.values())
+    assert {group_id: count for group_id, (_, count) in counts.items()} == actual
+    assert all(count <= GROUP_CAPACITY for count in actual.values())
+    assert sum(actual.values()) == 2 * GROUP_CAPACITY + 1
+
+
+def test_redistribution_needs_another_teacher(db):
+    [teacher] = add_teachers(db, "A", 1)
+    with pytest.raises(ValueError):
+        plan_redistribution(db, teacher)
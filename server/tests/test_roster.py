@@ -0,0 +1,78 @@
+from datetime import date
+
+from src.models import Teachers, Students, Group
+from src.roster import snapshot_cache
+
+
+def seed(db):
+    teacher = Teachers(name="T", department="A", date_of_birth=date(1970, 1, 2))
+    db.add(teacher)
+    db.flush()
+    group = Group(name="G1", teacher_id=teacher.id, student_count=1)
+    db.add(group)
+    db.flush()
+    db.add_all([Students(name="S", department="A", group_id=group.id), Students(name="Free", department="A")])
+    db.commit()
+
+
+def test_snapshot_contains_groups_and_iso_dates(client, db):
+    seed(db)
+    with client.websocket_connect("/ws") as ws:
+        snapshot = ws.receive_json()
+    [teacher] = snapshot["teachers"]
+    assert (teacher["name"], teacher["groups"], teacher["date_of_birth"]) == ("T", ["G1"], "1970-01-02")
+    assert [(s["name"], s["group_name"]) for s in snapshot["students"]] == [("S", "G1"), ("Free", None)]
+    assert all(isinstance(s["uuid"], str) and s["created_at"] for s in snapshot["students"])
+
+
+def test_roster_snapshot_is_cached_per_revision(client, db):
+    seed(db)
+    first = client.get("/roster")
+    assert first.json()["type"] == "snapshot"
+    hits = snapshot_cache.hits
+    assert client.get("/roster").json() == first.json()
+    assert snapshot_cache.hits == hits + 1
+    assert client.get("/roster", headers={"If-None-Match": first.headers["etag"]}).status_code == 304
+
+    with client.websocket_connect("/ws?protocol=delta") as ws:
+        ws.receive_json()
+        ws.send_json({"action": "create", "type": "teacher", "name": "T2", "department": "B"})
+        ws.receive_json()
+    second = client.get("/roster", headers={"If-None-Match": first.headers["etag"]})
+    assert second.status_code == 200 and second.headers["etag"] != first.headers["etag"]
+    assert [teacher["name"] for teacher in second.json()["teachers"]] == ["T", "T2"]
+
+
+def test_columnar_encoding_keeps_rows(client, db):
+    seed(db)
+    rows = client.get("/roster").json()
+    packed = client.get("/roster", params={"encoding": "columnar"}).json()
+    assert packed["layout"] == "columnar"
+    assert packed["students"]["name"] == [student["name"] for student in rows["students"]]
+    # Неизвестная кодировка — обычный JSON
+    assert client.get("/roster", params={"encoding": "xml"}).json() == rows
+
+    with client.websocket_connect("/ws?encoding=columnar") as ws:
+        snapshot = ws.receive_json()
+    assert snapshot["teachers"]["name"] == ["T"] and snapshot["students"]["group_name"] == ["G1", None]
+
+
+def test_http_writes_reach_cached_roster(client, db):
+    teacher = Teachers(name="T", department="A")
+    db.add(teacher)
+    db.flush()
+    teacher_id = teacher.id
+    db.commit()
+    first = client.get("/roster")
+    assert first.json()["students"] == []
+
+    student = client.post("/students/", json={"name": "S", "department": "A", "teacher_id": teacher_id})
+    assert student.status_code == 200 and student.json()["name"] == "S"
+    group = client.post("/groups/", json={"name": "Extra", "teacher_id": teacher_id})
+    assert group.status_code == 200 and group.json()["name"] == "Extra"
+
+    # Запись через HTTP — новая ревизия: кэшированный снимок и его ETag больше не годятся
+    second = client.get("/roster", headers={"If-None-Match": first.headers["etag"]})
+    assert second.status_code == 200
+    assert [student["name"] for student in second.json()["students"]] == ["S"]
+    assert "Extra" in second.json()["teachers"][0]["groups"]
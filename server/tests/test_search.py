@@ -0,0 +1,48 @@
+from src import search
+from src.main import enroll_student
+from src.models import Teachers
+
+
+def add_roster(db):
+    teacher = Teachers(name="Ivan Petrov", department="Math")
+    db.add_all([teacher, Teachers(name="Olga Smirnova", department="Physics")])
+    db.flush()
+    for name in ("Anna Ivanova", "Boris Orlov"):
+        enroll_student(db, {"name": name, "department": "Math", "teacher_id": teacher.id})
+    db.commit()
+
+
+def names(result):
+    return [(item["type"], item["name"]) for item in result["items"]]
+
+
+def test_prefix_search_ranks_name_matches_first(db):
+    add_roster(db)
+    assert names(search.search(db, "iva")) == [("teacher", "Ivan Petrov"), ("student", "Anna Ivanova")]
+    # Совпадение в кафедре весит меньше совпадения в имени
+    result = search.search(db, "math orl")
+    assert names(result) == [("student", "Boris Orlov")]
+    assert result["items"][0]["score"] == 1.5
+    # Название группы тоже ищется
+    assert ("student", "Anna Ivanova") in names(search.search(db, "group"))
+
+
+def test_prefix_search_filters(db):
+    add_roster(db)
+    assert names(search.search(db, "iva", types="student")) == [("student", "Anna Ivanova")]
+    assert names(search.search(db, "olga", department="Math")) == []
+    assert len(search.search(db, "math", limit=1)["items"]) == 1
+
+
+def test_prefix_index_sees_committed_changes(db):
+    add_roster(db)
+    assert names(search.search(db, "zoya")) == []
+    db.add(Teachers(name="Zoya Kim", department="Math"))
+    db.commit()
+    assert names(search.search(db, "zoya")) == [("teacher", "Zoya Kim")]
+
+
+def test_search_validates_query(client):
+    assert client.get("/search", params={"q": "a"}).status_code == 400
+    assert client.get("/search", params={"q": "ab", "types": "group"}).status_code == 400
+    assert client.get("/search", params={"q": "ab"}).json() == {"items": []}
@@ -0,0 +1,58 @@
+import pytest
+
+from src.models import Teachers, Students, RequestCount
+from src.workflow import recount_requests
+
+
+@pytest.fixture
+def people(db):
+    teacher = Teachers(name="T", department="A")
+    student = Students(name="S", department="A")
+    db.add_all([teacher, student])
+    db.flush()
+    ids = teacher.id, student.id
+    db.commit()
+    return ids
+
+
+def counts(db):
+    return sorted((row.teacher_id, row.status, row.stage, row.total) for row in db.query(RequestCount) if row.total)
+
+
+def test_transitions_keep_counts_in_step(client, db, people):
+    teacher_id, student_id = people
+    created = client.post("/requests/", json=[
+        {"teacher_id": teacher_id}, {"teacher_id": teacher_id, "student_id": student_id}, {"student_id": student_id},
+    ]).json()
+    first, second, third = [request["id"] for request in created]
+    assert {request["stage"] for request in created} == {"new"}
+
+    result = client.post("/requests/transitions", json={"ids": [first, second, 999], "stage": "review"}).json()
+    assert result == {"updated": [first, second], "skipped": [{"id": 999, "error": "Request not found"}]}
+    assert client.post(f"/requests/{first}/transition", json={"status": "done"}).json()["status"] == "done"
+    # Закрытую заявку дальше не переводят
+    assert client.post(f"/requests/{first}/transition", json={"stage": "again"}).status_code == 409
+
+    request = client.get(f"/requests/{first}").json()
+    assert [(stage["stage"], stage["status"]) for stage in request["stages"]] == [("new", "completed"), ("review", "completed")]
+    assert client.get("/requests/counts", params={"teacher_id": teacher_id}).json() == {
+        "total": 2,
+        "by_status": {"open": 0, "in_progress": 1, "done": 1, "cancelled": 0},
+        "by_stage": {"review": 1},
+    }
+    assert client.get("/requests/counts", params={"teacher_id": 0}).json()["by_stage"] == {"new": 1}
+
+    # Счётчики, которые вели по ходу переходов, совпадают с пересчётом по заявкам
+    kept = counts(db)
+    recount_requests(db)
+    db.commit()
+    assert counts(db) == kept
+    assert third in [item["id"] for item in client.get("/requests/", params={"stage": "new"}).json()["items"]]
+
+
+def test_invalid_requests_get_400(client, people):
+    assert client.post("/requests/", json=[{"stage": "new"}]).status_code == 400
+    assert client.post("/requests/", json=[{"teacher_id": 999}]).status_code == 400
+    assert client.post("/requests/transitions", json={"ids": [1]}).status_code == 400
+    assert client.get("/requests/", params={"status": "lost"}).status_code == 400
+    assert client.get("/requests/", params={"cursor": "garbage"}).status_code == 400